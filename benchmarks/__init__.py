@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks for yo's ingest, delivery and API hot paths
+
+    Run with:
+
+        python -m benchmarks.run --db-url sqlite:///bench.db --output new.json
+        python -m benchmarks.run --compare baseline.json new.json
+
+    See benchmarks/run.py for all the options.
+"""
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+""" The benchmark cases
+
+    Each case takes a prepared YoDatabase and the options and returns a
+    dict of measurements, see measure() for the keys.
+"""
+import asyncio
+import json
+import time
+import uuid
+
+from yo import config
+from yo.cache import RecentNotificationCache
+from yo.db import Priority
+from yo.ratelimits import SlidingWindowLimiter
+from yo.ratelimits import check_ratelimit
+from yo.services.blockchain_follower import YoBlockchainFollower
+from yo.services.notification_sender import YoNotificationSender
+from yo.transports.base_transport import BaseTransport
+
+from .opstream import DEFAULT_MIX
+from .opstream import OpStream
+from .seed import username
+from .standins import start_standin
+
+
+class BenchApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+    def signal_private_api(self, service=None, api_method=None):
+        pass
+
+
+class NullTransport(BaseTransport):
+    def __init__(self):
+        self.sent = 0
+
+    def send_notification(self, **kwargs):
+        self.sent += 1
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(
+        int(q * len(sorted_values)),
+        len(sorted_values) - 1)]
+
+
+def summarise(latencies, items=None):
+    """Turns a list of per-call latencies into the stored result format"""
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    items = len(latencies) if items is None else items
+    return {
+        'calls': len(latencies),
+        'items': items,
+        'total_seconds': total,
+        'ops_per_sec': items / total if total else None,
+        'mean': total / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def measure(func, iterations):
+    latencies = []
+    for n in range(iterations):
+        start = time.perf_counter()
+        func(n)
+        latencies.append(time.perf_counter() - start)
+    return summarise(latencies)
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def make_ops(op_type, count, users):
+    """Blockchain ops of one type, as returned by get_ops_in_block"""
+    ops = []
+    for n in range(count):
+        author, other = username(n % users), username((n + 1) % users)
+        if op_type == 'vote':
+            op = ('vote', {
+                'voter': other,
+                'author': author,
+                'permlink': 'bench-post-%d' % n,
+                'weight': 10000
+            })
+        elif op_type == 'custom_json':
+            op = ('custom_json', {
+                'required_auths': [],
+                'required_posting_auths': [other],
+                'id': 'follow',
+                'json': json.dumps(['follow', {
+                    'follower': other,
+                    'following': author,
+                    'what': ['blog']
+                }])
+            })
+        elif op_type == 'transfer':
+            op = ('transfer', {
+                'from': other,
+                'to': author,
+                'amount': '1.000 STEEM',
+                'memo': 'bench %d' % n
+            })
+        elif op_type == 'comment':
+            # top level posts, so no parent lookup on steemd
+            op = ('comment', {
+                'parent_author': '',
+                'parent_permlink': 'bench',
+                'author': other,
+                'permlink': 'bench-post-%d' % n,
+                'title': 'Bench post',
+                'body': 'Hello @%s and @%s, benchmarking\n' % (author, other),
+                'json_metadata': '{}'
+            })
+        else:
+            raise ValueError('Unknown op type %s' % op_type)
+        ops.append({'trx_id': uuid.uuid4().hex, 'op': op})
+    return ops
+
+
+FOLLOWER_OP_TYPES = ('vote', 'custom_json', 'transfer', 'comment')
+
+
+def bench_follower_notify(yo_db, options):
+    follower = YoBlockchainFollower(db=yo_db, yo_app=BenchApp(yo_db))
+    results = {}
+    for op_type in FOLLOWER_OP_TYPES:
+        ops = make_ops(op_type, options.ops, options.users)
+
+        async def run(ops=ops):
+            latencies = []
+            for op in ops:
+                start = time.perf_counter()
+                await follower.notify(op)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        results['follower_notify.%s' % op_type] = summarise(run_async(run()))
+
+    # realistic traffic mix, replies are left out as they need a parent
+    # lookup on steemd
+    stream = OpStream(seed=options.seed, users=options.users,
+                      user_prefix='benchuser', mix=dict(DEFAULT_MIX, reply=0))
+    ops = []
+    block_num = 1
+    while len(ops) < options.ops:
+        ops.extend(stream.get_ops_in_block(block_num))
+        block_num += 1
+
+    async def run_mixed():
+        latencies = []
+        for op in ops[:options.ops]:
+            start = time.perf_counter()
+            await follower.notify(op)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results['follower_notify.mixed'] = summarise(run_async(run_mixed()))
+    return results
+
+
+def bench_send_notify(yo_db, options):
+    sender = YoNotificationSender(db=yo_db, yo_app=BenchApp(yo_db))
+    transport = NullTransport()
+    sender.configured_transports = {'wwwpoll': transport}
+    unsent = sum(len(rows) for rows in yo_db.get_wwwpoll_unsents().values())
+    start = time.perf_counter()
+    run_async(sender.run_send_notify())
+    elapsed = time.perf_counter() - start
+    if unsent and not transport.sent:
+        raise RuntimeError('run_send_notify sent none of %d unsent '
+                           'notifications' % unsent)
+    result = summarise([elapsed], items=transport.sent)
+    result['sent'] = transport.sent
+    result['unsent'] = unsent
+    return {'run_send_notify': result}
+
+
+def bench_check_ratelimit(yo_db, options):
+    priorities = [int(p) for p in Priority.__members__.values()]
+    notifications = [{
+        'to_username': username(n % options.users),
+        'priority_level': priorities[n % len(priorities)]
+    } for n in range(options.ops)]
+    limiter = SlidingWindowLimiter()
+    limiter.warm_start(yo_db)
+    return {
+        'check_ratelimit':
+        measure(lambda n: check_ratelimit(yo_db, notifications[n]),
+                options.ops),
+        'check_ratelimit.in_memory':
+        measure(lambda n: limiter.check(yo_db, notifications[n]),
+                options.ops)
+    }
+
+
+def bench_api_reads(yo_db, options):
+    user = options.history_user
+    depth = options.history_depth
+    nids = [
+        row['nid']
+        for row in yo_db.get_wwwpoll_notifications(
+            to_username=user, limit=options.ops)
+    ] or [None]
+    results = {
+        # what yo.get_notifications calls, with the database's cache and
+        # archive if it has them
+        'get_notifications.depth_%d' % depth:
+        measure(lambda n: yo_db.get_notifications(to_username=user, limit=30),
+                options.ops),
+        'get_wwwpoll_notifications.depth_%d' % depth:
+        measure(lambda n: yo_db.get_wwwpoll_notifications(
+            to_username=user, limit=30), options.ops),
+    }
+    if yo_db.cache is None:
+        # the API nodes' default, see cache_users in yo.cfg
+        yo_db.cache = RecentNotificationCache()
+        try:
+            results['get_notifications.cached.depth_%d' % depth] = measure(
+                lambda n: yo_db.get_notifications(to_username=user, limit=30),
+                options.ops)
+        finally:
+            yo_db.cache = None
+    results['mark_read.depth_%d' % depth] = measure(
+        lambda n: yo_db.wwwpoll_mark_read(nids[n % len(nids)]), options.ops)
+    return results
+
+
+def make_transport(service, base_url):
+    # imported here so the other cases run without sendgrid and twilio
+    if service == 'sendgrid':
+        from yo.transports.sendgrid import SendGridTransport
+        return SendGridTransport('bench', 'mail_templates', base_url=base_url)
+    from yo.transports.twilio import TwilioTransport
+    return TwilioTransport(
+        'ACbench', 'bench', '+15005550006', base_url=base_url)
+
+
+def vote_item(service, n, users):
+    to_username = username(n % users)
+    return {
+        'nid': n,
+        'to_subdata': '%s@example.com' % to_username
+        if service == 'sendgrid' else '+1555%07d' % (n % 10000000),
+        'to_username': to_username,
+        'notify_type': 'vote',
+        'data': {
+            'author': to_username,
+            'permlink': 'post-%d' % n,
+            'voter': username((n + 1) % users),
+            'weight': 10000
+        }
+    }
+
+
+async def deliver(transport, items):
+    """Sends items the way the sender does, in chunks of max_batch_size,
+    max_concurrency of them at once"""
+    semaphore = asyncio.Semaphore(transport.max_concurrency)
+    size = transport.max_batch_size
+
+    async def send(chunk):
+        async with semaphore:
+            return await transport.send_batch(chunk)
+
+    results = await asyncio.gather(
+        *[send(items[i:i + size]) for i in range(0, len(items), size)])
+    return sum(sum(1 for sent in chunk if sent) for chunk in results)
+
+
+def bench_transports(yo_db, options):
+    """Email and SMS delivery against the local stand-ins"""
+    results = {}
+    for service in ('sendgrid', 'twilio'):
+
+        async def run(service=service):
+            standin, runner, base_url = await start_standin(
+                service,
+                latency=options.standin_latency,
+                error_rate=options.standin_error_rate,
+                rate=options.standin_rate)
+            try:
+                transport = make_transport(service, base_url)
+                items = [
+                    vote_item(service, n, options.users)
+                    for n in range(options.ops)
+                ]
+                await transport.start()
+                start = time.perf_counter()
+                sent = await deliver(transport, items)
+                elapsed = time.perf_counter() - start
+                await transport.stop()
+            finally:
+                await runner.cleanup()
+            return elapsed, sent, dict(standin.stats)
+
+        elapsed, sent, stats = run_async(run())
+        result = summarise([elapsed], items=sent)
+        result['sent'] = sent
+        result['failed'] = options.ops - sent
+        result['standin'] = stats
+        results['deliver.%s' % service] = result
+    return results
+
+
+CASES = {
+    'follower': bench_follower_notify,
+    'sender': bench_send_notify,
+    'ratelimit': bench_check_ratelimit,
+    'api': bench_api_reads,
+    'transports': bench_transports,
+}
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+""" Index audit: which indexes do YoDatabase's queries actually use
+
+    Builds a database with an index profile (see INDEX_PROFILES in yo/db.py),
+    seeds it, replays the query shapes YoDatabase runs for the follower, the
+    sender and the API, and EXPLAINs every statement. The report lists the
+    indexes each step used, the indexes nothing used and the steps that had
+    to scan a whole table:
+
+        python -m benchmarks.index_audit --profile query
+        python -m benchmarks.index_audit --profile full --output full.json
+
+    Plans are parsed from sqlite's EXPLAIN QUERY PLAN, on other databases an
+    index counts as used if its name shows up in the EXPLAIN output.
+"""
+import argparse
+import datetime
+import json
+import logging
+import re
+import sys
+
+import sqlalchemy as sa
+
+from yo.db import INDEX_PROFILES
+from yo.db import YoDatabase
+from yo.db import apply_index_profile
+from yo.db import metadata
+from yo.ids import min_nid
+
+from .seed import seed
+from .seed import username
+
+logger = logging.getLogger(__name__)
+
+SQLITE_INDEX_PATTERN = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+SQLITE_SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+AUDITED_TABLES = tuple(INDEX_PROFILES['full']) + ('yo_actions', )
+
+
+def workload(history_user, users):
+    """The query shapes to replay, as (step name, function of the db)"""
+    cursor = min_nid(datetime.datetime.utcnow())
+    since = (datetime.datetime.now() - datetime.timedelta(hours=1)).isoformat()
+    return [
+        ('api.get_notifications',
+         lambda db: db.get_notifications(to_username=history_user)),
+        ('api.get_notifications.notify_types',
+         lambda db: db.get_notifications(
+             to_username=history_user, notify_types=['vote', 'follow'])),
+        ('api.get_notifications.page',
+         lambda db: db.get_notifications(
+             to_username=history_user, before_id=cursor)),
+        ('api.get_notifications.updated_after',
+         lambda db: db.get_notifications(
+             to_username=history_user, updated_after=since)),
+        ('api.get_wwwpoll_notifications',
+         lambda db: db.get_wwwpoll_notifications(to_username=history_user)),
+        ('api.get_wwwpoll_notifications.notify_types',
+         lambda db: db.get_wwwpoll_notifications(
+             to_username=history_user, notify_types=['vote'])),
+        ('api.get_wwwpoll_notifications.read',
+         lambda db: db.get_wwwpoll_notifications(
+             to_username=history_user, read=True)),
+        ('api.get_user_transports',
+         lambda db: db.get_user_transports(username(1))),
+        ('follower.create_notification',
+         lambda db: db.create_notification(
+             notify_type='vote',
+             to_username=username(users - 1),
+             from_username=username(0),
+             json_data='{}',
+             trx_id='audit')),
+        ('follower.get_aggregate_notification',
+         lambda db: db.get_aggregate_notification(
+             to_username=history_user,
+             notify_type='vote',
+             group_key='bench-post-1',
+             created_after=datetime.datetime.utcnow())),
+        ('sender.get_wwwpoll_unsents', lambda db: db.get_wwwpoll_unsents()),
+        ('sender.get_priority_count',
+         lambda db: db.get_priority_count(history_user, 3, 3600)),
+        ('api.wwwpoll_mark_read', lambda db: db.wwwpoll_mark_read(cursor)),
+    ]
+
+
+def plan_usage(dialect, plan, known_indexes):
+    """Returns (indexes used, tables scanned) from EXPLAIN output rows"""
+    used, scanned = set(), set()
+    for row in plan or []:
+        if dialect == 'sqlite':
+            detail = str(row[-1])
+            used.update(SQLITE_INDEX_PATTERN.findall(detail))
+            match = SQLITE_SCAN_PATTERN.match(detail)
+            if match and 'INDEX' not in detail:
+                scanned.add(match.group(1))
+        else:
+            text = ' '.join(str(cell) for cell in row)
+            used.update(name for name in known_indexes if name in text)
+            if 'ALL' in [str(cell) for cell in row]:
+                scanned.update(t for t in AUDITED_TABLES if t in text)
+    return used, scanned
+
+
+def audit(db_url='sqlite://', profile='full', notifications=10000, users=1000,
+          history_depth=1000, seed_value=42):
+    """ Runs the workload against a fresh database with the profile
+
+    Returns:
+        dict: the report, see the module docstring
+    """
+    apply_index_profile(profile)
+    db = YoDatabase(db_url, capture_explain=True)
+    metadata.drop_all(bind=db.engine)
+    metadata.create_all(bind=db.engine)
+    history_user = username(0)
+    seed(db, notifications=notifications, users=users,
+         history_user=history_user, history_depth=history_depth,
+         sent_fraction=0.9, seed_value=seed_value)
+    if db.backend == 'sqlite':
+        with db.acquire_conn() as conn:
+            conn.execute('ANALYZE')
+
+    inspector = sa.inspect(db.engine)
+    known_indexes = {
+        index['name']
+        for table in AUDITED_TABLES for index in inspector.get_indexes(table)
+    }
+    report = {
+        'profile': profile,
+        'steps': {},
+        'indexes': {name: [] for name in sorted(known_indexes)},
+    }
+    for step, func in workload(history_user, users):
+        db.profiler.reset()
+        func(db)
+        used, scanned = set(), set()
+        for entry in db.profiler.explain(top=len(db.profiler.stats)):
+            entry_used, entry_scanned = plan_usage(
+                db.engine.dialect.name, entry.get('plan'), known_indexes)
+            used |= entry_used
+            scanned |= entry_scanned
+        report['steps'][step] = {
+            'indexes': sorted(used),
+            'scans': sorted(scanned)
+        }
+        for name in used:
+            report['indexes'].setdefault(name, []).append(step)
+    report['unused'] = sorted(
+        name for name, steps in report['indexes'].items()
+        if not steps and name in known_indexes)
+    return report
+
+
+def print_report(report, out=sys.stdout):
+    out.write('Index profile: %s\n\n' % report['profile'])
+    for step, usage in report['steps'].items():
+        out.write('%-45s %s%s\n' % (step, ', '.join(usage['indexes']) or '-',
+                                    ' (scans %s)' % ', '.join(usage['scans'])
+                                    if usage['scans'] else ''))
+    out.write('\nUnused indexes:\n')
+    for name in report['unused']:
+        out.write('  %s\n' % name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reports which indexes YoDatabase queries use')
+    parser.add_argument(
+        '--db-url',
+        type=str,
+        default='sqlite://',
+        help='database to audit in, it gets reset!')
+    parser.add_argument(
+        '--profile', type=str, default='full', choices=sorted(INDEX_PROFILES))
+    parser.add_argument('--notifications', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--history-depth', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, help='also write JSON here')
+    parser.add_argument('--yo-log-level', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.yo_log_level)
+    logging.getLogger('yo').setLevel(args.yo_log_level)
+
+    report = audit(
+        db_url=args.db_url,
+        profile=args.profile,
+        notifications=args.notifications,
+        users=args.users,
+        history_depth=args.history_depth,
+        seed_value=args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
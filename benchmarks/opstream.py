@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+""" Synthetic steem op stream with a realistic traffic mix
+
+    OpStream generates blocks of ops in the same shape get_ops_in_block
+    returns them: votes dominate, comments have realistic body lengths and
+    @mentions, and a handful of whale accounts receive a large share of the
+    votes (thousands per block at high rates). Every block is derived from
+    (seed, block_num) alone, so the same block always has the same ops no
+    matter in which order blocks are requested.
+
+    It can be used in-process in place of the follower's steemd client:
+
+        follower.steemd_rpc = OpStream(seed=1, ops_per_second=500)
+        await follower.run_active(chain=follower.steemd_rpc, ...)
+
+    or written to a file and replayed with FileOpSource:
+
+        python -m benchmarks.opstream --blocks 1000 --output ops.jsonl
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import math
+import random
+
+BLOCK_INTERVAL = 3  # seconds
+GENESIS_TIME = datetime.datetime(2016, 3, 24, 16, 0, 0)
+
+# relative weights of each kind of op, roughly what mainnet looks like
+DEFAULT_MIX = {
+    'vote': 70,
+    'comment': 3,
+    'reply': 9,
+    'transfer': 5,
+    'follow': 8,
+    'reblog': 3,
+    'account_update': 1,
+    'withdraw_vesting': 1,
+}
+
+WORDS = ('steem', 'post', 'great', 'photo', 'today', 'crypto', 'the', 'a',
+         'and', 'my', 'blockchain', 'community', 'thanks', 'for', 'sharing',
+         'upvoted', 'followed', 'travel', 'food', 'life', 'art', 'music')
+
+
+class OpStream:
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self,
+                 seed=0,
+                 ops_per_second=100,
+                 users=100000,
+                 user_prefix='synth',
+                 whales=10,
+                 whale_vote_share=0.3,
+                 mix=None,
+                 head_block=None,
+                 mentions_per_comment=0.3):
+        """ Deterministic generator of steem ops
+
+        Keyword args:
+            seed(int):                  blocks depend only on seed and number
+            ops_per_second(float):      average traffic rate
+            users(int):                 size of the account population
+            user_prefix(str):           accounts are named prefix + number
+            whales(int):                accounts that attract many votes
+            whale_vote_share(float):    fraction of votes going to whales
+            mix(dict):                  op kind -> relative weight, see
+                                        DEFAULT_MIX for the kinds
+            head_block(int):            what get_current_block_num returns
+            mentions_per_comment(float): average @mentions per comment
+        """
+        self.seed = seed
+        self.ops_per_second = ops_per_second
+        self.users = users
+        self.user_prefix = user_prefix
+        self.whales = whales
+        self.whale_vote_share = whale_vote_share
+        self.mix = dict(DEFAULT_MIX if mix is None else mix)
+        self.kinds = [k for k, v in self.mix.items() if v > 0]
+        self.weights = [self.mix[k] for k in self.kinds]
+        self.head_block = head_block
+        self.mentions_per_comment = mentions_per_comment
+
+    # steemd / Blockchain compatible bits the follower uses
+
+    def config(self):
+        return {'STEEMIT_BLOCK_INTERVAL': BLOCK_INTERVAL}
+
+    def get_current_block_num(self):
+        if self.head_block is not None:
+            return self.head_block
+        return int((datetime.datetime.utcnow() - GENESIS_TIME).total_seconds()
+                   // BLOCK_INTERVAL)
+
+    # pylint: disable=unused-argument
+    def get_ops_in_block(self, block_num, virtual_only=False):
+        return self.generate_block(block_num)
+
+    # pylint: enable=unused-argument
+
+    # generation
+
+    def username(self, rng):
+        return '%s%d' % (self.user_prefix, rng.randrange(self.users))
+
+    def whale(self, rng):
+        return 'whale%d' % rng.randrange(self.whales)
+
+    def block_time(self, block_num):
+        return GENESIS_TIME + datetime.timedelta(
+            seconds=block_num * BLOCK_INTERVAL)
+
+    def ops_in_block(self, rng):
+        """Poisson distributed op count around the configured rate"""
+        mean = self.ops_per_second * BLOCK_INTERVAL
+        if mean > 50:  # normal approximation for big blocks
+            return max(int(rng.gauss(mean, math.sqrt(mean))), 0)
+        limit, k, p = math.exp(-mean), 0, rng.random()
+        while p > limit:
+            k += 1
+            p *= rng.random()
+        return k
+
+    def generate_block(self, block_num):
+        rng = random.Random('%s:%d' % (self.seed, block_num))
+        timestamp = self.block_time(block_num).strftime('%Y-%m-%dT%H:%M:%S')
+        ops = []
+        for trx_in_block in range(self.ops_in_block(rng)):
+            kind = rng.choices(self.kinds, self.weights)[0]
+            op = getattr(self, 'make_%s' % kind)(rng)
+            trx_id = hashlib.sha1(('%s:%d:%d' % (
+                self.seed, block_num, trx_in_block)).encode()).hexdigest()
+            ops.append({
+                'trx_id': trx_id,
+                'block': block_num,
+                'trx_in_block': trx_in_block,
+                'op_in_trx': 0,
+                'virtual_op': 0,
+                'timestamp': timestamp,
+                'op': op
+            })
+        return ops
+
+    def permlink(self, rng):
+        return '-'.join(rng.choice(WORDS) for _ in range(4)) + \
+            '-%d' % rng.randrange(10 ** 6)
+
+    def body(self, rng):
+        """Log-normal body length, median ~600 chars, with some @mentions"""
+        length = min(int(rng.lognormvariate(6.4, 1.0)), 60000)
+        words = []
+        size = 0
+        while size < length:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        mentions = 0
+        while rng.random() < self.mentions_per_comment / (
+                1 + self.mentions_per_comment) and mentions < 10:
+            words.insert(rng.randrange(len(words) + 1), '@%s' %
+                         self.username(rng))
+            mentions += 1
+        return ' '.join(words) + '\n'
+
+    def make_vote(self, rng):
+        author = self.whale(rng) if rng.random() < self.whale_vote_share \
+            else self.username(rng)
+        return ['vote', {
+            'voter': self.username(rng),
+            'author': author,
+            'permlink': 'whale-post' if author.startswith('whale') else
+            self.permlink(rng),
+            'weight': rng.choice((10000, 10000, 5000, 2500, 100, -10000))
+        }]
+
+    def make_comment(self, rng, parent_author='', parent_permlink=None):
+        return ['comment', {
+            'parent_author': parent_author,
+            'parent_permlink': parent_permlink or rng.choice(WORDS),
+            'author': self.username(rng),
+            'permlink': self.permlink(rng),
+            'title': '' if parent_author else ' '.join(
+                rng.choice(WORDS) for _ in range(6)),
+            'body': self.body(rng),
+            'json_metadata': json.dumps({'tags': [rng.choice(WORDS)],
+                                         'app': 'steemit/0.1'})
+        }]
+
+    def make_reply(self, rng):
+        parent_author = self.whale(rng) if rng.random() < 0.2 \
+            else self.username(rng)
+        return self.make_comment(rng, parent_author, self.permlink(rng))
+
+    def make_transfer(self, rng):
+        return ['transfer', {
+            'from': self.username(rng),
+            'to': self.username(rng),
+            'amount': '%.3f %s' % (rng.lognormvariate(0, 2),
+                                   rng.choice(('STEEM', 'SBD'))),
+            'memo': rng.choice(('', 'thanks!', 'for the upvote',
+                                '#encrypted-memo'))
+        }]
+
+    def make_custom_json(self, rng, data):
+        account = data[1].get('follower') or data[1].get('account')
+        return ['custom_json', {
+            'required_auths': [],
+            'required_posting_auths': [account],
+            'id': 'follow',
+            'json': json.dumps(data)
+        }]
+
+    def make_follow(self, rng):
+        return self.make_custom_json(rng, ['follow', {
+            'follower': self.username(rng),
+            'following': self.username(rng),
+            'what': ['blog']
+        }])
+
+    def make_reblog(self, rng):
+        return self.make_custom_json(rng, ['reblog', {
+            'account': self.username(rng),
+            'author': self.username(rng),
+            'permlink': self.permlink(rng)
+        }])
+
+    def make_account_update(self, rng):
+        return ['account_update', {
+            'account': self.username(rng),
+            'memo_key': 'STM8S9siuc6wBQztU2qNSuftcZRew96mdpaJpVRWjbMHTvkMDLMH7',
+            'json_metadata': json.dumps({'profile': {'name': 'Synthetic'}})
+        }]
+
+    def make_withdraw_vesting(self, rng):
+        return ['withdraw_vesting', {
+            'account': self.username(rng),
+            'vesting_shares': '%.6f VESTS' % rng.lognormvariate(10, 2)
+        }]
+
+    async def stream_blocks(self, start_block, blocks=None, realtime=True):
+        """ Yields (block_num, ops), paced at one block per BLOCK_INTERVAL
+
+        Set realtime=False to generate as fast as possible
+        """
+        block_num = start_block
+        while blocks is None or block_num < start_block + blocks:
+            yield block_num, self.generate_block(block_num)
+            block_num += 1
+            if realtime:
+                await asyncio.sleep(BLOCK_INTERVAL)
+
+    def write(self, path, start_block, blocks):
+        """Writes blocks to path as JSON lines, one block per line"""
+        with open(path, 'w') as f:
+            for block_num in range(start_block, start_block + blocks):
+                f.write(json.dumps({
+                    'block': block_num,
+                    'ops': self.generate_block(block_num)
+                }) + '\n')
+
+
+class FileOpSource:
+    """Replays a file written by OpStream.write in place of steemd"""
+
+    def __init__(self, path):
+        self.blocks = {}
+        with open(path) as f:
+            for line in f:
+                block = json.loads(line)
+                self.blocks[block['block']] = block['ops']
+
+    def config(self):
+        return {'STEEMIT_BLOCK_INTERVAL': BLOCK_INTERVAL}
+
+    def get_current_block_num(self):
+        return max(self.blocks) if self.blocks else 0
+
+    # pylint: disable=unused-argument
+    def get_ops_in_block(self, block_num, virtual_only=False):
+        return self.blocks.get(block_num, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Writes a synthetic steem op stream as JSON lines')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-block', type=int, default=1)
+    parser.add_argument('--blocks', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=100,
+                        help='average ops per second')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--whales', type=int, default=10)
+    parser.add_argument('--whale-vote-share', type=float, default=0.3)
+    parser.add_argument('--output', type=str, required=True)
+    args = parser.parse_args()
+    OpStream(
+        seed=args.seed,
+        ops_per_second=args.rate,
+        users=args.users,
+        whales=args.whales,
+        whale_vote_share=args.whale_vote_share).write(
+            args.output, args.start_block, args.blocks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+""" Runs the benchmarks and stores/compares machine-readable baselines
+
+    Run against a fresh on-disk sqlite DB with the default scale:
+
+        python -m benchmarks.run --output bench.json
+
+    Or a local MySQL and a bigger history (the DB is reset first!):
+
+        python -m benchmarks.run --db-url mysql+pymysql://yo:yo@localhost/yo_bench \\
+            --notifications 10000000 --users 100000 --output bench.json
+
+    Compare a PR against main, exits non-zero on regressions:
+
+        python -m benchmarks.run --compare main.json pr.json --threshold 0.2
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from yo.db_utils import reset_db
+
+from .cases import CASES
+from .seed import seed
+
+logger = logging.getLogger(__name__)
+
+# lower is better for these, higher is better for ops_per_sec
+LATENCY_KEYS = ('p50', 'p95', 'p99')
+
+# tail percentiles are too noisy on a laptop to gate on by default
+DEFAULT_COMPARE_KEYS = ('p50', 'ops_per_sec')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    if args.db_url is None:
+        tmpdir = tempfile.mkdtemp(prefix='yo-bench-')
+        args.db_url = 'sqlite:///%s' % os.path.join(tmpdir, 'bench.db')
+    logger.info('Benchmarking against %s', args.db_url)
+    yo_db = reset_db(db_url=args.db_url)
+
+    start = time.perf_counter()
+    counts = seed(
+        yo_db,
+        notifications=args.notifications,
+        users=args.users,
+        history_user=args.history_user,
+        history_depth=args.history_depth,
+        sent_fraction=1.0 - args.unsent_fraction,
+        seed_value=args.seed)
+    seed_seconds = time.perf_counter() - start
+    logger.info('Seeded %s in %.1fs', counts, seed_seconds)
+
+    results = {}
+    for name in args.cases.split(','):
+        logger.info('Running %s benchmarks', name)
+        results.update(CASES[name](yo_db, args))
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'backend': yo_db.backend,
+            'python': platform.python_version(),
+            'notifications': args.notifications,
+            'users': args.users,
+            'history_depth': args.history_depth,
+            'unsent_fraction': args.unsent_fraction,
+            'ops': args.ops,
+            'seed': args.seed,
+            'seed_seconds': seed_seconds,
+            'rows': counts,
+        },
+        'results': results
+    }
+
+
+def compare(baseline, new, threshold, keys=DEFAULT_COMPARE_KEYS):
+    """ Compares two result files, returns a list of regressions
+
+    A regression is a latency percentile that grew, or a throughput that
+    dropped, by more than threshold (a fraction)
+    """
+    regressions = []
+    for name, new_result in sorted(new['results'].items()):
+        old_result = baseline['results'].get(name)
+        if old_result is None:
+            print('%-40s new' % name)
+            continue
+        for key in keys:
+            old, cur = old_result.get(key), new_result.get(key)
+            if not old or cur is None:
+                continue
+            change = (cur - old) / old
+            worse = change > threshold if key in LATENCY_KEYS \
+                else change < -threshold
+            print('%-40s %-12s %12.6g -> %12.6g %+7.1f%%%s' %
+                  (name, key, old, cur, change * 100,
+                   '  REGRESSION' if worse else ''))
+            if worse:
+                regressions.append((name, key, old, cur))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Yo benchmarks')
+    parser.add_argument(
+        '--db-url',
+        type=str,
+        default=None,
+        help='database to benchmark against, it is reset first! '
+        'defaults to a new on-disk sqlite DB')
+    parser.add_argument('--notifications', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--history-user', type=str, default='benchhistory')
+    parser.add_argument(
+        '--history-depth',
+        type=int,
+        default=1000,
+        help='notifications in the history of the user the API reads from')
+    parser.add_argument(
+        '--unsent-fraction',
+        type=float,
+        default=0.01,
+        help='fraction of the notifications left for run_send_notify')
+    parser.add_argument(
+        '--ops', type=int, default=500, help='calls per latency benchmark')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument(
+        '--cases',
+        type=str,
+        default='ratelimit,api,sender,follower',
+        help='comma separated, any of: %s' % ','.join(sorted(CASES)))
+    parser.add_argument(
+        '--standin-latency',
+        type=str,
+        default='lognormal:0.08:0.5',
+        help='latency of the SendGrid/Twilio stand-ins in the transports '
+        'case, see benchmarks.standins')
+    parser.add_argument(
+        '--standin-error-rate',
+        type=float,
+        default=0.0,
+        help='fraction of stand-in requests failing with a 500')
+    parser.add_argument(
+        '--standin-rate',
+        type=float,
+        default=0,
+        help='stand-in requests per second before 429s, 0 for no limit')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument(
+        '--yo-log-level',
+        type=str,
+        default='WARNING',
+        help='log level for the yo package while benchmarking')
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('BASELINE', 'NEW'),
+        help='compare two result files instead of running')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.2,
+        help='relative change counted as a regression when comparing')
+    parser.add_argument(
+        '--compare-keys',
+        type=str,
+        default=','.join(DEFAULT_COMPARE_KEYS),
+        help='comma separated, any of: %s,ops_per_sec' %
+        ','.join(LATENCY_KEYS))
+    args = parser.parse_args()
+    logging.getLogger('yo').setLevel(args.yo_log_level)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(baseline, new, args.threshold,
+                              args.compare_keys.split(','))
+        sys.exit(1 if regressions else 0)
+
+    results = run(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        logger.info('Results written to %s', args.output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
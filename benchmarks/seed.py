@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+""" Synthetic data for the benchmarks
+
+    Rows are generated deterministically from a seed and inserted in large
+    executemany batches, so 10^7 notifications can be loaded in reasonable
+    time even on sqlite.
+"""
+import datetime
+import json
+import logging
+import random
+
+from yo.db import Priority
+from yo.db import actions_table
+from yo.db import notifications_table
+from yo.db import user_settings_table
+from yo.db import wwwpoll_table
+from yo.ids import new_nid
+from yo.shards import username_hash
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+
+SEED_NOTIFY_TYPES = ('vote', 'vote', 'vote', 'vote', 'follow', 'mention',
+                     'comment_reply', 'post_reply', 'receive', 'resteem')
+
+
+def username(n):
+    return 'benchuser%d' % n
+
+
+def insert_batches(conn, table, rows):
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def generate_notifications(rng, count, users, start_time, history_user=None,
+                           history_depth=0):
+    """Yields notification rows spread over users, oldest first
+
+    history_user gets history_depth of the rows, so latency can be measured
+    against a known history depth
+    """
+    for n in range(count):
+        if n < history_depth:
+            to_username = history_user
+        else:
+            to_username = username(rng.randrange(users))
+        notify_type = rng.choice(SEED_NOTIFY_TYPES)
+        yield {
+            'nid': new_nid(start_time + datetime.timedelta(seconds=n),
+                           randomness=rng.getrandbits(80)),
+            'notify_type': notify_type,
+            'to_username': to_username,
+            'from_username': username(rng.randrange(users)),
+            'json_data': json.dumps({
+                'author': to_username,
+                'permlink': 'bench-post-%d' % rng.randrange(1000)
+            }),
+            'created': start_time + datetime.timedelta(seconds=n),
+            'updated': start_time + datetime.timedelta(seconds=n),
+            'priority_level': int(Priority.LOW),
+            'created_at': start_time + datetime.timedelta(seconds=n),
+            'trx_id': '%040x' % rng.getrandbits(160),
+            'to_username_hash': username_hash(to_username),
+        }
+
+
+def seed(yo_db, notifications=10000, users=1000, history_user=None,
+         history_depth=0, sent_fraction=1.0, seed_value=42):
+    """ Loads synthetic users, notifications, wwwpoll rows and actions
+
+    Keyword args:
+        notifications(int):    number of notifications to create
+        users(int):            number of users to spread them over
+        history_user(str):     user who gets the first history_depth rows
+        history_depth(int):    rows for history_user
+        sent_fraction(float):  fraction of notifications marked as sent, the
+                               rest are left for the sender, at ALWAYS
+                               priority so the recent sent history doesn't
+                               rate limit them
+        seed_value(int):       random seed, the same seed gives the same data
+
+    Returns:
+        dict: counts of the rows inserted per table
+    """
+    rng = random.Random(seed_value)
+    start_time = datetime.datetime.now() - datetime.timedelta(
+        seconds=notifications)
+    counts = {}
+    with yo_db.acquire_conn() as conn:
+        counts['yo_user_settings'] = insert_batches(
+            conn, user_settings_table, ({
+                'username': username(n),
+                'transports': json.dumps({
+                    'wwwpoll': {
+                        'notification_types': sorted(set(SEED_NOTIFY_TYPES)),
+                        'sub_data': {}
+                    }
+                })
+            } for n in range(users)))
+        logger.info('Seeded %d users', counts['yo_user_settings'])
+
+        sent_cutoff = int(notifications * sent_fraction)
+        rows = generate_notifications(rng, notifications, users, start_time,
+                                      history_user, history_depth)
+        counts['yo_notifications'] = counts['yo_wwwpoll'] = 0
+        counts['yo_actions'] = 0
+        batch = []
+        for n, row in enumerate(rows):
+            if n >= sent_cutoff:
+                # deliverable, so the sender benchmark times sends rather
+                # than rate limit denials
+                row['priority_level'] = int(Priority.ALWAYS)
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE or n == notifications - 1:
+                conn.execute(notifications_table.insert(), batch)
+                sent = batch[:max(sent_cutoff - (n + 1 - len(batch)), 0)]
+                if sent:
+                    conn.execute(wwwpoll_table.insert(), [{
+                        'nid': r['nid'],
+                        'notify_type': r['notify_type'],
+                        'to_username': r['to_username'],
+                        'from_username': r['from_username'],
+                        'json_data': r['json_data'],
+                        'created': r['created'],
+                        'updated': r['updated'],
+                        'read': False,
+                        'shown': False
+                    } for r in sent])
+                    conn.execute(actions_table.insert(), [{
+                        'nid': r['nid'],
+                        'to_username': r['to_username'],
+                        'transport': 'wwwpoll',
+                        'priority_level': r['priority_level'],
+                        'status': 'Sent',
+                        'created_at': r['created_at']
+                    } for r in sent])
+                counts['yo_notifications'] += len(batch)
+                counts['yo_wwwpoll'] += len(sent)
+                counts['yo_actions'] += len(sent)
+                batch = []
+                logger.info('Seeded %d/%d notifications',
+                            counts['yo_notifications'], notifications)
+    return counts
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+""" Local stand-ins for the SendGrid and Twilio APIs
+
+    They accept the same requests as SendGrid's v3 mail send and Twilio's
+    Messages endpoints and answer like them, after a latency drawn from a
+    configurable distribution. A configurable fraction of requests fail
+    with a 500, and a token bucket answers 429 once the request rate goes
+    over what the account would be allowed.
+
+    Point the transports at one with base_url in the [sendgrid] or [twilio]
+    section of yo.cfg:
+
+        python -m benchmarks.standins sendgrid --port 8025 \\
+            --latency lognormal:0.08:0.5 --error-rate 0.01 --rate 100
+
+    GET /stats returns what a stand-in has seen so far.
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import random
+import time
+from email.utils import formatdate
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+# recipients at this domain are rejected like invalid addresses
+INVALID_DOMAIN = 'invalid.example'
+
+
+def parse_latency(spec):
+    """ Returns a function drawing latencies in seconds from a spec
+
+    Specs are fixed:<s>, uniform:<low>:<high>, exponential:<mean> or
+    lognormal:<median>:<sigma>, e.g. lognormal:0.08:0.5
+    """
+    name, *params = spec.split(':')
+    params = [float(p) for p in params]
+    if name == 'fixed':
+        return lambda: params[0]
+    if name == 'uniform':
+        return lambda: random.uniform(params[0], params[1])
+    if name == 'exponential':
+        return lambda: random.expovariate(1 / params[0]) if params[0] else 0
+    if name == 'lognormal':
+        return lambda: params[0] * random.lognormvariate(0, params[1])
+    raise ValueError('Unknown latency distribution %s' % spec)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        """ Allows rate requests per second on average, burst at once
+
+        A rate of 0 allows everything
+        """
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self):
+        """ Takes a token
+
+        Returns:
+            float: 0 if there was one, otherwise seconds until there is
+        """
+        if not self.rate:
+            return 0
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class StandIn:
+    def __init__(self, latency='fixed:0', error_rate=0.0, rate=0, burst=None):
+        """ Behaviour shared by the stand-ins
+
+        Keyword args:
+            latency(str):       latency distribution, see parse_latency
+            error_rate(float):  fraction of requests answered with a 500
+            rate(float):        requests per second before 429s, 0 for none
+            burst(int):         requests allowed at once, rate by default
+        """
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(rate, burst)
+        self.stats = collections.Counter()
+
+    async def gate(self):
+        """ Waits out the latency, then returns an error response or None """
+        self.stats['requests'] += 1
+        await asyncio.sleep(self.latency())
+        retry_after = self.bucket.take()
+        if retry_after:
+            self.stats['throttled'] += 1
+            return self.throttled(retry_after)
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return self.error(500, 'Internal server error')
+        return None
+
+    def throttled(self, retry_after):
+        raise NotImplementedError
+
+    def error(self, status, message):
+        raise NotImplementedError
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/stats', self.handle_stats)
+        self.add_routes(app)
+        return app
+
+    def add_routes(self, app):
+        raise NotImplementedError
+
+
+class SendGridStandIn(StandIn):
+    """POST /v3/mail/send, 202 with no body once accepted"""
+
+    def add_routes(self, app):
+        app.router.add_post('/v3/mail/send', self.handle_send)
+
+    def throttled(self, retry_after):
+        return web.json_response(
+            {'errors': [{'message': 'too many requests'}]},
+            status=429,
+            headers={
+                'X-RateLimit-Remaining': '0',
+                'X-RateLimit-Reset': str(int(time.time() + retry_after) + 1)
+            })
+
+    def error(self, status, message):
+        return web.json_response(
+            {'errors': [{'message': message, 'field': None}]}, status=status)
+
+    def validate(self, body):
+        personalizations = body.get('personalizations') or []
+        if not 0 < len(personalizations) <= SENDGRID_MAX_PERSONALIZATIONS:
+            return 'personalizations must have 1 to %d items' % \
+                SENDGRID_MAX_PERSONALIZATIONS
+        if not (body.get('from') or {}).get('email'):
+            return 'from email is required'
+        if not body.get('content') and not body.get('template_id'):
+            return 'content or template_id is required'
+        for personalization in personalizations:
+            for to in personalization.get('to') or []:
+                if to.get('email', '').endswith('@' + INVALID_DOMAIN):
+                    return 'invalid email address %s' % to['email']
+        return None
+
+    async def handle_send(self, request):
+        response = await self.gate()
+        if response is not None:
+            return response
+        try:
+            body = await request.json()
+        except ValueError:
+            return self.error(400, 'invalid JSON')
+        problem = self.validate(body)
+        if problem:
+            self.stats['rejected'] += 1
+            return self.error(400, problem)
+        self.stats['accepted'] += 1
+        self.stats['emails'] += len(body['personalizations'])
+        return web.Response(status=202)
+
+
+class TwilioStandIn(StandIn):
+    """POST /2010-04-01/Accounts/{sid}/Messages.json, 201 with the message"""
+
+    def add_routes(self, app):
+        app.router.add_post('/2010-04-01/Accounts/{account_sid}/Messages.json',
+                            self.handle_message)
+
+    def throttled(self, retry_after):
+        return web.json_response(
+            {
+                'code': 20429,
+                'message': 'Too Many Requests',
+                'status': 429
+            },
+            status=429,
+            headers={'Retry-After': str(int(retry_after) + 1)})
+
+    def error(self, status, message):
+        return web.json_response(
+            {
+                'code': 20500,
+                'message': message,
+                'status': status
+            }, status=status)
+
+    async def handle_message(self, request):
+        response = await self.gate()
+        if response is not None:
+            return response
+        form = await request.post()
+        if not form.get('To') or not form.get('From') or not form.get('Body'):
+            self.stats['rejected'] += 1
+            return web.json_response(
+                {
+                    'code': 21604,
+                    'message': 'To, From and Body are required',
+                    'status': 400
+                },
+                status=400)
+        self.stats['accepted'] += 1
+        sid = 'SM%032x' % random.getrandbits(128)
+        now = formatdate(usegmt=True)
+        uri = '%s/%s.json' % (request.path[:-len('.json')], sid)
+        return web.json_response(
+            {
+                'sid': sid,
+                'account_sid': request.match_info['account_sid'],
+                'messaging_service_sid': None,
+                'to': form['To'],
+                'from': form['From'],
+                'body': form['Body'],
+                'status': 'queued',
+                'direction': 'outbound-api',
+                'api_version': '2010-04-01',
+                'date_created': now,
+                'date_updated': now,
+                'date_sent': None,
+                'num_segments': '1',
+                'num_media': '0',
+                'price': None,
+                'price_unit': 'USD',
+                'error_code': None,
+                'error_message': None,
+                'uri': uri,
+                'subresource_uris': {
+                    'media': uri[:-len('.json')] + '/Media.json'
+                }
+            },
+            status=201)
+
+
+STANDINS = {'sendgrid': SendGridStandIn, 'twilio': TwilioStandIn}
+
+
+async def start_standin(service, host='127.0.0.1', port=0, **options):
+    """ Starts a stand-in on the running loop
+
+    Returns:
+        (stand-in, runner, base url), runner.cleanup() stops it
+    """
+    standin = STANDINS[service](**options)
+    runner = web.AppRunner(standin.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return standin, runner, 'http://%s:%d' % (host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for SendGrid or Twilio')
+    parser.add_argument('service', choices=sorted(STANDINS))
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument(
+        '--latency',
+        type=str,
+        default='lognormal:0.08:0.5',
+        help='fixed:<s>, uniform:<low>:<high>, exponential:<mean> or '
+        'lognormal:<median>:<sigma>')
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='fraction of requests answered with a 500')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=0,
+        help='requests per second before answering 429, 0 for no limit')
+    parser.add_argument(
+        '--burst', type=int, default=None, help='requests allowed at once')
+    args = parser.parse_args()
+    standin = STANDINS[args.service](
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate=args.rate,
+        burst=args.burst)
+    logger.info('%s stand-in on http://%s:%d', args.service, args.host,
+                args.port)
+    web.run_app(standin.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
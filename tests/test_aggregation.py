@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+import uuid
+
+import pytest
+
+from yo import config
+from yo.services import blockchain_follower
+
+
+class MockApp:
+    def __init__(self, db, aggregate_window='600'):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+        self.config.config_data['blockchain_follower'][
+            'aggregate_window'] = aggregate_window
+
+
+def vote_op(voter, permlink='test-post', author='testauthor'):
+    return {
+        'trx_id': str(uuid.uuid4()),
+        'op': ('vote', {
+            'permlink': permlink,
+            'author': author,
+            'voter': voter,
+            'weight': 10000
+        })
+    }
+
+
+def stored_votes(db, username='testauthor'):
+    return [
+        json.loads(row['json_data'])
+        for row in db.get_notifications(to_username=username)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_votes_on_same_post_are_merged(sqlite_db):
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    for n in range(8):
+        await follower.notify(vote_op('voter%d' % n))
+    await follower.notify(vote_op('voter0', permlink='other-post'))
+
+    votes = sorted(stored_votes(sqlite_db), key=lambda v: v['permlink'])
+    assert len(votes) == 2
+    assert votes[0]['permlink'] == 'other-post'
+    assert votes[0]['count'] == 1
+    assert votes[1]['count'] == 8
+    assert votes[1]['senders'] == ['voter%d' % n for n in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_merge_updates_delivered_copy(sqlite_db):
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    await follower.notify(vote_op('alice'))
+    row = sqlite_db.get_notifications(to_username='testauthor')[0]
+    sqlite_db.create_wwwpoll_notification(
+        notify_id=row['nid'],
+        notify_type=row['notify_type'],
+        json_data=row['json_data'],
+        from_username=row['from_username'],
+        to_username=row['to_username'])
+
+    # a restarted follower finds the group in the database
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    await follower.notify(vote_op('bob'))
+
+    wwwpoll = sqlite_db.get_wwwpoll_notifications(to_username='testauthor')
+    assert len(wwwpoll) == 1
+    assert json.loads(wwwpoll[0]['json_data'])['senders'] == ['alice', 'bob']
+
+
+@pytest.mark.asyncio
+async def test_aggregation_disabled(sqlite_db):
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=MockApp(sqlite_db, aggregate_window='0'))
+    for n in range(3):
+        await follower.notify(vote_op('voter%d' % n))
+    assert len(stored_votes(sqlite_db)) == 3
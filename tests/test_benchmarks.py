@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import argparse
+
+from benchmarks.cases import bench_api_reads
+from benchmarks.cases import bench_send_notify
+from benchmarks.seed import seed
+
+
+def seeded(db):
+    seed(db, notifications=500, users=50, history_user='benchhistory',
+         history_depth=50, sent_fraction=0.9)
+    return argparse.Namespace(
+        ops=10, users=50, history_user='benchhistory', history_depth=50)
+
+
+def test_sender_case_delivers_the_unsent_rows(sqlite_db):
+    options = seeded(sqlite_db)
+    result = bench_send_notify(sqlite_db, options)['run_send_notify']
+    assert result['unsent'] == 50
+    assert result['sent'] == 50
+    assert result['ops_per_sec'] > 0
+
+
+def test_api_case_times_get_notifications(sqlite_db):
+    options = seeded(sqlite_db)
+    results = bench_api_reads(sqlite_db, options)
+    assert {
+        'get_notifications.depth_50', 'get_notifications.cached.depth_50',
+        'get_wwwpoll_notifications.depth_50', 'mark_read.depth_50'
+    } <= set(results)
+    assert sqlite_db.cache is None
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from yo.cache import RecentNotificationCache
+from yo.db import YoDatabase
+
+
+def add_notification(db, to_username, n):
+    db.create_notification(
+        notify_type='vote',
+        to_username=to_username,
+        from_username='someone',
+        json_data='{}',
+        trx_id='%s-%d' % (to_username, n))
+
+
+def cached_db(**kwargs):
+    cache = RecentNotificationCache(**kwargs)
+    return YoDatabase('sqlite://', notification_cache=cache), cache
+
+
+def test_newest_page_served_from_cache():
+    db, cache = cached_db(per_user=3)
+    for n in range(5):
+        add_notification(db, 'alice', n)
+
+    first = db.get_notifications(to_username='alice', limit=2)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(cache.users['alice'].rows) == 3
+    assert not cache.users['alice'].complete
+    assert db.get_notifications(to_username='alice', limit=2) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # more than the buffer holds, or other filters, go to the database
+    assert len(db.get_notifications(to_username='alice', limit=5)) == 5
+    db.get_notifications(to_username='alice', notify_types=['vote'])
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.bytes > 0
+
+
+def test_writes_update_and_invalidate_cache():
+    db, cache = cached_db(per_user=3)
+    add_notification(db, 'alice', 0)
+    assert len(db.get_notifications(to_username='alice', limit=3)) == 1
+    assert cache.users['alice'].complete
+
+    add_notification(db, 'alice', 1)
+    rows = db.get_notifications(to_username='alice', limit=3)
+    assert [row['trx_id'] for row in rows] == ['alice-1', 'alice-0']
+    assert cache.misses == 1
+
+    db.wwwpoll_mark_read(rows[0]['nid'])
+    assert 'alice' not in cache.users
+    assert cache.bytes == 0
+
+
+def test_least_recently_used_users_are_evicted():
+    db, cache = cached_db(max_users=2)
+    for username in ('alice', 'bob', 'carol'):
+        add_notification(db, username, 0)
+    db.get_notifications(to_username='alice')
+    db.get_notifications(to_username='bob')
+    db.get_notifications(to_username='alice')
+    db.get_notifications(to_username='carol')
+    assert list(cache.users) == ['alice', 'carol']
+
+
+def test_stale_entries_are_reloaded():
+    db, cache = cached_db(max_age=0)
+    add_notification(db, 'alice', 0)
+    db.get_notifications(to_username='alice')
+    db.get_notifications(to_username='alice')
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_callers_get_copies():
+    db, cache = cached_db()
+    add_notification(db, 'alice', 0)
+    # the miss fills the cache from the rows it returns
+    db.get_notifications(to_username='alice')[0]['json_data'] = 'changed'
+    hit = db.get_notifications(to_username='alice')
+    assert cache.hits == 1
+    assert hit[0]['json_data'] == '{}'
+    hit[0]['json_data'] = 'changed'
+    assert db.get_notifications(to_username='alice')[0]['json_data'] == '{}'
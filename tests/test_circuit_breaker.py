@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from yo import config
+from yo.circuit_breaker import CLOSED
+from yo.circuit_breaker import HALF_OPEN
+from yo.circuit_breaker import OPEN
+from yo.circuit_breaker import AIMDLimiter
+from yo.circuit_breaker import CircuitBreaker
+from yo.db import Priority
+from yo.services import notification_sender
+from yo.transports.base_transport import BaseTransport
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_and_probes():
+    clock = Clock()
+    breaker = CircuitBreaker(
+        'mock', window=60, min_sends=4, error_rate=0.5, cooldown=30,
+        clock=clock)
+
+    breaker.record(1, 0, 0.1)
+    breaker.record(0, 1, 0.1)
+    assert breaker.state == CLOSED
+    # slow batches count as failed
+    breaker.record(2, 0, 11)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # one probe at a time
+    assert not breaker.allow()
+    breaker.record(0, 1, 0.1)
+    assert breaker.state == OPEN
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(1, 0, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_forgets_old_failures():
+    clock = Clock()
+    breaker = CircuitBreaker('mock', window=60, min_sends=2, clock=clock)
+    breaker.record(0, 1, 0.1)
+    clock.now += 61
+    breaker.record(1, 0, 0.1)
+    breaker.record(1, 0, 0.1)
+    assert breaker.state == CLOSED
+
+
+def test_aimd_limiter():
+    limiter = AIMDLimiter('mock', 8)
+    assert limiter.limit == 8
+    limiter.record(False)
+    limiter.record(False)
+    assert limiter.limit == 2
+    limiter.record(True)
+    assert limiter.limit == 3
+    for _ in range(10):
+        limiter.record(False)
+    assert limiter.limit == 1
+    for _ in range(10):
+        limiter.record(True)
+    assert limiter.limit == 8
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+
+class FlakyTransport(BaseTransport):
+    def __init__(self):
+        self.down = True
+        self.sent = []
+
+    def send_notification(self, **kwargs):
+        if self.down:
+            raise ConnectionError('provider is down')
+        self.sent.append(kwargs)
+
+
+def add_follow(db, n):
+    db.create_notification(
+        notify_type='follow',
+        to_username='testuser',
+        from_username='follower%d' % n,
+        json_data=json.dumps({'follower': 'follower%d' % n}),
+        priority_level=int(Priority.ALWAYS),
+        trx_id='follow-%d' % n)
+
+
+@pytest.mark.asyncio
+async def test_sender_defers_while_circuit_is_open(sqlite_db):
+    sqlite_db.create_user('testuser', {
+        'mock': {
+            'notification_types': ['follow'],
+            'sub_data': 'mock-address'
+        }
+    })
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    transport = FlakyTransport()
+    sender.configured_transports = {'mock': transport}
+    sender.breaker_settings['min_sends'] = 2
+    breaker, limiter = sender.guard('mock')
+    clock = Clock()
+    breaker.clock = clock
+
+    add_follow(sqlite_db, 0)
+    add_follow(sqlite_db, 1)
+    await sender.run_send_notify()
+    assert breaker.state == OPEN
+    assert limiter.limit == 1
+    # failed sends are left unsent
+    assert len(sqlite_db.get_wwwpoll_unsents()['testuser']) == 2
+
+    add_follow(sqlite_db, 2)
+    await sender.run_send_notify()
+    assert sqlite_db.get_wwwpoll_unsents() == {}
+    assert len(sqlite_db.get_deferred_notifications('mock')) == 3
+
+    # still in the cooldown
+    transport.down = False
+    await sender.run_send_notify()
+    assert transport.sent == []
+
+    clock.now += breaker.cooldown
+    await sender.run_send_notify()
+    assert breaker.state == CLOSED
+    assert [item['data']['follower'] for item in transport.sent] == \
+        ['follower0', 'follower1', 'follower2']
+    assert sqlite_db.get_deferred_notifications('mock') == []
+    assert sqlite_db.get_priority_count('testuser', int(Priority.ALWAYS),
+                                        3600) == 3
@@ -52,3 +52,22 @@ def test_file_missing():
 def test_nofile():
     """Test using config manager without yo.cfg"""
     yo_config = config.YoConfigManager(None)
+
+
+def test_service_enabled():
+    """Test services are enabled by default and can be switched off"""
+    yo_config = config.YoConfigManager(
+        None, defaults={'blockchain_follower': {
+            'enabled': '0'
+        }})
+    assert yo_config.service_enabled('api_server')
+    assert yo_config.service_enabled('notification_sender')
+    assert not yo_config.service_enabled('blockchain_follower')
+
+
+def test_vapid_generated_lazily():
+    """Test VAPID keys are only generated when first needed"""
+    yo_config = config.YoConfigManager(None)
+    assert yo_config._vapid is None
+    assert yo_config.vapid is not None
+    assert yo_config.vapid is yo_config.vapid
@@ -338,3 +338,36 @@ def test_set_user_transports(sqlite_db):
 
     assert yo_db.get_user_transports(username='testuser')
 
+
+
+def test_deliver_wwwpoll(sqlite_db):
+    yo_db = sqlite_db
+    for n in range(3):
+        yo_db.create_notification(
+            notify_type='vote',
+            to_username='testuser%d' % n,
+            from_username=None if n == 0 else 'voter',
+            json_data=json.dumps({'n': n}),
+            priority_level=3,
+            trx_id='trx-%d' % n)
+    unsents = yo_db.get_wwwpoll_unsents()
+    nids = [n['nid'] for notifications in unsents.values()
+            for n in notifications]
+    assert len(nids) == 3
+
+    # one was delivered one by one before
+    yo_db.create_wwwpoll_notification(
+        notify_id=nids[1],
+        notify_type='vote',
+        from_username='voter',
+        to_username='testuser1',
+        json_data=json.dumps({'n': 1}))
+    assert yo_db.deliver_wwwpoll(nids) is True
+
+    assert yo_db.get_wwwpoll_unsents() == {}
+    result = yo_db.get_wwwpoll_notifications(to_username='testuser0')[0]
+    assert result['nid'] == nids[0]
+    assert result['from_username'] == ''
+    assert json.loads(result['json_data']) == {'n': 0}
+    assert result['read'] is False
+    assert yo_db.get_priority_count('testuser2', 3, 60) == 1
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from yo import config
+from yo.db import Priority
+from yo.email_templates import EmailRenderer
+from yo.services import notification_sender
+from yo.transports.base_transport import BaseTransport
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+
+class MockTransport(BaseTransport):
+    def __init__(self):
+        self.sent = []
+
+    def send_notification(self, **kwargs):
+        self.sent.append(kwargs)
+
+
+def add_vote(db, n):
+    db.create_notification(
+        notify_type='vote',
+        to_username='testauthor',
+        from_username='voter%d' % n,
+        json_data=json.dumps({
+            'author': 'testauthor',
+            'permlink': 'post-%d' % n,
+            'voter': 'voter%d' % n,
+            'weight': 10000
+        }),
+        priority_level=int(Priority.LOW),
+        trx_id='vote-%d' % n)
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_emails_go_to_digest(sqlite_db):
+    sqlite_db.create_user('testauthor', {
+        'email': {
+            'notification_types': ['vote'],
+            'sub_data': 'author@example.com'
+        }
+    })
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    email = MockTransport()
+    sender.configured_transports = {'email': email}
+
+    for n in range(3):
+        add_vote(sqlite_db, n)
+    await sender.run_send_notify()
+
+    # LOW allows one email an hour, the others are queued
+    assert len(email.sent) == 1
+    assert sqlite_db.get_digest_users() == ['testauthor']
+    assert sqlite_db.get_wwwpoll_unsents() == {}
+
+    digests = sender.digests
+    assert await digests.run_slice(digests.slice_of('testauthor')) == 1
+    digest = email.sent[-1]
+    assert digest['notify_type'] == 'digest'
+    assert digest['to_subdata'] == 'author@example.com'
+    assert digest['data']['count'] == 2
+    assert [item['data']['voter'] for item in digest['data']
+            ['notifications']] == ['voter1', 'voter2']
+    assert sqlite_db.get_digest_users() == []
+
+    rendered = EmailRenderer('mail_templates').render('digest',
+                                                      digest['data'])
+    assert rendered['subject'] == 'You have 2 new notifications on steemit'
+    assert 'voter2 upvoted https://steemit.com/@testauthor/post-2' in \
+        rendered['text']
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+
+import pytest
+
+from yo import config
+from yo.db import chain_status_table
+from yo.metrics import FOLLOWER_FAILOVER_SECONDS
+from yo.services import blockchain_follower
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+
+def make_follower(db, lock_timeout=0.3):
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=db, yo_app=MockApp(db))
+    follower.lock_timeout = lock_timeout
+    return follower
+
+
+def failovers():
+    sample = FOLLOWER_FAILOVER_SECONDS.values.get(())
+    return sum(sample[:-1]) if sample else 0
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_a_released_lock(sqlite_db):
+    first = make_follower(sqlite_db)
+    second = make_follower(sqlite_db)
+    seen = failovers()
+
+    assert first.try_lead(start_block=100)
+    assert first.fencing_token == 1
+    assert sqlite_db.get_chain_status()['last_processed_block'] == 99
+    assert not second.try_lead(start_block=100)
+
+    first.step_down(release=True)
+    assert second.try_lead(start_block=100)
+    assert second.fencing_token == 2
+    assert failovers() == seen + 1
+
+    # writes under the old token are fenced off
+    sqlite_db.try_update_status(
+        follower_id=first.follower_id,
+        last_processed_block=120,
+        lock_timeout=1,
+        fencing_token=1)
+    assert sqlite_db.get_chain_status()['last_processed_block'] == 99
+    assert not sqlite_db.renew_follower_lock(
+        follower_id=first.follower_id, fencing_token=1)
+    second.step_down(release=True)
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_keeps_and_loses_the_lock(sqlite_db):
+    first = make_follower(sqlite_db)
+    second = make_follower(sqlite_db)
+    assert first.try_lead(start_block=100)
+
+    # renewed by the heartbeat alone, with no blocks processed
+    await asyncio.sleep(0.5)
+    assert not second.try_lead()
+    assert first.fencing_token == 1
+
+    # e.g. the first was paused, its lock lapsed and the second took over
+    with sqlite_db.acquire_conn() as conn:
+        conn.execute(chain_status_table.update().values(
+            lock_expires=datetime.datetime(1970, 1, 1)))
+    assert second.try_lead()
+    await asyncio.sleep(0.2)
+    assert first.fencing_token is None
+    assert first.heartbeat_task is None
+    assert second.fencing_token == 2
+    second.step_down(release=True)
+
+
+@pytest.mark.asyncio
+async def test_notification_writes_are_fenced(sqlite_db):
+    first = make_follower(sqlite_db)
+    second = make_follower(sqlite_db)
+    assert first.try_lead(start_block=100)
+    stale = first.fence
+    assert sqlite_db.create_notification(
+        fence=stale,
+        notify_type='follow',
+        to_username='testuser',
+        from_username='first',
+        json_data='{}',
+        trx_id='fenced-1')
+
+    # another follower took over before the first noticed
+    first.heartbeat_task.cancel()
+    with sqlite_db.acquire_conn() as conn:
+        conn.execute(chain_status_table.update().values(
+            lock_expires=datetime.datetime(1970, 1, 1)))
+    assert second.try_lead()
+    assert not sqlite_db.create_notification(
+        fence=stale,
+        notify_type='follow',
+        to_username='testuser',
+        from_username='second',
+        json_data='{}',
+        trx_id='fenced-2')
+    nid = sqlite_db.get_notifications(to_username='testuser')[0]['nid']
+    assert not sqlite_db.update_aggregate_notification(
+        nid, '{"stale": true}', fence=stale)
+    assert sqlite_db.update_aggregate_notification(
+        nid, '{"fresh": true}', fence=second.fence)
+    notifications = sqlite_db.get_notifications(to_username='testuser')
+    assert [n['from_username'] for n in notifications] == ['first']
+    second.step_down(release=True)
+
+
+@pytest.mark.asyncio
+async def test_standby_notices_a_release_before_expiry(sqlite_db):
+    first = make_follower(sqlite_db, lock_timeout=30)
+    second = make_follower(sqlite_db, lock_timeout=0.3)
+    assert first.try_lead(start_block=100)
+    assert not second.try_lead()
+
+    waiting = asyncio.ensure_future(second.wait_for_lock())
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    first.step_down(release=True)
+    await asyncio.wait_for(waiting, 1)
+    assert second.try_lead()
+    second.step_down(release=True)
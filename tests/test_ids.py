@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import datetime
+import uuid
+
+import sqlalchemy as sa
+
+from yo import ids
+from yo.db import actions_table
+from yo.db import notifications_table
+from yo.db import wwwpoll_table
+from yo.db_utils import init_db
+from yo.db_utils import migrate_ids
+
+
+def test_nids_are_time_ordered():
+    now = datetime.datetime(2018, 1, 1, 12, 0, 0)
+    earlier = ids.new_nid(now)
+    later = ids.new_nid(now + datetime.timedelta(milliseconds=1))
+    assert len(earlier) == ids.ULID_LENGTH
+    assert earlier < later
+    assert ids.to_bytes(earlier) < ids.to_bytes(later)
+    assert ids.nid_time(later) == now + datetime.timedelta(milliseconds=1)
+    assert ids.min_nid(now) <= earlier < ids.min_nid(
+        now + datetime.timedelta(milliseconds=1))
+
+
+def test_nids_in_same_millisecond_stay_ordered():
+    now = datetime.datetime.utcnow()
+    nids = [ids.new_nid(now) for _ in range(100)]
+    assert nids == sorted(nids)
+    assert len(set(nids)) == 100
+
+
+def test_binary_roundtrip():
+    nid = ids.new_nid()
+    assert len(ids.to_bytes(nid)) == ids.BINARY_LENGTH
+    assert ids.from_bytes(ids.to_bytes(nid)) == nid
+
+
+def test_pagination_by_nid(sqlite_db):
+    start = datetime.datetime(2018, 1, 1)
+    for n in range(5):
+        sqlite_db.create_notification(
+            nid=ids.new_nid(start + datetime.timedelta(seconds=n)),
+            notify_type='vote',
+            to_username='pageduser',
+            json_data='{}')
+    first = sqlite_db.get_notifications(to_username='pageduser', limit=3)
+    second = sqlite_db.get_notifications(
+        to_username='pageduser', limit=3, before_id=first[-1]['nid'])
+    nids = [row['nid'] for row in first] + [row['nid'] for row in second]
+    assert len(second) == 2
+    assert nids == sorted(nids, reverse=True)
+
+
+def test_migrate_legacy_ids(tmpdir):
+    db_url = 'sqlite:///%s' % tmpdir.join('legacy.db')
+    db = init_db(db_url=db_url, reset=True)
+    created = datetime.datetime(2018, 1, 1)
+    legacy = [str(uuid.uuid4()) for _ in range(3)]
+    with db.acquire_conn() as conn:
+        for n, nid in enumerate(legacy):
+            row = dict(
+                nid=nid,
+                notify_type='vote',
+                to_username='olduser',
+                from_username='voter',
+                json_data='{}',
+                created=created + datetime.timedelta(seconds=n),
+                updated=created)
+            conn.execute(notifications_table.insert(), **row)
+            conn.execute(wwwpoll_table.insert(), **row)
+            conn.execute(actions_table.insert(), nid=nid,
+                         to_username='olduser', status='Sent')
+
+    assert migrate_ids(db_url=db_url, batch_size=2) == 3
+    nids = [row['nid'] for row in db.get_notifications(to_username='olduser')]
+    assert all(ids.is_ulid(nid) for nid in nids)
+    assert [ids.nid_time(nid) for nid in reversed(nids)] == [
+        created + datetime.timedelta(seconds=n) for n in range(3)
+    ]
+    with db.acquire_conn() as conn:
+        assert {row['nid'] for row in conn.execute(
+            sa.select([wwwpoll_table.c.nid]))} == set(nids)
+        assert {row['nid'] for row in conn.execute(
+            sa.select([actions_table.c.nid]))} == set(nids)
+
+    # to binary, then the same rows read back through binary storage
+    assert migrate_ids(db_url=db_url, binary=True) == 3
+    try:
+        ids.use_binary_storage(True)
+        binary_nids = [row['nid'] for row in
+                       db.get_notifications(to_username='olduser')]
+        assert binary_nids == nids
+        assert db.get_notifications(nid=nids[0])[0]['nid'] == nids[0]
+    finally:
+        ids.use_binary_storage(False)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import sqlalchemy as sa
+
+from benchmarks.index_audit import audit
+from yo.db import apply_index_profile
+from yo.db import notifications_table
+from yo.db_utils import init_db
+from yo.db_utils import sync_columns
+from yo.db_utils import sync_indexes
+
+
+def index_names(db, table='yo_notifications'):
+    return {i['name'] for i in sa.inspect(db.engine).get_indexes(table)}
+
+
+def test_sync_indexes(tmpdir):
+    db_url = 'sqlite:///%s' % tmpdir.join('indexes.db')
+    try:
+        db = init_db(db_url=db_url, reset=True)
+        assert 'ix_yo_notifications_trx_id' in index_names(db)
+
+        changes = sync_indexes(db_url=db_url, profile='query')
+        assert 'ix_yo_notifications_to_username_nid' in changes['created']
+        assert not changes['dropped']
+
+        changes = sync_indexes(db_url=db_url, profile='ingest', drop=True)
+        assert 'ix_yo_notifications_trx_id' in changes['dropped']
+        assert 'yo_notification_group_idx' not in changes['dropped']
+        assert index_names(db) == {
+            'yo_notification_group_idx', 'yo_notification_hash_idx'
+        }
+        # the dropped indexes don't linger in the metadata
+        assert {i.name for i in notifications_table.indexes} == \
+            {'yo_notification_group_idx', 'yo_notification_hash_idx'}
+    finally:
+        apply_index_profile('full')
+
+
+def test_audit_reports_index_usage():
+    try:
+        report = audit(profile='query', notifications=500, users=50,
+                       history_depth=100)
+    finally:
+        apply_index_profile('full')
+    assert 'ix_yo_notifications_to_username_nid' in \
+        report['steps']['api.get_notifications']['indexes']
+    assert report['steps']['follower.get_aggregate_notification'][
+        'indexes'] == ['yo_notification_group_idx']
+    assert 'ix_yo_actions_status' in report['unused']
+
+
+def test_sync_columns_upgrades_an_old_schema(tmpdir):
+    db_url = 'sqlite:///%s' % tmpdir.join('columns.db')
+    db = init_db(db_url=db_url, reset=True)
+    with db.acquire_conn() as conn:
+        conn.execute('DROP INDEX yo_notification_group_idx')
+        conn.execute('DROP INDEX yo_notification_hash_idx')
+        conn.execute('ALTER TABLE yo_notifications DROP COLUMN group_key')
+        conn.execute(
+            'ALTER TABLE yo_notifications DROP COLUMN to_username_hash')
+        conn.execute('ALTER TABLE yo_chain_status DROP COLUMN fencing_token')
+        conn.execute('INSERT INTO yo_chain_status (status_id) VALUES (1)')
+
+    added = sync_columns(db_url=db_url)
+    assert set(added) == {
+        'yo_notifications.group_key', 'yo_notifications.to_username_hash',
+        'yo_notifications.yo_notification_group_idx',
+        'yo_notifications.yo_notification_hash_idx',
+        'yo_chain_status.fencing_token'
+    }
+    assert {'yo_notification_group_idx', 'yo_notification_hash_idx'} <= \
+        index_names(db)
+    # the server default fills the existing row
+    assert db.get_chain_status()['fencing_token'] == 0
+    assert sync_columns(db_url=db_url) == []
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import json
+
+from yo import metrics
+from yo.db import Priority
+from yo.ratelimits import check_ratelimit
+
+
+def test_histogram_render():
+    registry = metrics.Registry()
+    histogram = registry.register(
+        metrics.Histogram(
+            'test_seconds', 'Test histogram', ('method', ),
+            buckets=(0.1, 1)))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.5, 'a')
+    histogram.observe(5, 'a')
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{method="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{method="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{method="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{method="a"} 5.55' in lines
+    assert 'test_seconds_count{method="a"} 3' in lines
+
+
+def test_counter_and_gauge_render():
+    registry = metrics.Registry()
+    counter = registry.register(
+        metrics.Counter('test_total', 'Test counter', ('status', )))
+    gauge = registry.register(metrics.Gauge('test_gauge', 'Test gauge'))
+    counter.inc('ok')
+    counter.inc('ok', amount=2)
+    gauge.set(42)
+
+    lines = registry.render().splitlines()
+    assert 'test_total{status="ok"} 3' in lines
+    assert 'test_gauge 42' in lines
+
+
+def test_db_methods_are_timed(sqlite_db):
+    before = metrics.DB_QUERY_SECONDS.count('create_notification')
+    sqlite_db.create_notification(
+        json_data=json.dumps({}),
+        to_username='testuser1337',
+        notify_type='vote',
+        trx_id='123abc')
+    assert metrics.DB_QUERY_SECONDS.count('create_notification') == before + 1
+
+
+def test_ratelimit_decisions_counted(sqlite_db):
+    before = metrics.RATELIMIT_DECISIONS.get('LOW', 'allowed')
+    assert check_ratelimit(sqlite_db, {
+        'to_username': 'testuser1337',
+        'priority_level': int(Priority.LOW)
+    })
+    assert metrics.RATELIMIT_DECISIONS.get('LOW', 'allowed') == before + 1
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import json
+from collections import Counter
+
+from benchmarks.opstream import FileOpSource
+from benchmarks.opstream import OpStream
+
+
+def test_blocks_are_deterministic():
+    stream = OpStream(seed=7, ops_per_second=50)
+    block = stream.get_ops_in_block(1000)
+    # generating other blocks first must not change the result
+    stream.get_ops_in_block(999)
+    assert OpStream(seed=7, ops_per_second=50).get_ops_in_block(1000) == block
+    assert OpStream(seed=8, ops_per_second=50).get_ops_in_block(1000) != block
+
+
+def test_op_shape():
+    for op in OpStream(seed=1, ops_per_second=20).get_ops_in_block(5):
+        assert op['block'] == 5
+        assert len(op['trx_id']) == 40
+        assert op['timestamp']
+        op_type, op_data = op['op']
+        assert isinstance(op_data, dict)
+        if op_type == 'custom_json':
+            assert json.loads(op_data['json'])[0] in ('follow', 'reblog')
+
+
+def test_traffic_mix():
+    stream = OpStream(seed=1, ops_per_second=1000, whales=2,
+                      whale_vote_share=0.5)
+    ops = stream.get_ops_in_block(1)
+    assert 2500 < len(ops) < 3500
+    types = Counter(op['op'][0] for op in ops)
+    assert types.most_common(1)[0][0] == 'vote'
+    whale_votes = Counter(op['op'][1]['author'] for op in ops
+                          if op['op'][0] == 'vote'
+                          and op['op'][1]['author'].startswith('whale'))
+    assert all(count > 400 for count in whale_votes.values())
+    bodies = [op['op'][1]['body'] for op in ops if op['op'][0] == 'comment']
+    assert any('@' in body for body in bodies)
+    assert sum(map(len, bodies)) / len(bodies) > 200
+
+
+def test_file_roundtrip(tmpdir):
+    path = str(tmpdir.join('ops.jsonl'))
+    stream = OpStream(seed=3, ops_per_second=10)
+    stream.write(path, 10, 5)
+    source = FileOpSource(path)
+    assert source.get_current_block_num() == 14
+    for block_num in range(10, 15):
+        assert source.get_ops_in_block(block_num) == \
+            stream.get_ops_in_block(block_num)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+
+from yo import payloads
+
+
+def test_excerpt():
+    assert payloads.excerpt('  short\n\n text ') == 'short text'
+    text = payloads.excerpt('word ' * 100)
+    assert len(text) <= payloads.EXCERPT_LENGTH
+    assert text.endswith('word…')
+    assert payloads.excerpt(None) == ''
+
+
+def test_reply_payload_is_compact():
+    op_data = {
+        'parent_author': 'parent',
+        'parent_permlink': 'parent-post',
+        'author': 'replier',
+        'permlink': 're-parent-post',
+        'title': '',
+        'body': 'lorem ipsum ' * 5000,
+        'json_metadata': json.dumps({'tags': ['test'] * 100})
+    }
+    payload = payloads.reply_payload(op_data)
+    assert set(payload) == {
+        'author', 'permlink', 'parent_author', 'parent_permlink', 'excerpt'
+    }
+    assert len(json.dumps(payload)) < 1024
+
+
+def test_account_update_payload():
+    payload = payloads.account_update_payload({
+        'account': 'testuser',
+        'memo_key': 'STM8S9siuc6wBQztU2qNSuftcZRew96mdpaJpVRWjbMHTvkMDLMH7',
+        'json_metadata': ''
+    })
+    assert payload == {'account': 'testuser', 'updated': ['memo_key']}
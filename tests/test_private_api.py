@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from yo import config
+from yo.app import YoApp
+from yo.private_api import PRIVATE_API_KEY_HEADER
+from yo.private_api import PRIVATE_API_PATH
+from yo.private_api import PrivateAPIClient
+
+
+class MockNode:
+    """Stands in for a remote Yo node's /private endpoint"""
+
+    def __init__(self, delay=0):
+        self.requests = []
+        self.delay = delay
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.requests.append((request.headers, payload))
+        await asyncio.sleep(self.delay)
+        return web.json_response([{
+            'jsonrpc': '2.0',
+            'id': call['id'],
+            'result': {
+                'method': call['method'],
+                'params': call['params']
+            }
+        } for call in payload])
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/private', self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url(''))
+
+
+@pytest.mark.asyncio
+async def test_calls_are_batched():
+    node = MockNode()
+    client = PrivateAPIClient(await node.start(), api_key='secret')
+    results = await asyncio.gather(*[
+        client.call('notification_sender', 'trigger_notifications', n=n)
+        for n in range(3)
+    ])
+    await client.close()
+    await node.server.close()
+
+    assert len(node.requests) == 1
+    headers, payload = node.requests[0]
+    assert headers[PRIVATE_API_KEY_HEADER] == 'secret'
+    assert len(payload) == 3
+    assert [r['params']['n'] for r in results] == [0, 1, 2]
+    assert results[0]['method'] == 'notification_sender.trigger_notifications'
+
+
+@pytest.mark.asyncio
+async def test_max_batch_size():
+    node = MockNode()
+    client = PrivateAPIClient(await node.start(), max_batch_size=2)
+    await asyncio.gather(
+        *[client.call('notification_sender', 'wake') for _ in range(5)])
+    await client.close()
+    await node.server.close()
+
+    assert [len(payload) for _, payload in node.requests] == [2, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_signals_are_coalesced():
+    node = MockNode()
+    client = PrivateAPIClient(await node.start(), coalesce_window=0.1)
+    for _ in range(20):
+        client.signal('notification_sender', 'wake')
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.3)
+    await client.close()
+    await node.server.close()
+
+    # one leading call plus one trailing call for the rest of the burst
+    calls = [call for _, payload in node.requests for call in payload]
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_timeout_returns_error():
+    node = MockNode(delay=1)
+    client = PrivateAPIClient(await node.start(), timeout=0.05)
+    result = await client.call('notification_sender', 'wake')
+    await client.close()
+    await node.server.close()
+
+    assert 'error' in result
+
+
+class MockService:
+    def __init__(self):
+        self.private_api_methods = {'echo': self.echo, 'fail': self.fail}
+
+    async def echo(self, **kwargs):
+        return kwargs
+
+    async def fail(self, **kwargs):
+        raise ValueError('broken')
+
+
+async def start_node(api_key):
+    yo_config = config.YoConfigManager(None)
+    yo_config.config_data['private_api'] = {'api_key': api_key}
+    app = YoApp(config=yo_config)
+    app.services['mock'] = MockService()
+    await app.setup_standard_api(app.web_app)
+    server = TestServer(app.web_app)
+    await server.start_server()
+    return server
+
+
+@pytest.mark.asyncio
+async def test_private_endpoint_needs_a_key():
+    server = await start_node('')
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+                server.make_url(PRIVATE_API_PATH), json={}) as response:
+            assert response.status in (404, 405)
+    await server.close()
+
+    server = await start_node('secret')
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+                server.make_url(PRIVATE_API_PATH),
+                json={},
+                headers={PRIVATE_API_KEY_HEADER: 'wrong'}) as response:
+            assert response.status == 403
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_call_does_not_fail_the_batch():
+    server = await start_node('secret')
+    client = PrivateAPIClient(str(server.make_url('')), api_key='secret')
+    results = await asyncio.gather(
+        client.call('mock', 'echo', n=1), client.call('mock', 'fail'))
+    await client.close()
+    await server.close()
+
+    assert results[0] == {'n': 1}
+    assert results[1]['error']['code'] == -32603
+
+
+@pytest.mark.asyncio
+async def test_debug_routes_need_the_key():
+    server = await start_node('')
+    async with aiohttp.ClientSession() as session:
+        for path in ('/debug/queries', '/debug/trace/nid'):
+            async with session.get(server.make_url(path)) as response:
+                assert response.status == 404
+    await server.close()
+
+    server = await start_node('secret')
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+                server.make_url('/debug/queries?explain=1')) as response:
+            assert response.status == 403
+        async with session.get(
+                server.make_url('/debug/queries?top=x'),
+                headers={PRIVATE_API_KEY_HEADER: 'secret'}) as response:
+            assert response.status == 400
+        async with session.get(
+                server.make_url('/debug/trace/nid'),
+                headers={PRIVATE_API_KEY_HEADER: 'wrong'}) as response:
+            assert response.status == 403
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_malformed_json_is_a_parse_error():
+    server = await start_node('secret')
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+                server.make_url(PRIVATE_API_PATH),
+                data='{"method": ',
+                headers={PRIVATE_API_KEY_HEADER: 'secret'}) as response:
+            assert response.status == 200
+            assert (await response.json())['error']['code'] == -32700
+    await server.close()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from yo.db_utils import init_db
+from yo.query_profiler import REDACTED
+
+
+def create_test_notification(yo_db):
+    return yo_db.create_notification(
+        json_data=json.dumps({'secret': 'value'}),
+        to_username='testuser1337',
+        from_username='testuser1336',
+        notify_type='vote',
+        trx_id='123abc')
+
+
+def test_stats_collected(sqlite_db):
+    sqlite_db.profiler.reset()
+    create_test_notification(sqlite_db)
+    sqlite_db.get_notifications(to_username='testuser1337')
+    sqlite_db.get_notifications(to_username='testuser1337')
+
+    stats = sqlite_db.profiler.get_stats()
+    selects = [s for s in stats if s['statement'].startswith('SELECT')]
+    inserts = [s for s in stats if s['statement'].startswith('INSERT')]
+    assert selects[0]['count'] == 2
+    assert selects[0]['rows'] >= 0
+    assert inserts[0]['count'] == 1
+    assert stats == sorted(
+        stats, key=lambda s: s['total_time'], reverse=True)
+
+
+def test_slow_query_log(caplog):
+    yo_db = init_db(db_url='sqlite://', reset=True)
+    yo_db.profiler.slow_query_threshold = 0
+    with caplog.at_level(logging.WARNING, logger='yo.query_profiler'):
+        create_test_notification(yo_db)
+    messages = [r.getMessage() for r in caplog.records]
+    slow_inserts = [m for m in messages if 'INSERT INTO yo_notifications' in m]
+    assert slow_inserts
+    assert 'YoDatabase.create_notification' in slow_inserts[0]
+    assert REDACTED in slow_inserts[0]
+    assert 'value' not in slow_inserts[0]
+
+
+def test_explain_top_statements():
+    yo_db = init_db(db_url='sqlite://', reset=True)
+    yo_db.profiler.capture_explain = True
+    yo_db.profiler.reset()
+    create_test_notification(yo_db)
+    yo_db.get_notifications(to_username='testuser1337')
+
+    explained = yo_db.profiler.explain(top=5)
+    selects = [e for e in explained if e['statement'].startswith('SELECT')]
+    assert selects
+    assert selects[0]['plan']
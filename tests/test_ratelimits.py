@@ -93,3 +93,49 @@ async def test_basic_ratelimit(sqlite_db):
 
     # check the ratelimit succeeds when override flag is set
     assert ratelimits.check_ratelimit(yo_db,vote_op, override=True)
+
+
+def test_load_policies():
+    policies, override_policies = ratelimits.load_policies(
+        {'low': '5/60', 'marketing_override': '1/10'})
+    assert policies[Priority.LOW] == (5, 60.0)
+    assert policies[Priority.NORMAL] == ratelimits.DEFAULT_POLICIES[
+        Priority.NORMAL]
+    assert override_policies[Priority.MARKETING] == (1, 10.0)
+
+
+def test_sliding_window_limiter():
+    limiter = ratelimits.SlidingWindowLimiter(
+        policies={Priority.LOW: (2, 60), Priority.NORMAL: (1, 60)},
+        override_policies={Priority.LOW: (3, 60), Priority.NORMAL: (1, 60)})
+    assert limiter.allowed('alice', Priority.LOW, now=1000)
+    limiter.record('alice', Priority.LOW, sent_at=1000)
+    # a higher priority send counts against the lower priority limits
+    limiter.record('alice', Priority.NORMAL, sent_at=1001)
+    assert not limiter.allowed('alice', Priority.LOW, now=1002)
+    assert limiter.allowed('alice', Priority.LOW, override=True, now=1002)
+    assert limiter.allowed('alice', Priority.LOW, now=1061)
+    assert limiter.allowed('bob', Priority.LOW, now=1002)
+
+    limiter.evict(now=2000)
+    assert len(limiter) == 0
+
+
+def test_limiter_warm_start(sqlite_db):
+    notification = {'nid': 'warm', 'to_username': 'alice',
+                    'priority_level': int(Priority.LOW)}
+    sqlite_db.mark_sent(notification, 'email')
+    limiter = ratelimits.SlidingWindowLimiter()
+    assert not limiter.check(sqlite_db, notification)
+    assert limiter.warm
+
+
+def test_limiters_share_sends_through_store(tmpdir):
+    path = str(tmpdir.join('ratelimits.db'))
+    first = ratelimits.SlidingWindowLimiter(
+        store=ratelimits.SQLiteRateStore(path, sync_interval=0))
+    second = ratelimits.SlidingWindowLimiter(
+        store=ratelimits.SQLiteRateStore(path, sync_interval=0))
+    first.record('alice', Priority.LOW)
+    assert not second.allowed('alice', Priority.LOW)
+    assert second.allowed('bob', Priority.LOW)
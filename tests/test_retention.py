@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import datetime
+import uuid
+
+import pytest
+
+from yo import config
+from yo.archive import ArchiveWriter
+from yo.archive import read_segment
+from yo.db import notifications_table
+from yo.ids import new_nid
+from yo.services.retention import YoRetention
+
+
+class MockApp:
+    def __init__(self, db, **settings):
+        self.db = db
+        self.config = config.YoConfigManager(
+            None, defaults={'retention': settings})
+
+
+def add_notification(db, notify_type, age_days, to_username='olduser'):
+    created = datetime.datetime.utcnow() - datetime.timedelta(days=age_days)
+    nid = new_nid(created)
+    db.create_notification(
+        nid=nid,
+        notify_type=notify_type,
+        to_username=to_username,
+        from_username='someone',
+        json_data='{}',
+        created=created,
+        trx_id=nid)
+    db.create_wwwpoll_notification(
+        notify_id=nid,
+        notify_type=notify_type,
+        to_username=to_username,
+        from_username='someone',
+        json_data='{}')
+    db.mark_sent(
+        {'nid': nid, 'to_username': to_username, 'priority_level': 2},
+        'wwwpoll')
+    return nid
+
+
+def test_archive_segments_rotate(tmpdir):
+    writer = ArchiveWriter(str(tmpdir), segment_bytes=1)
+    writer.write('yo_test', [{'n': 1}])
+    writer.write('yo_test', [{'n': 2}, {'n': 3}])
+    segments = writer.segments('yo_test')
+    assert len(segments) == 2
+    assert [r['n'] for s in segments for r in read_segment(s)] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_expired_rows_are_archived(sqlite_db, tmpdir):
+    old_vote = add_notification(sqlite_db, 'vote', age_days=40)
+    recent_vote = add_notification(sqlite_db, 'vote', age_days=1)
+    old_follow = add_notification(sqlite_db, 'follow', age_days=40)
+    retention = YoRetention(
+        db=sqlite_db,
+        yo_app=MockApp(
+            sqlite_db,
+            ttl_days_vote='30',
+            batch_size='1',
+            batch_pause='0',
+            archive_dir=str(tmpdir)))
+
+    totals = await retention.run_retention()
+
+    assert totals == {'yo_notifications': 1, 'yo_wwwpoll': 0}
+    remaining = {row['nid'] for row in sqlite_db.get_notifications(limit=10)}
+    assert remaining == {recent_vote, old_follow}
+    assert {row['nid'] for row in sqlite_db.get_wwwpoll_notifications(
+        limit=10)} == remaining
+    archived = {
+        table: [row['nid'] for s in retention.archive.segments(table)
+                for row in read_segment(s)]
+        for table in ('yo_notifications', 'yo_wwwpoll', 'yo_actions')
+    }
+    assert archived == {
+        'yo_notifications': [old_vote],
+        'yo_wwwpoll': [old_vote],
+        'yo_actions': [old_vote]
+    }
+
+
+@pytest.mark.asyncio
+async def test_no_expiry_while_legacy_nids_remain(sqlite_db, tmpdir):
+    now = datetime.datetime.now()
+    # uuid4 nids don't sort by time, this one sorts before any recent ULID
+    legacy = '00' + str(uuid.uuid4())[2:]
+    with sqlite_db.acquire_conn() as conn:
+        conn.execute(
+            notifications_table.insert(),
+            nid=legacy,
+            notify_type='vote',
+            to_username='olduser',
+            from_username='voter',
+            json_data='{}',
+            created=now,
+            updated=now)
+    old_vote = add_notification(sqlite_db, 'vote', age_days=40)
+    retention = YoRetention(
+        db=sqlite_db,
+        yo_app=MockApp(
+            sqlite_db,
+            ttl_days_vote='30',
+            batch_pause='0',
+            archive_dir=str(tmpdir)))
+
+    totals = await retention.run_retention()
+    assert 'yo_notifications' not in totals
+    remaining = {row['nid'] for row in sqlite_db.get_notifications(limit=10)}
+    assert remaining == {legacy, old_vote}
+
+    # once migrated the old one expires
+    with sqlite_db.acquire_conn() as conn:
+        conn.execute(notifications_table.delete().where(
+            notifications_table.c.nid == legacy))
+    assert sqlite_db.has_legacy_nids('yo_notifications') is False
+    totals = await retention.run_retention()
+    assert totals['yo_notifications'] == 1
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+
+from yo.archive import ArchiveWriter
+from yo.db import YoDatabase
+from yo.ids import new_nid
+from yo.segments import ArchiveReader
+from yo.segments import Segment
+from yo.segments import write_segment
+
+
+def make_row(to_username, age_days, notify_type='vote'):
+    created = datetime.datetime.utcnow() - datetime.timedelta(days=age_days)
+    return {
+        'nid': new_nid(created),
+        'notify_type': notify_type,
+        'to_username': to_username,
+        'from_username': 'someone',
+        'json_data': '{}',
+        'created': created,
+        'priority_level': 3,
+    }
+
+
+def test_segment_index_lookup(tmpdir):
+    rows = [make_row(name, age) for name in ('carol', 'alice', 'bob')
+            for age in (3, 1, 2)]
+    path = write_segment(
+        str(tmpdir.join('test.yoseg')),
+        [dict(row, created=row['created'].isoformat()) for row in rows])
+    segment = Segment(path)
+    try:
+        assert segment.user_count == 3
+        assert segment.row_count == 9
+        assert segment.find_user('dave') is None
+        alice = [nid for nid, _ in segment.user_rows('alice')]
+        assert alice == sorted(
+            (r['nid'] for r in rows if r['to_username'] == 'alice'),
+            reverse=True)
+        assert [nid for nid, _ in segment.user_rows(
+            'alice', before_id=alice[0])] == alice[1:]
+        _, row = next(segment.user_rows('bob'))
+        assert isinstance(row['created'], datetime.datetime)
+    finally:
+        segment.close()
+
+
+def test_reader_merges_segments(tmpdir):
+    writer = ArchiveWriter(str(tmpdir))
+    old = [make_row('alice', age, 'follow') for age in (10, 12)]
+    newer = [make_row('alice', age) for age in (5, 11)]
+    writer.write('yo_notifications', old)
+    writer.write('yo_notifications', newer)
+    reader = ArchiveReader(os.path.join(str(tmpdir), 'yo_notifications'))
+
+    expected = sorted((r['nid'] for r in old + newer), reverse=True)
+    assert [r['nid'] for r in reader.get_notifications('alice')] == expected
+    assert [r['nid'] for r in reader.get_notifications(
+        'alice', before_id=expected[0], limit=2)] == expected[1:3]
+    assert [r['nid'] for r in reader.get_notifications(
+        'alice', notify_types=['follow'])] == sorted(
+            (r['nid'] for r in old), reverse=True)
+
+    assert writer.compact('yo_notifications') == 2
+    assert len(writer.segments('yo_notifications')) == 1
+    assert [r['nid'] for r in reader.get_notifications('alice')] == expected
+
+
+def test_get_notifications_falls_through_to_archive(tmpdir):
+    archived = [make_row('alice', age) for age in (30, 31, 32)]
+    ArchiveWriter(str(tmpdir)).write('yo_notifications', archived)
+    db = YoDatabase('sqlite://', archive_dir=str(tmpdir))
+    hot = make_row('alice', 1)
+    db.create_notification(**dict(hot, trx_id='hot'))
+
+    nids = [r['nid'] for r in db.get_notifications(
+        to_username='alice', limit=3)]
+    assert nids == [hot['nid'], archived[0]['nid'], archived[1]['nid']]
+    assert [r['nid'] for r in db.get_notifications(
+        to_username='alice', before_id=nids[-1])] == [archived[2]['nid']]
+    # filters the archive can't answer only see the hot table
+    assert len(db.get_notifications(
+        to_username='alice', updated_after='2000-01-01')) <= 1
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import pytest
+
+from yo.transports import sendgrid
+
+
+class StandInSendGrid(BaseHTTPRequestHandler):
+    """Accepts mail sends unless a recipient is at invalid.example"""
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append(body)
+        recipients = [
+            to['email'] for p in body['personalizations'] for to in p['to']
+        ]
+        status = 400 if any(
+            r.endswith('@invalid.example') for r in recipients) else 202
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sendgrid_server():
+    StandInSendGrid.requests = []
+    server = HTTPServer(('127.0.0.1', 0), StandInSendGrid)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def vote(n, domain='example.com'):
+    return {
+        'to_subdata': 'user%d@%s' % (n, domain),
+        'to_username': 'user%d' % n,
+        'notify_type': 'vote',
+        'data': {
+            'author': 'user%d' % n,
+            'permlink': 'post-%d' % n,
+            'voter': 'voter'
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_send_batch_groups_by_type(sendgrid_server):
+    transport = sendgrid.SendGridTransport(
+        'key', 'mail_templates', base_url=sendgrid_server)
+    follow = {
+        'to_subdata': 'followed@example.com',
+        'to_username': 'followed',
+        'notify_type': 'follow',
+        'data': {'follower': 'a', 'following': 'followed'}
+    }
+
+    results = await transport.send_batch([vote(n) for n in range(5)] +
+                                         [follow])
+
+    assert results == [True] * 6
+    assert len(StandInSendGrid.requests) == 2
+    votes = max(StandInSendGrid.requests,
+                key=lambda r: len(r['personalizations']))
+    assert len(votes['personalizations']) == 5
+    assert votes['content'][0]['value'] == sendgrid.TEXT_TAG
+    first = votes['personalizations'][0]
+    assert first['to'] == [{'email': 'user0@example.com'}]
+    assert 'user0/post-0' in first['substitutions'][sendgrid.TEXT_TAG]
+
+
+@pytest.mark.asyncio
+async def test_rejected_recipients_are_split_out(sendgrid_server):
+    transport = sendgrid.SendGridTransport(
+        'key', 'mail_templates', base_url=sendgrid_server)
+    items = [vote(n) for n in range(8)]
+    items[5] = vote(5, domain='invalid.example')
+
+    results = await transport.send_batch(items)
+
+    assert results == [n != 5 for n in range(8)]
+    sent = [
+        p['to'][0]['email'] for r in StandInSendGrid.requests[1:]
+        for p in r['personalizations']
+    ]
+    assert sent.count('user0@example.com') == 1
+    with pytest.raises(RuntimeError):
+        await transport.send_notification(
+            **vote(9, domain='invalid.example'))
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import pytest
+
+from yo import config
+from yo.db import Priority
+from yo.services import notification_sender
+from yo.shards import ShardLeases
+from yo.shards import hash_range
+from yo.shards import shard_of
+from yo.shards import username_hash
+from yo.transports.base_transport import BaseTransport
+
+
+def test_shard_of_splits_the_hash_range():
+    usernames = ['user%d' % n for n in range(1000)]
+    counts = [0] * 4
+    for username in usernames:
+        shard = shard_of(username, 4)
+        assert shard == shard_of(username, 4)
+        counts[shard] += 1
+    assert all(150 < count < 350 for count in counts)
+    # a shard splits into neighbouring ranges when the count doubles
+    assert all(
+        shard_of(username, 8) // 2 == shard_of(username, 4)
+        for username in usernames)
+
+
+def test_workers_share_the_shards(sqlite_db):
+    first = ShardLeases(sqlite_db, 4, lease_timeout=0.5, worker_id='first')
+    assert first.refresh() == {0, 1, 2, 3}
+
+    second = ShardLeases(sqlite_db, 4, lease_timeout=0.5, worker_id='second')
+    assert second.refresh() == set()
+    # the first sees the second and gives up half
+    assert first.refresh() == {0, 1}
+    assert second.refresh() == {2, 3}
+    assert first.refresh() == {0, 1}
+
+    # the second dies, its shards are taken over once the leases lapse
+    time.sleep(0.6)
+    assert first.refresh() == {0, 1, 2, 3}
+
+    first.release()
+    assert second.refresh() == {0, 1, 2, 3}
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+        self.config.config_data['notification_sender']['shards'] = '2'
+
+
+class MockTransport(BaseTransport):
+    def __init__(self):
+        self.sent = []
+
+    def send_notification(self, **kwargs):
+        self.sent.append(kwargs['to_username'])
+
+
+@pytest.mark.asyncio
+async def test_sharded_senders_split_the_users(sqlite_db):
+    usernames = ['user%d' % n for n in range(20)]
+    for username in usernames:
+        sqlite_db.create_user(username, {
+            'mock': {
+                'notification_types': ['follow'],
+                'sub_data': ''
+            }
+        })
+        sqlite_db.create_notification(
+            notify_type='follow',
+            to_username=username,
+            from_username='follower',
+            json_data=json.dumps({'follower': 'follower'}),
+            priority_level=int(Priority.ALWAYS),
+            trx_id=username)
+    senders = []
+    for _ in range(2):
+        sender = notification_sender.YoNotificationSender(
+            db=sqlite_db, yo_app=MockApp(sqlite_db))
+        sender.configured_transports = {'mock': MockTransport()}
+        senders.append(sender)
+
+    await senders[0].run_send_notify()
+    # the first took both shards before the second was around
+    assert senders[0].shards.owned == {0, 1}
+    senders[1].shards.refresh()
+    senders[0].shards.refresh()
+    assert senders[0].shards.owned == {0}
+
+    for username in usernames:
+        sqlite_db.create_notification(
+            notify_type='follow',
+            to_username=username,
+            from_username='follower',
+            json_data=json.dumps({'follower': 'other'}),
+            priority_level=int(Priority.ALWAYS),
+            trx_id=username + '-2')
+    for sender in senders:
+        sender.configured_transports['mock'].sent = []
+        await sender.run_send_notify()
+    first, second = [
+        sender.configured_transports['mock'].sent for sender in senders
+    ]
+    assert sorted(first + second) == sorted(usernames)
+    assert all(shard_of(username, 2) == 0 for username in first)
+    assert all(shard_of(username, 2) == 1 for username in second)
+
+
+def test_hash_ranges_match_shard_of():
+    usernames = ['user%d' % n for n in range(1000)]
+    for shards in (1, 3, 4, 7):
+        ranges = [hash_range(shard, shards) for shard in range(shards)]
+        assert ranges[0][0] == 0 and ranges[-1][1] == 2**32
+        for username in usernames:
+            low, high = ranges[shard_of(username, shards)]
+            assert low <= username_hash(username) < high
+
+
+def test_unsents_are_filtered_by_shard(sqlite_db):
+    usernames = ['user%d' % n for n in range(20)]
+    for username in usernames:
+        sqlite_db.create_notification(
+            notify_type='follow',
+            to_username=username,
+            from_username='follower',
+            json_data='{}',
+            trx_id=username)
+    leases = ShardLeases(sqlite_db, 4)
+    leases.owned = {1, 3}
+    unsents = sqlite_db.get_wwwpoll_unsents(hash_ranges=leases.hash_ranges())
+    assert sorted(unsents) == sorted(
+        username for username in usernames if leases.owns(username))
+    assert sqlite_db.get_wwwpoll_unsents(hash_ranges=[]) == {}
+
+
+@pytest.mark.asyncio
+async def test_sender_drops_chunks_of_lost_shards(sqlite_db):
+    sqlite_db.create_user('user0', {
+        'mock': {
+            'notification_types': ['follow'],
+            'sub_data': ''
+        }
+    })
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    transport = MockTransport()
+    sender.configured_transports = {'mock': transport}
+    sender.shards.refresh()
+    assert sender.shards.owned == {0, 1}
+
+    # the leases lapsed mid-pass, e.g. a long send, and another worker took
+    # the shards
+    sqlite_db.release_sender_shards(
+        worker_id=sender.shards.worker_id, shard_ids=[0, 1])
+    sender.shards.renewed = None
+    item = {
+        'nid': 'nid',
+        'to_subdata': '',
+        'to_username': 'user0',
+        'notify_type': 'follow',
+        'data': {}
+    }
+    await sender.send_chunk('mock', [({'nid': 'nid'}, item)])
+    assert transport.sent == []
+    assert sender.shards.owned == set()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from benchmarks.cases import vote_item
+from benchmarks.standins import TokenBucket
+from benchmarks.standins import start_standin
+from yo.transports.sendgrid import SendGridTransport
+from yo.transports.twilio import TwilioTransport
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(2, burst=2, clock=lambda: now[0])
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.take() == 0
+
+
+@pytest.mark.asyncio
+async def test_twilio_standin_throttles():
+    standin, runner, base_url = await start_standin('twilio', rate=1, burst=2)
+    try:
+        transport = TwilioTransport(
+            'ACtest', 'token', '+15005550006', base_url=base_url)
+        results = await transport.send_batch(
+            [vote_item('twilio', n, 10) for n in range(3)])
+    finally:
+        await runner.cleanup()
+    assert sorted(results) == [False, True, True]
+    assert standin.stats['accepted'] == 2
+    assert standin.stats['throttled'] == 1
+
+
+@pytest.mark.asyncio
+async def test_sendgrid_standin_rejects_invalid_recipients():
+    standin, runner, base_url = await start_standin('sendgrid')
+    try:
+        transport = SendGridTransport(
+            'key', 'mail_templates', base_url=base_url)
+        items = [vote_item('sendgrid', n, 10) for n in range(4)]
+        items[2]['to_subdata'] = 'nobody@invalid.example'
+        results = await transport.send_batch(items)
+    finally:
+        await runner.cleanup()
+    assert results == [True, True, False, True]
+    assert standin.stats['emails'] == 3
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Startup time benchmark
+
+   Runs the service selection from yo.cli in a fresh interpreter for an
+   API-only node and checks that it stays fast and doesn't drag in the heavy
+   dependencies only used by the other services.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('jsonrpcserver')
+pytest.importorskip('uvloop')
+
+# modules that an API-only node should never import at startup
+HEAVY_MODULES = ('steem', 'sendgrid', 'twilio', 'premailer', 'jinja2',
+                 'py_vapid', 'yo.services.blockchain_follower',
+                 'yo.services.notification_sender')
+
+# generous default so slow CI boxes don't flap, tighten with the env var
+STARTUP_BUDGET = float(os.environ.get('YO_STARTUP_BUDGET', '3.0'))
+
+STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from yo import cli
+from yo.config import YoConfigManager
+
+yo_config = YoConfigManager(None, defaults={
+    'blockchain_follower': {'enabled': '0'},
+    'notification_sender': {'enabled': '0'}})
+services = [cli.load_service_class(name)
+            for name in cli.enabled_services(yo_config)]
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed,
+                  'services': [kls.service_name for kls in services],
+                  'modules': sorted(sys.modules.keys())}))
+'''
+
+source_code_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def run_startup():
+    output = subprocess.check_output(
+        [sys.executable, '-c', STARTUP_SCRIPT],
+        cwd=os.path.join(source_code_path, '..'))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_api_only_startup():
+    """API-only nodes load only the API server and start within budget"""
+    result = run_startup()
+    assert result['services'] == ['api_server']
+
+    loaded = set(result['modules'])
+    for module in HEAVY_MODULES:
+        assert module not in loaded, '%s imported at startup' % module
+
+    assert result['elapsed'] < STARTUP_BUDGET, \
+        'startup took %.3fs, budget is %.3fs' % (result['elapsed'],
+                                                   STARTUP_BUDGET)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+import pytest
+
+from yo import config
+from yo.metrics import FOLLOWER_DROPPED
+from yo.metrics import TRANSPORT_SENDS
+from yo.services import blockchain_follower
+from yo.services import notification_sender
+from yo.subscriptions import RoutingCache
+from yo.subscriptions import SubscriptionIndex
+from yo.transports import base_transport
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+
+def vote_op(author, voter='testvoter'):
+    return {
+        'trx_id': str(uuid.uuid4()),
+        'op': ('vote', {
+            'permlink': 'test-post',
+            'author': author,
+            'voter': voter,
+            'weight': 10000
+        })
+    }
+
+
+def test_index_defaults(sqlite_db):
+    index = SubscriptionIndex(sqlite_db)
+    assert index.wants('neverseen', 'vote')
+    assert not SubscriptionIndex(
+        sqlite_db, drop_unknown_users=True).wants('neverseen', 'vote')
+
+
+def test_index_loads_and_follows_changes(sqlite_db):
+    sqlite_db.create_user(
+        'loaded', {'email': {'notification_types': ['follow'], 'sub_data': {}}})
+    index = SubscriptionIndex(sqlite_db)
+    sqlite_db.add_user_settings_listener(index.update)
+    assert index.wants('loaded', 'follow')
+    assert not index.wants('loaded', 'vote')
+    assert len(index) == 1
+
+    sqlite_db.set_user_transports(
+        'loaded', {'wwwpoll': {'notification_types': ['vote'], 'sub_data': {}}})
+    assert index.wants('loaded', 'vote')
+    assert not index.wants('loaded', 'follow')
+
+
+def test_index_refresh_picks_up_other_writers(sqlite_db):
+    index = SubscriptionIndex(sqlite_db)
+    index.refresh()
+    # a change made without the listener, e.g. by an API server elsewhere
+    sqlite_db.create_user(
+        'remote', {'wwwpoll': {'notification_types': [], 'sub_data': {}}})
+    index.refresh()
+    assert not index.wants('remote', 'vote')
+
+
+@pytest.mark.asyncio
+async def test_follower_drops_undeliverable(sqlite_db):
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    sqlite_db.set_user_transports(
+        'novotes', {'wwwpoll': {'notification_types': ['follow'],
+                                'sub_data': {}}})
+    dropped = FOLLOWER_DROPPED.get('vote')
+
+    await follower.notify(vote_op('novotes'))
+    await follower.notify(vote_op('defaultuser'))
+
+    assert FOLLOWER_DROPPED.get('vote') == dropped + 1
+    assert not sqlite_db.get_notifications(to_username='novotes')
+    assert len(sqlite_db.get_notifications(to_username='defaultuser')) == 1
+
+
+def test_routing_cache_follows_changes(sqlite_db):
+    sqlite_db.create_user(
+        'routed', {'email': {'notification_types': ['vote'], 'sub_data': 'a'}})
+    routes = RoutingCache(sqlite_db, max_users=1)
+    assert routes.routes('routed') == {'vote': [('email', 'a')]}
+
+    sqlite_db.set_user_transports(
+        'routed', {'sms': {'notification_types': ['follow'], 'sub_data': 'b'}})
+    assert routes.routes('routed') == {'follow': [('sms', 'b')]}
+
+    routes.routes('other')
+    assert list(routes.users) == ['other']
+
+
+class MockTransport(base_transport.BaseTransport):
+    def __init__(self):
+        self.sent = []
+
+    def send_notification(self, **kwargs):
+        self.sent.append(kwargs)
+
+
+@pytest.mark.asyncio
+async def test_sender_skips_types_without_transport(sqlite_db):
+    yo_app = MockApp(sqlite_db)
+    sqlite_db.create_user(
+        'testauthor', {'mock': {'notification_types': ['follow'],
+                                'sub_data': ''}})
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=yo_app)
+    sender.configured_transports = {'mock': MockTransport()}
+    skipped = TRANSPORT_SENDS.get('none', 'skipped')
+
+    # stored before the user turned votes off
+    sqlite_db.create_notification(
+        notify_type='vote',
+        to_username='testauthor',
+        from_username='testvoter',
+        json_data='{}',
+        priority_level=2,
+        trx_id='skipped-vote')
+    await sender.run_send_notify()
+
+    assert sender.configured_transports['mock'].sent == []
+    assert TRANSPORT_SENDS.get('none', 'skipped') == skipped + 1
+    assert sqlite_db.get_wwwpoll_unsents() == {}
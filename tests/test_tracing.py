@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+import uuid
+
+import pytest
+
+from yo import config
+from yo import metrics
+from yo import tracing
+from yo.services import api_server
+from yo.services import blockchain_follower
+from yo.services import notification_sender
+from yo.transports import base_transport
+
+
+class MockApp:
+    def __init__(self, db):
+        self.db = db
+        self.config = config.YoConfigManager(None)
+
+
+class MockTransport(base_transport.BaseTransport):
+    def send_notification(self, **kwargs):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def add_mock_transport_type(monkeypatch):
+    monkeypatch.setattr(api_server, 'TRANSPORT_TYPES',
+                        set(api_server.TRANSPORT_TYPES) | {'mock'})
+
+
+def test_stage_latencies():
+    summary = metrics.Summary('test_stage_seconds', 'Test', ('stage', ))
+    tracer = tracing.NotificationTracer(summary=summary)
+    tracer.record('nid1', 'commit', timestamp=103, block=100, ingest=101)
+    tracer.record('nid1', 'claim', timestamp=104)
+    tracer.record('nid1', 'deliver', timestamp=110)
+    tracer.record('nid1', 'deliver', timestamp=120)  # only the first counts
+
+    trace = tracer.get_trace('nid1')
+    assert trace['latency'] == {
+        'block': 0,
+        'ingest': 1,
+        'commit': 3,
+        'claim': 4,
+        'deliver': 10
+    }
+    assert summary.get_quantiles('ingest_to_commit')[0.5] == 2
+    assert summary.get_quantiles('claim_to_deliver')[0.5] == 6
+    assert summary.get_quantiles('block_to_deliver')[0.5] == 10
+
+
+def test_max_traces():
+    tracer = tracing.NotificationTracer(max_traces=2)
+    for nid in ('a', 'b', 'c'):
+        tracer.record(nid, 'claim')
+    assert tracer.get_trace('a') is None
+    assert tracer.get_trace('c') is not None
+
+
+@pytest.fixture(params=['UTC', 'America/New_York', 'Asia/Kolkata'])
+def timezone(request, monkeypatch):
+    """Runs the test with the host clock in each timezone"""
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.asyncio
+async def test_vote_traced_to_delivery(sqlite_db, timezone):
+    yo_app = MockApp(sqlite_db)
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=yo_app)
+    sender.configured_transports = {'mock': MockTransport()}
+    follower = blockchain_follower.YoBlockchainFollower(
+        db=sqlite_db, yo_app=yo_app)
+    await api_server.YoAPIServer().api_set_transports(
+        username='testupvoted',
+        transports={'mock': {
+            'notification_types': ['vote'],
+            'sub_data': ''
+        }},
+        context=dict(yo_db=sqlite_db))
+
+    block_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=3)
+    await follower.notify({
+        'trx_id': str(uuid.uuid4()),
+        'timestamp': block_time.strftime(tracing.BLOCK_TIME_FORMAT),
+        'op': ('vote', {
+            'permlink': 'test-post',
+            'author': 'testupvoted',
+            'voter': 'testupvoter',
+            'weight': 10000
+        })
+    })
+    await sender.api_trigger_notifications()
+
+    nid = sqlite_db.get_notifications(to_username='testupvoted')[0]['nid']
+    trace = tracing.TRACER.get_trace(nid)
+    assert list(trace['stages'].keys()) == list(tracing.STAGES)
+    assert 3 <= trace['latency']['deliver'] < 60
+
+
+@pytest.mark.asyncio
+async def test_sender_reads_commit_time_in_any_timezone(sqlite_db, timezone):
+    # a follower in another process committed it, the sender only has the row
+    sender = notification_sender.YoNotificationSender(
+        db=sqlite_db, yo_app=MockApp(sqlite_db))
+    sender.configured_transports = {'mock': MockTransport()}
+    sqlite_db.create_user('testuser', {
+        'mock': {
+            'notification_types': ['vote'],
+            'sub_data': ''
+        }
+    })
+    now = datetime.datetime.now()
+    sqlite_db.create_notification(
+        notify_type='vote',
+        to_username='testuser',
+        from_username='voter',
+        json_data='{}',
+        trx_id=str(uuid.uuid4()),
+        created=now,
+        block_time=datetime.datetime.utcnow() - datetime.timedelta(seconds=3))
+    await sender.api_trigger_notifications()
+
+    nid = sqlite_db.get_notifications(to_username='testuser')[0]['nid']
+    trace = tracing.TRACER.get_trace(nid)
+    # created is local time, block_time UTC, both line up
+    assert abs(trace['stages']['commit'] - now.timestamp()) < 1
+    assert 2 <= trace['latency']['commit'] <= trace['latency']['claim'] < 60
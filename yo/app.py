@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import datetime
+import hmac
 import logging
 import os
 
@@ -8,6 +9,13 @@ import uvloop
 from aiohttp import web
 from jsonrpcserver.async_methods import AsyncMethods
 
+from .metrics import API_REQUEST_SECONDS
+from .metrics import REGISTRY
+from .private_api import PRIVATE_API_KEY_HEADER
+from .private_api import PRIVATE_API_PATH
+from .private_api import PrivateAPIClient
+from .tracing import TRACER
+
 logger = logging.getLogger(__name__)
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -31,6 +39,7 @@ class YoApp:
             'yo_app': self
         }
         self.api_methods = AsyncMethods()
+        self.private_api_clients = {}
         self.running = False
 
     async def handle_api(self, request):
@@ -40,7 +49,12 @@ class YoApp:
         if 'params' not in request.keys():
             request['params'] = {}  # fix for API methods that have no params
         context = {'yo_db': req_app['config']['yo_db']}
-        response = await self.api_methods.dispatch(request, context=context)
+        method = request.get('method') if isinstance(request, dict) else None
+        if method not in self.api_methods:
+            method = 'unknown'  # keep label cardinality bounded
+        with API_REQUEST_SECONDS.time(method):
+            response = await self.api_methods.dispatch(
+                request, context=context)
         return web.json_response(response)
 
     def add_api_method(self, func, func_name):
@@ -72,6 +86,45 @@ class YoApp:
 
     # pylint: enable=unused-argument
 
+    # pylint: disable=unused-argument
+    @staticmethod
+    async def metrics_handler(request):
+        return web.Response(
+            text=REGISTRY.render(),
+            content_type='text/plain',
+            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def trace_handler(self, request):
+        if not self.has_private_api_key(request):
+            return web.Response(status=403)
+        trace = TRACER.get_trace(request.match_info['nid'])
+        if trace is None:
+            return web.json_response({'error': 'No trace found'}, status=404)
+        return web.json_response(trace)
+
+    async def queries_handler(self, request):
+        """ Per-statement query stats, most total time first
+
+        ?top=N limits the number of statements, ?explain=1 includes the
+        EXPLAIN output for them (needs capture_explain in yo.cfg). Like
+        /private this needs the private API key
+        """
+        if not self.has_private_api_key(request):
+            return web.Response(status=403)
+        try:
+            top = int(request.query.get('top', 20))
+        except ValueError:
+            top = 0
+        if top <= 0:
+            return web.json_response(
+                {'error': 'top must be a positive integer'}, status=400)
+        profiler = self.db.profiler
+        if request.query.get('explain'):
+            return web.json_response(profiler.explain(top=top))
+        return web.json_response(profiler.get_stats(top=top))
+
+    # pylint: enable=unused-argument
+
     @staticmethod
     async def handle_options(request):
         origin = request.headers['Origin']
@@ -87,12 +140,100 @@ class YoApp:
             response = web.Response(status=403)
         return response
 
+    def get_private_api_key(self):
+        return self.config.config_data['private_api'].get('api_key', '')
+
+    def has_private_api_key(self, request):
+        """ Whether a request carries the configured private API key, always
+        False if no key is set
+        """
+        api_key = self.get_private_api_key()
+        return bool(api_key) and hmac.compare_digest(
+            request.headers.get(PRIVATE_API_KEY_HEADER, ''), api_key)
+
+    async def handle_private_api(self, request):
+        """ Handles private API calls (single or batched) from other nodes
+
+        Methods are named service.api_method and are always invoked on the
+        services running locally in this node. Requests without the
+        configured key are refused, and so is everything if no key is set
+        """
+        if not self.has_private_api_key(request):
+            return web.Response(status=403)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.json_response({
+                'jsonrpc': '2.0',
+                'id': None,
+                'error': {
+                    'code': -32700,
+                    'message': 'Parse error'
+                }
+            })
+        batch = isinstance(payload, list)
+        calls = payload if batch else [payload]
+        responses = await asyncio.gather(
+            *[self.dispatch_private_call(call) for call in calls])
+        return web.json_response(responses if batch else responses[0])
+
+    async def dispatch_private_call(self, call):
+        """ Invokes one call of a private API request
+
+        Returns:
+            the JSON-RPC response for the call, with an error object if it
+            failed so the other calls in the batch still get their results
+        """
+        if not isinstance(call, dict):
+            return {
+                'jsonrpc': '2.0',
+                'id': None,
+                'error': {
+                    'code': -32600,
+                    'message': 'Invalid Request'
+                }
+            }
+        try:
+            service, _, api_method = call.get('method', '').partition('.')
+            result = await self.invoke_local_private_api(
+                service=service,
+                api_method=api_method,
+                **call.get('params', {}))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Private API call %s failed', call.get('method'))
+            return {
+                'jsonrpc': '2.0',
+                'id': call.get('id'),
+                'error': {
+                    'code': -32603,
+                    'message': 'Internal error',
+                    'data': repr(e)
+                }
+            }
+        return {'jsonrpc': '2.0', 'id': call.get('id'), 'result': result}
+
     # pylint: disable=unused-argument
     async def setup_standard_api(self, app):
         self.add_api_method(self.api_healthcheck, 'healthcheck')
         self.web_app.router.add_post('/', self.handle_api)
         self.web_app.router.add_get('/.well-known/healthcheck.json',
                                     self.healthcheck_handler)
+        self.web_app.router.add_get('/metrics', self.metrics_handler)
+        if self.get_private_api_key():
+            self.web_app.router.add_post(PRIVATE_API_PATH,
+                                         self.handle_private_api)
+            # raw SQL, bind parameters and EXPLAIN on the live database
+            self.web_app.router.add_get('/debug/trace/{nid}',
+                                        self.trace_handler)
+            self.web_app.router.add_get('/debug/queries',
+                                        self.queries_handler)
+        else:
+            logger.warning('No [private_api] api_key set, not serving %s '
+                           'and /debug', PRIVATE_API_PATH)
+
+    async def close_private_api_clients(self, app):
+        for client in self.private_api_clients.values():
+            await client.close()
 
     # pylint: enable=unused-argument
 
@@ -100,6 +241,7 @@ class YoApp:
         self.running = True
         self.web_app.on_startup.append(self.start_background_tasks)
         self.web_app.on_startup.append(self.setup_standard_api)
+        self.web_app.on_cleanup.append(self.close_private_api_clients)
         web.run_app(
             self.web_app,
             host=self.config.get_listen_host(),
@@ -114,9 +256,61 @@ class YoApp:
         self.services[name] = service
         service.init_api()
 
+    def get_service_url(self, service):
+        """Returns the configured URL for a service, :local: by default"""
+        if service not in self.config.config_data:
+            return ':local:'
+        return self.config.config_data[service].get('url', ':local:') or \
+            ':local:'
+
+    def get_private_api_client(self, url):
+        """Returns the (shared) private API client for a remote node"""
+        if url not in self.private_api_clients:
+            settings = self.config.config_data['private_api']
+            self.private_api_clients[url] = PrivateAPIClient(
+                url,
+                api_key=settings.get('api_key', '') or None,
+                timeout=settings.getfloat('timeout', 10),
+                batch_window=settings.getfloat('batch_window', 0.01),
+                max_batch_size=settings.getint('max_batch_size', 50),
+                coalesce_window=settings.getfloat('coalesce_window', 0.5),
+                max_connections=settings.getint('max_connections', 10),
+                loop=self.loop)
+        return self.private_api_clients[url]
+
     async def invoke_private_api(self, service=None, api_method=None,
                                  **kwargs):
-        # TODO - add support for URLs other than :local:
+        """ Invokes a private API method on the node running the service
+
+        If the service's url is :local: this calls straight into the service
+        in this process, otherwise the call is batched and sent over HTTP
+        """
+        url = self.get_service_url(service)
+        if url == ':local:':
+            return await self.invoke_local_private_api(
+                service=service, api_method=api_method, **kwargs)
+        return await self.get_private_api_client(url).call(
+            service=service, api_method=api_method, **kwargs)
+
+    def signal_private_api(self, service=None, api_method=None):
+        """ Fire-and-forget version of invoke_private_api for wake-ups
+
+        Remote signals are coalesced by the private API client, local ones
+        are just scheduled on the event loop
+        """
+        url = self.get_service_url(service)
+        if url == ':local:':
+            self.loop.create_task(
+                self.invoke_local_private_api(
+                    service=service, api_method=api_method))
+        else:
+            self.get_private_api_client(url).signal(
+                service=service, api_method=api_method)
+
+    async def invoke_local_private_api(self,
+                                       service=None,
+                                       api_method=None,
+                                       **kwargs):
         if service not in self.services.keys():
             return {'error': 'No such service found!'}
         if api_method not in self.services[service].private_api_methods.keys():
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+""" Append-only archive segments for expired rows
+
+    The retention service moves expired rows out of the hot tables into
+    segment files under the archive directory, one set per table:
+
+        <archive_dir>/<table>/<table>-<seq>.jsonl.gz
+
+    Each write appends a gzip member holding one JSON row per line, which
+    gzip readers see as a single stream. A segment is closed once it grows
+    past segment_bytes and never touched again.
+
+    Notifications are the one table read back, by get_notifications once a
+    user's history runs past the hot table. They go to indexed segments
+    instead (see yo/segments.py), one per write, which compact() merges
+    into segments of up to segment_bytes:
+
+        <archive_dir>/yo_notifications/yo_notifications-<seq>.yoseg
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+
+from . import segments
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PATTERN = re.compile(
+    r'^(?P<table>\w+)-(?P<seq>\d{8})(?P<suffix>\.jsonl\.gz|\.yoseg)$')
+
+INDEXED_TABLES = ('yo_notifications', )
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return value
+
+
+def segment_name(table_name, seq):
+    suffix = segments.SEGMENT_SUFFIX if table_name in INDEXED_TABLES \
+        else '.jsonl.gz'
+    return '%s-%08d%s' % (table_name, seq, suffix)
+
+
+class ArchiveWriter:
+    def __init__(self, archive_dir, segment_bytes=64 * 1024 * 1024):
+        """ Writes expired rows to segment files
+
+        Keyword args:
+            archive_dir(str):     where segments go, created if missing
+            segment_bytes(int):   start a new segment past this size
+        """
+        self.archive_dir = archive_dir
+        self.segment_bytes = segment_bytes
+
+    def table_dir(self, table_name):
+        path = os.path.join(self.archive_dir, table_name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def segments(self, table_name):
+        """Returns the segment paths of a table, oldest first"""
+        path = self.table_dir(table_name)
+        return [
+            os.path.join(path, name) for name in sorted(os.listdir(path))
+            if SEGMENT_PATTERN.match(name)
+        ]
+
+    def next_segment(self, table_name):
+        paths = self.segments(table_name)
+        seq = int(SEGMENT_PATTERN.match(os.path.basename(
+            paths[-1])).group('seq')) + 1 if paths else 0
+        return os.path.join(
+            self.table_dir(table_name), segment_name(table_name, seq))
+
+    def current_segment(self, table_name):
+        paths = self.segments(table_name)
+        if paths and os.path.getsize(paths[-1]) < self.segment_bytes:
+            return paths[-1]
+        return self.next_segment(table_name)
+
+    def write(self, table_name, rows):
+        """ Appends rows (dicts) to the table's current segment
+
+        The data is flushed and fsynced before returning, so the rows can be
+        deleted from the database afterwards
+
+        Returns:
+            str: path of the segment written to
+        """
+        rows = [{k: encode_value(v) for k, v in row.items()} for row in rows]
+        if table_name in INDEXED_TABLES:
+            path = segments.write_segment(
+                self.next_segment(table_name), rows)
+            logger.debug('Archived %d %s rows to %s', len(rows), table_name,
+                         path)
+            return path
+        path = self.current_segment(table_name)
+        data = ''.join(json.dumps(row, sort_keys=True) + '\n'
+                       for row in rows).encode('utf-8')
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(data))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.debug('Archived %d %s rows to %s', len(rows), table_name, path)
+        return path
+
+    def compact(self, table_name):
+        """ Merges the indexed segments of a table smaller than segment_bytes
+
+        The merged segment is complete before the small ones are removed,
+        readers skip the rows they see twice in between
+
+        Returns:
+            int: the number of segments merged
+        """
+        small, total = [], 0
+        for path in self.segments(table_name):
+            size = os.path.getsize(path)
+            if size >= self.segment_bytes:
+                continue
+            if total + size > self.segment_bytes and len(small) > 1:
+                break
+            small.append(path)
+            total += size
+        if len(small) < 2:
+            return 0
+        rows = [row for path in small for row in read_segment(path)]
+        path = segments.write_segment(self.next_segment(table_name), rows)
+        for old_path in small:
+            os.remove(old_path)
+        logger.info('Compacted %d %s segments into %s', len(small), table_name,
+                    path)
+        return len(small)
+
+
+def read_segment(path):
+    """Yields the rows of a segment as dicts"""
+    if path.endswith(segments.SEGMENT_SUFFIX):
+        segment = segments.Segment(path)
+        try:
+            yield from segment.rows()
+        finally:
+            segment.close()
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
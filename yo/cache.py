@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Cache of the most recent notifications of active users
+
+    Nearly every get_notifications call asks for a user's newest page, so
+    YoDatabase keeps a small ring buffer of newest-first rows per user and
+    answers those calls from memory. Users are evicted least recently used
+    first once there are more than max_users of them.
+
+    A buffer is filled from the database on a miss, then kept current by
+    the writes going through the same YoDatabase. Writes made by other
+    processes (e.g. a follower on another node) aren't seen, so entries
+    are only trusted for max_age seconds.
+"""
+import itertools
+import logging
+import sys
+import time
+from collections import OrderedDict
+from collections import deque
+
+from .metrics import NOTIFICATION_CACHE_BYTES
+from .metrics import NOTIFICATION_CACHE_LOOKUPS
+from .metrics import NOTIFICATION_CACHE_USERS
+
+logger = logging.getLogger(__name__)
+
+
+def row_size(row):
+    """Rough size of a row dict in bytes, the keys are shared by all rows"""
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+
+
+class UserBuffer:
+    __slots__ = ('rows', 'complete', 'size', 'loaded_at')
+
+    def __init__(self, rows, per_user, loaded_at):
+        self.rows = deque(rows, maxlen=per_user)
+        # True if the buffer holds every notification the user has
+        self.complete = len(rows) < per_user
+        self.size = sum(row_size(row) for row in rows)
+        self.loaded_at = loaded_at
+
+
+class RecentNotificationCache:
+    def __init__(self, max_users=10000, per_user=30, max_age=10):
+        """ Bounded per-user buffers of recent notifications
+
+        Keyword args:
+            max_users(int):   users kept, least recently used are evicted
+            per_user(int):    rows kept per user, the largest cached limit
+            max_age(float):   seconds a buffer is trusted after being loaded
+        """
+        self.max_users = max_users
+        self.per_user = per_user
+        self.max_age = max_age
+        self.users = OrderedDict()
+        self.nid_users = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio
+        }
+
+    def update_gauges(self):
+        NOTIFICATION_CACHE_BYTES.set(self.bytes)
+        NOTIFICATION_CACHE_USERS.set(len(self.users))
+
+    def get(self, username, limit):
+        """ Returns copies of the newest limit rows of a user, None on a miss
+        """
+        entry = self.users.get(username)
+        if entry is not None and \
+                time.monotonic() - entry.loaded_at > self.max_age:
+            self.invalidate_user(username)
+            entry = None
+        if entry is None or (limit > len(entry.rows) and not entry.complete):
+            self.misses += 1
+            NOTIFICATION_CACHE_LOOKUPS.inc('miss')
+            return None
+        self.users.move_to_end(username)
+        self.hits += 1
+        NOTIFICATION_CACHE_LOOKUPS.inc('hit')
+        return [dict(row) for row in itertools.islice(entry.rows, limit)]
+
+    def fill(self, username, rows):
+        """ Loads a user's buffer from their newest per_user rows, newest
+        first, as read from the database
+        """
+        self.invalidate_user(username)
+        # copies, the caller hands the rows on
+        entry = UserBuffer([dict(row) for row in rows[:self.per_user]],
+                           self.per_user, time.monotonic())
+        self.users[username] = entry
+        self.bytes += entry.size
+        for row in entry.rows:
+            self.nid_users[row['nid']] = username
+        while len(self.users) > self.max_users:
+            self.invalidate_user(next(iter(self.users)))
+        self.update_gauges()
+
+    def push(self, row):
+        """ Adds a newly stored row to its user's buffer, if there is one
+        """
+        username = row['to_username']
+        entry = self.users.get(username)
+        if entry is None or row['nid'] in self.nid_users:
+            return
+        if entry.rows and row['nid'] < entry.rows[0]['nid']:
+            # not the newest, e.g. a backfill, reload rather than reorder
+            self.invalidate_user(username)
+            return
+        if len(entry.rows) == entry.rows.maxlen:
+            dropped = entry.rows.pop()
+            self.nid_users.pop(dropped['nid'], None)
+            entry.size -= row_size(dropped)
+            self.bytes -= row_size(dropped)
+            entry.complete = False
+        row = dict(row)
+        entry.rows.appendleft(row)
+        self.nid_users[row['nid']] = username
+        entry.size += row_size(row)
+        self.bytes += row_size(row)
+        self.update_gauges()
+
+    def invalidate_user(self, username):
+        entry = self.users.pop(username, None)
+        if entry is None:
+            return
+        for row in entry.rows:
+            self.nid_users.pop(row['nid'], None)
+        self.bytes -= entry.size
+        self.update_gauges()
+
+    def invalidate_nids(self, nids):
+        """Drops the buffers holding any of the nids"""
+        for nid in nids:
+            username = self.nid_users.get(nid)
+            if username is not None:
+                self.invalidate_user(username)
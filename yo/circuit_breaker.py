@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+""" Circuit breakers and adaptive concurrency for the transports
+
+    Every transport of the notification sender gets a CircuitBreaker and an
+    AIMDLimiter. The breaker watches the error rate and latency of the
+    sends in a sliding window. Once too many fail or are too slow it opens,
+    and the sender defers the transport's notifications instead of waiting
+    on timeouts. After the cooldown one probe batch is let through
+    (half-open). If it goes well the breaker closes again, if not it stays
+    open for another cooldown.
+
+    The AIMDLimiter bounds how many batches of a transport are in flight.
+    Every clean batch adds one, up to the transport's max_concurrency. A
+    failed or slow one halves it.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from .metrics import TRANSPORT_CIRCUIT_STATE
+from .metrics import TRANSPORT_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self,
+                 name,
+                 window=60,
+                 min_sends=20,
+                 error_rate=0.5,
+                 slow_seconds=10,
+                 cooldown=30,
+                 clock=time.monotonic):
+        """ Tracks the health of one transport
+
+        Args:
+            name(str):          the transport, for logs and metrics
+        Keyword args:
+            window(float):      seconds of send outcomes considered
+            min_sends(int):     sends in the window needed to open
+            error_rate(float):  fraction of bad sends that opens it
+            slow_seconds(float): a batch taking longer counts as bad
+            cooldown(float):    seconds open before a probe is let through
+        """
+        self.name = name
+        self.window = window
+        self.min_sends = min_sends
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.clock = clock
+        # (time, good sends, bad sends) per batch
+        self.outcomes = collections.deque()
+        self.good = 0
+        self.bad = 0
+        self.opened_at = None
+        self.probing = False
+        self.set_state(CLOSED)
+
+    def set_state(self, state):
+        self.state = state
+        TRANSPORT_CIRCUIT_STATE.set(STATE_VALUES[state], self.name)
+
+    def expire(self, now):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            _, good, bad = self.outcomes.popleft()
+            self.good -= good
+            self.bad -= bad
+
+    def ready(self):
+        """Whether a send would be let through now, without claiming it"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return self.clock() >= self.opened_at + self.cooldown
+        return not self.probing
+
+    def allow(self):
+        """ Whether to send now, past the cooldown this claims the probe
+
+        Returns:
+            bool: False if the sends should be deferred
+        """
+        if not self.ready():
+            return False
+        if self.state == OPEN:
+            logger.info('Circuit of %s half-open, probing', self.name)
+            self.set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            self.probing = True
+        return True
+
+    def record(self, good, bad, seconds):
+        """ Records the outcome of a batch let through by allow()
+
+        Args:
+            good(int):       sends that succeeded
+            bad(int):        sends that failed
+            seconds(float):  how long the batch took
+        """
+        if seconds > self.slow_seconds:
+            good, bad = 0, good + bad
+        now = self.clock()
+        if self.state == HALF_OPEN:
+            self.probing = False
+            if bad and bad >= (good + bad) * self.error_rate:
+                self.trip(now)
+            else:
+                logger.info('Circuit of %s closed', self.name)
+                self.outcomes.clear()
+                self.good = self.bad = 0
+                self.set_state(CLOSED)
+            return
+        self.outcomes.append((now, good, bad))
+        self.good += good
+        self.bad += bad
+        self.expire(now)
+        total = self.good + self.bad
+        if self.state == CLOSED and total >= self.min_sends and \
+                self.bad >= total * self.error_rate:
+            self.trip(now)
+
+    def trip(self, now):
+        logger.warning('Circuit of %s opened, deferring its sends for %ss',
+                       self.name, self.cooldown)
+        self.opened_at = now
+        self.set_state(OPEN)
+
+
+class AIMDLimiter:
+    def __init__(self, name, maximum, minimum=1):
+        """ Limits the batches of one transport in flight, additive increase
+        multiplicative decrease between minimum and maximum
+
+        Args:
+            name(str):      the transport, for metrics
+            maximum(int):   the transport's max_concurrency
+        """
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = self.maximum
+        self.in_flight = 0
+        self.condition = None
+        TRANSPORT_CONCURRENCY.set(self.limit, self.name)
+
+    async def __aenter__(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            while self.in_flight >= self.limit:
+                await self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, ok):
+        """Adjusts the limit after a batch, ok if it was clean and fast"""
+        if ok:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(self.minimum, self.limit // 2)
+        TRANSPORT_CONCURRENCY.set(self.limit, self.name)
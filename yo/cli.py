@@ -1,14 +1,44 @@
 # -*- coding: utf-8 -*-
 import argparse
+import importlib
+import logging
 import os
 import sys
 
 from .app import YoApp
+from .cache import RecentNotificationCache
 from .config import YoConfigManager
 from .db import YoDatabase
-from .services.api_server import YoAPIServer
-from .services.blockchain_follower import YoBlockchainFollower
-from .services.notification_sender import YoNotificationSender
+from .db import apply_index_profile
+from .ids import use_binary_storage
+
+logger = logging.getLogger(__name__)
+
+# service name (as used for the config section) -> (module, class)
+# the modules are only imported if the service is enabled on this node, this
+# keeps steem-python, sendgrid, twilio etc out of nodes that don't need them
+SERVICES = (
+    ('notification_sender', ('.services.notification_sender',
+                             'YoNotificationSender')),
+    ('api_server', ('.services.api_server', 'YoAPIServer')),
+    ('blockchain_follower', ('.services.blockchain_follower',
+                             'YoBlockchainFollower')),
+    ('retention', ('.services.retention', 'YoRetention')),
+)
+
+
+def load_service_class(service_name):
+    """Imports and returns the class implementing the named service"""
+    module_name, class_name = dict(SERVICES)[service_name]
+    module = importlib.import_module(module_name, package=__package__)
+    return getattr(module, class_name)
+
+
+def enabled_services(yo_config):
+    """Returns the names of the services enabled in the config"""
+    return [
+        name for name, _ in SERVICES if yo_config.service_enabled(name)
+    ]
 
 
 def main():
@@ -23,12 +53,30 @@ def main():
     args = parser.parse_args(sys.argv[1:])
 
     yo_config = YoConfigManager(args.config)
-    yo_database = YoDatabase(db_url=os.environ.get('YO_DATABASE_URL'))
+    db_settings = yo_config.config_data['database']
+    notification_cache = None
+    if db_settings.getint('cache_users', 10000) > 0:
+        notification_cache = RecentNotificationCache(
+            max_users=db_settings.getint('cache_users', 10000),
+            per_user=db_settings.getint('cache_per_user', 30),
+            max_age=db_settings.getfloat('cache_max_age', 10))
+    # process wide, before the tables are first used
+    use_binary_storage(bool(db_settings.getint('binary_ids', 0)))
+    apply_index_profile(db_settings.get('index_profile', 'full'))
+    yo_database = YoDatabase(
+        db_url=os.environ.get('YO_DATABASE_URL'),
+        slow_query_threshold=db_settings.getfloat('slow_query_threshold',
+                                                  None),
+        redact_query_params=bool(
+            db_settings.getint('redact_query_params', 1)),
+        capture_explain=bool(db_settings.getint('capture_explain', 0)),
+        archive_dir=db_settings.get('archive_dir', None),
+        notification_cache=notification_cache)
     yo_app = YoApp(config=yo_config, db=yo_database)
 
-    yo_app.add_service(YoNotificationSender)
-    yo_app.add_service(YoAPIServer)
-    yo_app.add_service(YoBlockchainFollower)
+    for service_name in enabled_services(yo_config):
+        logger.info('Enabling service %s', service_name)
+        yo_app.add_service(load_service_class(service_name))
     yo_app.run()
 
 
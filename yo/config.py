@@ -3,8 +3,6 @@ import configparser
 import logging
 import os
 
-import py_vapid
-
 
 class YoConfigManager:
     """A class for handling configuration details all in one place
@@ -24,8 +22,12 @@ class YoConfigManager:
         self.config_data['blockchain_follower'] = {}
         self.config_data['notification_sender'] = {}
         self.config_data['api_server'] = {}
+        self.config_data['private_api'] = {}
+        self.config_data['database'] = {}
+        self.config_data['retention'] = {'enabled': '0'}
+        self.config_data['ratelimits'] = {}
         self.vapid_priv_key = None
-        self.vapid = None
+        self._vapid = None
         for k, v in defaults.items():  # load defaults passed as param
             self.config_data[k] = v
 
@@ -43,7 +45,6 @@ class YoConfigManager:
 
         log_level = self.config_data['yo_general'].get('log_level', 'INFO')
         logging.basicConfig(level=log_level)
-        self.generate_needed()
 
     def get_listen_host(self):
         return self.config_data['http'].get('listen_host',
@@ -53,17 +54,39 @@ class YoConfigManager:
         return int(self.config_data['http'].get('listen_port',
                                                 8080))  # pragma: no cover
 
+    def service_enabled(self, service_name):
+        """Returns True if the named service should run on this node
+
+       Services are enabled by default, set enabled=0 in the service's
+       section (or YO_<SERVICE>_ENABLED in the environment) to disable
+       """
+        if service_name not in self.config_data:
+            return True
+        return bool(self.config_data[service_name].getint('enabled', 1))
+
+    @property
+    def vapid(self):
+        """The VAPID key pair, loaded or generated on first use
+
+       Only webpush needs this, so nodes that never touch it skip the
+       EC key generation at startup
+       """
+        if self._vapid is None:
+            self.generate_needed()
+        return self._vapid
+
     def generate_needed(self):
         """If needed, regenerates VAPID keys and similar
        """
+        import py_vapid  # deferred, pulls in cryptography
         self.vapid_priv_key = self.config_data['vapid'].get('priv_key', None)
         if self.vapid_priv_key is None:
-            self.vapid = py_vapid.Vapid()
-            self.vapid.generate_keys()
+            self._vapid = py_vapid.Vapid()
+            self._vapid.generate_keys()
         else:
             if not self.vapid_priv_key:
-                self.vapid = py_vapid.Vapid()
-                self.vapid.generate_keys()
+                self._vapid = py_vapid.Vapid()
+                self._vapid.generate_keys()
             else:
-                self.vapid = py_vapid.Vapid.from_raw(
+                self._vapid = py_vapid.Vapid.from_raw(
                     private_raw=self.vapid_priv_key.encode())
@@ -2,7 +2,7 @@
 import datetime
 import json
 import logging
-import uuid
+import os
 from contextlib import contextmanager
 from enum import IntFlag
 from sqlite3 import IntegrityError as SQLiteIntegrityError
@@ -13,6 +13,16 @@ import sqlalchemy as sa
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import IntegrityError
 
+from .ids import ULID_LENGTH
+from .ids import NidType
+from .ids import new_nid
+from .ids import min_nid
+from .metrics import DB_QUERY_SECONDS
+from .metrics import instrument_methods
+from .query_profiler import QueryProfiler
+from .segments import ArchiveReader
+from .shards import username_hash
+
 logger = logging.getLogger(__name__)
 
 metadata = sa.MetaData()
@@ -23,6 +33,12 @@ NOTIFY_TYPES = ('power_down', 'power_up', 'resteem', 'feed', 'reward', 'send',
 
 TRANSPORT_TYPES = ('email', 'sms', 'wwwpoll')
 
+# get_notifications filters the archive index can't answer
+ARCHIVE_UNSUPPORTED_FILTERS = ('nid', 'created_before', 'updated_after', 'read')
+# get_notifications filters that bypass the recent notification cache
+CACHE_UNSUPPORTED_FILTERS = ARCHIVE_UNSUPPORTED_FILTERS + ('before_id',
+                                                           'notify_types')
+
 
 class Priority(IntFlag):
     MARKETING = 1
@@ -54,11 +70,11 @@ DEFAULT_USER_TRANSPORT_SETTINGS_STRING = json.dumps(
 wwwpoll_table = sa.Table(
     'yo_wwwpoll',
     metadata,
-    sa.Column('nid', sa.String(36), primary_key=True),
-    sa.Column('notify_type', sa.String(20), nullable=False, index=True),
-    sa.Column('to_username', sa.String(20), nullable=False, index=True),
+    sa.Column('nid', NidType(), primary_key=True),
+    sa.Column('notify_type', sa.String(20), nullable=False),
+    sa.Column('to_username', sa.String(20), nullable=False),
     sa.Column(
-        'from_username', sa.String(20), nullable=False, index=True
+        'from_username', sa.String(20), nullable=False
     ),  # TODO - do we actually need this? @jg please discuss as you keep adding references to this field
     sa.Column('json_data', sa.UnicodeText(1024)),
 
@@ -67,15 +83,13 @@ wwwpoll_table = sa.Table(
         'created',
         sa.DateTime,
         default=sa.func.now(),
-        nullable=False,
-        index=True),
+        nullable=False),
     sa.Column(
         'updated',
         sa.DateTime,
         default=sa.func.now(),
         onupdate=sa.func.now(),
-        nullable=False,
-        index=True),
+        nullable=False),
     sa.Column('read', sa.Boolean(), default=False),
     sa.Column('shown', sa.Boolean(), default=False),
 
@@ -88,29 +102,33 @@ wwwpoll_table = sa.Table(
 notifications_table = sa.Table(
     'yo_notifications',
     metadata,
-    sa.Column('nid', sa.String(36), primary_key=True),
-    sa.Column('notify_type', sa.String(20), nullable=False, index=True),
-    sa.Column('to_username', sa.String(20), nullable=False, index=True),
-    sa.Column('from_username', sa.String(20), index=True, nullable=True),
+    sa.Column('nid', NidType(), primary_key=True),
+    sa.Column('notify_type', sa.String(20), nullable=False),
+    sa.Column('to_username', sa.String(20), nullable=False),
+    sa.Column('from_username', sa.String(20), nullable=True),
     sa.Column('json_data', sa.UnicodeText(1024)),
     sa.Column(
         'created',
         sa.DateTime,
         default=sa.func.now(),
-        nullable=False,
-        index=True),
+        nullable=False),
     sa.Column(
         'updated',
         sa.DateTime,
         default=sa.func.now(),
         onupdate=sa.func.now(),
-        nullable=False,
-        index=True),
+        nullable=False),
 
     # non-wwwpoll columns
-    sa.Column('priority_level', sa.Integer, index=True, default=3),
-    sa.Column('created_at', sa.DateTime, default=sa.func.now(), index=True),
-    sa.Column('trx_id', sa.String(40), index=True, nullable=True),
+    sa.Column('priority_level', sa.Integer, default=3),
+    sa.Column('created_at', sa.DateTime, default=sa.func.now()),
+    sa.Column('trx_id', sa.String(40), nullable=True),
+    sa.Column('block_time', sa.DateTime, nullable=True),  # UTC, for tracing
+    sa.Column('group_key', sa.String(255), nullable=True),  # e.g. permlink of a vote, for aggregation
+    sa.Column('to_username_hash', sa.BigInteger, nullable=True),  # crc32, for sender shards
+    sa.Index('yo_notification_group_idx', 'to_username', 'notify_type',
+             'group_key'),
+    sa.Index('yo_notification_hash_idx', 'to_username_hash'),
     sa.UniqueConstraint(
         'to_username',
         'notify_type',
@@ -164,9 +182,84 @@ chain_status_table = sa.Table(
     sa.Column('last_processed_time', sa.DateTime, index=True),
     sa.Column('lock_expires', sa.DateTime, index=True),   # set to the future to keep locked, set to the past to release lock
     sa.Column('active_follower_id',   sa.String(36), index=True),
+    sa.Column('fencing_token', sa.Integer, nullable=False, default=0, server_default='0'),  # bumped on every change of active follower
+    sa.Column('lock_renewed', sa.DateTime, nullable=True),  # last time the active follower showed signs of life
     mysql_engine='InnoDB',
 )
 
+# one row per shard of the notification senders, see yo/shards.py
+sender_shards_table = sa.Table(
+    'yo_sender_shards',
+    metadata,
+    sa.Column('shard_id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('lock_expires', sa.DateTime, index=True),  # like yo_chain_status, past means free
+    sa.Column('worker_id', sa.String(36), index=True),
+    mysql_engine='InnoDB',
+)
+
+# heartbeats of the sender workers, to split the shards between them
+sender_workers_table = sa.Table(
+    'yo_sender_workers',
+    metadata,
+    sa.Column('worker_id', sa.String(36), primary_key=True),
+    sa.Column('lock_expires', sa.DateTime, index=True),
+    mysql_engine='InnoDB',
+)
+
+
+# secondary indexes on the notification tables for each deployment role,
+# primary keys, unique constraints and yo_notification_group_idx always exist
+# 'full' is one index per column, as yo always had
+# see benchmarks/index_audit.py for which queries use which index
+INDEX_PROFILES = {
+    'full': {
+        'yo_notifications': [(c, ) for c in (
+            'notify_type', 'to_username', 'from_username', 'created',
+            'updated', 'priority_level', 'created_at', 'trx_id')],
+        'yo_wwwpoll': [(c, ) for c in ('notify_type', 'to_username',
+                                       'from_username', 'created', 'updated')],
+    },
+    # follower/sender nodes: inserts only pay for the unique constraint
+    'ingest': {
+        'yo_notifications': [],
+        'yo_wwwpoll': [('to_username', 'nid')],
+    },
+    # API nodes: a user's notifications newest first, optionally by type
+    'query': {
+        'yo_notifications': [('to_username', 'nid'),
+                             ('to_username', 'notify_type', 'nid')],
+        'yo_wwwpoll': [('to_username', 'nid'),
+                       ('to_username', 'notify_type', 'nid')],
+    },
+}
+
+
+def index_name(table_name, columns):
+    return 'ix_%s_%s' % (table_name, '_'.join(columns))
+
+
+def apply_index_profile(profile):
+    """ Sets the secondary indexes of the notification tables in metadata
+
+    This only changes what create_all creates, see sync_indexes in db_utils
+    for existing databases
+    """
+    if profile not in INDEX_PROFILES:
+        raise ValueError('Unknown index profile %s, expected one of %s' %
+                         (profile, ', '.join(sorted(INDEX_PROFILES))))
+    for table_name, indexes in INDEX_PROFILES[profile].items():
+        table = metadata.tables[table_name]
+        for index in list(table.indexes):
+            if index.name.startswith('ix_'):
+                table.indexes.discard(index)
+        for columns in indexes:
+            sa.Index(
+                index_name(table_name, columns),
+                *[table.c[column] for column in columns])
+
+
+apply_index_profile('full')
+
 
 def is_duplicate_entry_error(error):
     if isinstance(error, (IntegrityError, SQLiteIntegrityError)):
@@ -177,12 +270,35 @@ def is_duplicate_entry_error(error):
 
 # pylint: disable-msg=no-value-for-parameter
 class YoDatabase:
-    def __init__(self, db_url=None):
+    def __init__(self,
+                 db_url=None,
+                 slow_query_threshold=None,
+                 redact_query_params=True,
+                 capture_explain=False,
+                 archive_dir=None,
+                 notification_cache=None):
+        """ Binary nids and the index profile change the module's metadata,
+        so they are set once at process start with use_binary_storage and
+        apply_index_profile, before the first YoDatabase is created
+        """
         self.db_url = db_url
         self.engine = sa.create_engine(self.db_url)
+        self.profiler = QueryProfiler(
+            slow_query_threshold=slow_query_threshold,
+            redact_params=redact_query_params,
+            capture_explain=capture_explain)
+        self.profiler.attach(self.engine)
         self.metadata = metadata
         self.metadata.create_all(bind=self.engine)
         self.url = make_url(self.db_url)
+        self.user_settings_listeners = []
+        self.cache = notification_cache
+        self.archive = None
+        # table name -> whether it may still have uuid4 nids from before ULIDs
+        self.legacy_nids = {}
+        if archive_dir:
+            self.archive = ArchiveReader(
+                os.path.join(archive_dir, notifications_table.name))
 
     @contextmanager
     def acquire_conn(self):
@@ -195,6 +311,20 @@ class YoDatabase:
     @property
     def backend(self):
         return self.url.get_backend_name()
+
+    def add_user_settings_listener(self, callback):
+        """ Registers callback(username, transports), called whenever a
+        user's transports are created or changed through this instance
+        """
+        self.user_settings_listeners.append(callback)
+
+    def _notify_user_settings_listeners(self, username, transports):
+        for callback in self.user_settings_listeners:
+            try:
+                callback(username, transports)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('user settings listener failed for %s',
+                                 username)
     
     def get_chain_status(self):
         """ Returns current blockchain status
@@ -209,12 +339,13 @@ class YoDatabase:
                    retval = dict(resp.items())
         return retval
 
-    def try_update_status(self,follower_id=None, last_processed_block=None, lock_timeout=5):
+    def try_update_status(self,follower_id=None, last_processed_block=None, lock_timeout=5, fencing_token=None):
         """ Tries to update the chain status
 
         Fails if one of the following occurs:
             last_processed_block param <= current last_processed_block in DB
             active_follower_id != follower_id
+            fencing_token is given and another follower took over since it was issued
 
         Otherwise, last_processed_block is updated, last_processed_time is set to now and lock_expires is set to the current time + lock_timeout
 
@@ -225,9 +356,12 @@ class YoDatabase:
              tx = conn.begin()
              query = chain_status_table.update(values=dict(last_processed_block= last_processed_block,
                                                            last_processed_time = now,
+                                                           lock_renewed        = now,
                                                            lock_expires        = now + datetime.timedelta(seconds = lock_timeout)))
              query = query.where(chain_status_table.c.active_follower_id == follower_id)
              query = query.where(chain_status_table.c.last_processed_block <= last_processed_block)
+             if fencing_token is not None:
+                query = query.where(chain_status_table.c.fencing_token == fencing_token)
              try:
                 conn.execute(query)
                 tx.commit()
@@ -242,6 +376,8 @@ class YoDatabase:
 
         This only succeeds if the current active follower's lock has expired and there's not a currently open transaction etc
 
+        Taking over bumps fencing_token, the follower then passes it with its writes so ones from a follower that lost the lock fail
+
         Not to be confused with try_update_status() above
 
         last_processed_block will only be changed if the DB is empty, in which case the timestamp will be set to the current time
@@ -258,12 +394,16 @@ class YoDatabase:
              resp  = conn.execute(query).fetchone()
              if resp is None:
                 query = chain_status_table.insert(values=dict(active_follower_id=follower_id,
+                                                              fencing_token=1,
+                                                              lock_renewed        = now,
                                                               last_processed_block=last_processed_block,
                                                               last_processed_time = now,
                                                               lock_expires        = now + datetime.timedelta(seconds = lock_timeout)))
              
              else:
                 query = chain_status_table.update(values=dict(active_follower_id=follower_id,
+                                                              fencing_token=chain_status_table.c.fencing_token + 1,
+                                                              lock_renewed=now,
                                                               lock_expires=now + datetime.timedelta(seconds = lock_timeout)))
 
                 query = query.where(chain_status_table.c.lock_expires <= now)
@@ -275,9 +415,188 @@ class YoDatabase:
         return self.get_chain_status()
 
 
+    def _holds_follower_lock(self, conn, fence):
+        """ Checks, inside the caller's transaction, that the follower still
+        holds the lock under its fencing token. The row stays locked until
+        the transaction ends, so a takeover can't slip in before the commit
+
+        Args:
+            fence(tuple): (follower_id, fencing_token), None skips the check
+        """
+        if fence is None:
+            return True
+        follower_id, fencing_token = fence
+        row = conn.execute(sa.select([chain_status_table.c.status_id]).where(
+            chain_status_table.c.active_follower_id == follower_id).where(
+                chain_status_table.c.fencing_token == fencing_token)
+                           .with_for_update()).fetchone()
+        if row is None:
+            logger.warning('Follower %s lost the lock, fencing token %s is '
+                           'stale, not writing', follower_id, fencing_token)
+            return False
+        return True
+
+    def renew_follower_lock(self, follower_id=None, fencing_token=None, lock_timeout=5):
+        """ Extends the active follower's lock, without touching the block
+        status, as long as no other follower took over since fencing_token
+        was issued (even if the lock expired in between)
+
+        Returns:
+            bool: False if the lock was lost
+        """
+        now = datetime.datetime.now()
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                result = conn.execute(chain_status_table.update(values=dict(
+                    lock_renewed=now,
+                    lock_expires=now + datetime.timedelta(seconds=lock_timeout))).where(
+                        chain_status_table.c.active_follower_id == follower_id).where(
+                            chain_status_table.c.fencing_token == fencing_token))
+                tx.commit()
+                return result.rowcount == 1
+            except BaseException:
+                tx.rollback()
+                logger.exception('Failed to renew the follower lock')
+        return False
+
+    def release_follower_lock(self, follower_id=None, fencing_token=None):
+        """Lets a standby follower take over right away"""
+        now = datetime.datetime.now()
+        with self.acquire_conn() as conn:
+            try:
+                conn.execute(chain_status_table.update(values=dict(
+                    lock_renewed=now, lock_expires=now)).where(
+                        chain_status_table.c.active_follower_id == follower_id).where(
+                            chain_status_table.c.fencing_token == fencing_token))
+                return True
+            except BaseException:
+                logger.exception('Failed to release the follower lock')
+        return False
+
+    def touch_sender_worker(self, worker_id=None, lock_timeout=30):
+        """ Records that a sender worker is alive for lock_timeout seconds,
+        forgetting the workers that aren't
+
+        Returns:
+            int: the number of live workers, this one included
+        """
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lock_timeout)
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                conn.execute(sender_workers_table.delete().where(
+                    sender_workers_table.c.lock_expires <= now))
+                result = conn.execute(sender_workers_table.update(
+                    values=dict(lock_expires=expires)).where(
+                        sender_workers_table.c.worker_id == worker_id))
+                if result.rowcount == 0:
+                    conn.execute(sender_workers_table.insert(values=dict(
+                        worker_id=worker_id, lock_expires=expires)))
+                tx.commit()
+            except BaseException:
+                tx.rollback()
+                logger.exception('Failed to record sender worker %s',
+                                 worker_id)
+            query = sa.select([sa.func.count()]).select_from(
+                sender_workers_table).where(
+                    sender_workers_table.c.lock_expires > now).where(
+                        sender_workers_table.c.worker_id != worker_id)
+            return conn.execute(query).scalar() + 1
+
+    def get_sender_shards(self):
+        """ Returns the sender shard leases
+
+        Returns:
+            list: dicts with shard_id, worker_id and lock_expires
+        """
+        with self.acquire_conn() as conn:
+            query = sender_shards_table.select().order_by(
+                sender_shards_table.c.shard_id)
+            return [dict(row.items()) for row in conn.execute(query)]
+
+    def try_acquire_sender_shard(self, worker_id=None, shard_id=None,
+                                 lock_timeout=30):
+        """ Tries to lease a sender shard to the worker, only succeeds if the
+        shard is new or its lease expired, same as try_active_follower()
+
+        Returns:
+            bool: True if the worker holds the shard now
+        """
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lock_timeout)
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                row = conn.execute(sender_shards_table.select().where(
+                    sender_shards_table.c.shard_id == shard_id)).fetchone()
+                if row is None:
+                    conn.execute(sender_shards_table.insert(values=dict(
+                        shard_id=shard_id,
+                        worker_id=worker_id,
+                        lock_expires=expires)))
+                    tx.commit()
+                    return True
+                result = conn.execute(sender_shards_table.update(values=dict(
+                    worker_id=worker_id, lock_expires=expires)).where(
+                        sender_shards_table.c.shard_id == shard_id).where(
+                            sender_shards_table.c.lock_expires <= now))
+                tx.commit()
+                return result.rowcount == 1
+            except BaseException:
+                # most likely another worker inserted it first
+                tx.rollback()
+                logger.debug('Failed to acquire sender shard %s', shard_id)
+        return False
+
+    def renew_sender_shards(self, worker_id=None, shard_ids=(),
+                            lock_timeout=30):
+        """ Extends the worker's leases on the shards it still holds
+
+        Returns:
+            set: the shard ids the worker holds
+        """
+        if not shard_ids:
+            return set()
+        now = datetime.datetime.now()
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                conn.execute(sender_shards_table.update(values=dict(
+                    lock_expires=now +
+                    datetime.timedelta(seconds=lock_timeout))).where(
+                        sender_shards_table.c.worker_id == worker_id).where(
+                            sender_shards_table.c.shard_id.in_(shard_ids)).where(
+                                sender_shards_table.c.lock_expires > now))
+                tx.commit()
+            except BaseException:
+                tx.rollback()
+                logger.exception('Failed to renew sender shards')
+            query = sa.select([sender_shards_table.c.shard_id]).where(
+                sender_shards_table.c.worker_id == worker_id).where(
+                    sender_shards_table.c.lock_expires > now)
+            return set(row[0] for row in conn.execute(query))
+
+    def release_sender_shards(self, worker_id=None, shard_ids=()):
+        """Lets other workers take the shards right away"""
+        if not shard_ids:
+            return True
+        with self.acquire_conn() as conn:
+            try:
+                conn.execute(sender_shards_table.update(values=dict(
+                    lock_expires=datetime.datetime(1970, 1, 1))).where(
+                        sender_shards_table.c.worker_id == worker_id).where(
+                            sender_shards_table.c.shard_id.in_(shard_ids)))
+                return True
+            except BaseException:
+                logger.exception('Failed to release sender shards')
+        return False
+
     def _get_notifications(self,
                            table=None,
                            nid=None,
+                           before_id=None,
                            to_username=None,
                            created_before=None,
                            updated_after=None,
@@ -287,7 +606,8 @@ class YoDatabase:
         """Returns an SQLAlchemy result proxy with the notifications stored in wwwpoll table matching the specified params
 
        Keyword args:
-          nid(int):            notification id
+          nid(str):            notification id
+          before_id(str):      only return notifications older than this nid, pass the last nid of a page to get the next one
           username(str):       the username to lookup notifications for
           created_before(str): ISO8601-formatted timestamp
           updated_after(str):  ISO8601-formatted
@@ -302,7 +622,8 @@ class YoDatabase:
             try:
                 query = table.select()
                 if nid:
-                    return conn.execute(query.where(table.c.nid == nid))
+                    return conn.execute(
+                        query.where(table.c.nid == nid)).fetchall()
                 if to_username:
                     query = query.where(table.c.to_username == to_username)
                 if created_before:
@@ -314,8 +635,11 @@ class YoDatabase:
                 if read:
                     query = query.where(table.c.read == read)
                 if notify_types:
-                    query = query.filter(table.c.notify_type.in_(notify_types))
-                query = query.limit(limit)
+                    query = query.where(table.c.notify_type.in_(notify_types))
+                if before_id:
+                    query = query.where(table.c.nid < before_id)
+                # nids are time ordered, so this is newest first
+                query = query.order_by(table.c.nid.desc()).limit(limit)
                 resp = conn.execute(query)
                 if resp is not None:
                     return resp.fetchall()
@@ -324,34 +648,235 @@ class YoDatabase:
         return []
 
     def get_notifications(self, **kwargs):
+        """ Returns notifications, see _get_notifications for the params
+
+        A user's newest page is served from the recent notification cache
+        when there is one, see yo/cache.py. With an archive, a user's history continues into the archived
+        notifications once the hot table runs out of rows, for queries the
+        archive index can answer (by user, before_id and notify_types)
+        """
+        limit = kwargs.get('limit', 30)
+        if self.cache is None or not kwargs.get('to_username') or \
+                limit > self.cache.per_user or \
+                any(kwargs.get(k) for k in CACHE_UNSUPPORTED_FILTERS):
+            return self._query_notifications(**kwargs)
+        rows = self.cache.get(kwargs['to_username'], limit)
+        if rows is None:
+            rows = [
+                dict(row.items()) for row in self._query_notifications(
+                    **dict(kwargs, limit=self.cache.per_user))
+            ]
+            self.cache.fill(kwargs['to_username'], rows)
+        return rows[:limit]
+
+    def _query_notifications(self, **kwargs):
         kwargs['table'] = notifications_table
-        return self._get_notifications(**kwargs)
+        rows = self._get_notifications(**kwargs)
+        limit = kwargs.get('limit', 30)
+        if self.archive is None or len(rows) >= limit or \
+                not kwargs.get('to_username') or \
+                any(kwargs.get(k) for k in ARCHIVE_UNSUPPORTED_FILTERS):
+            return rows
+        before_id = rows[-1]['nid'] if rows else kwargs.get('before_id')
+        return list(rows) + self.archive.get_notifications(
+            kwargs['to_username'],
+            before_id=before_id,
+            notify_types=kwargs.get('notify_types'),
+            limit=limit - len(rows))
 
     def get_wwwpoll_notifications(self, **kwargs):
         kwargs['table'] = wwwpoll_table
         return self._get_notifications(**kwargs)
 
-    def get_wwwpoll_unsents(self):
-        retval = {}
-        with self.acquire_conn() as conn:
-            query = sa.sql.select([notifications_table.c.nid])
-            query = query.except_(
-                sa.sql.select([
-                    actions_table.c.nid
-                ]).where(actions_table.c.nid == notifications_table.c.nid))
-            select_response = conn.execute(query).fetchall()
-            logger.info(str(select_response))
+    def has_legacy_nids(self, table_name):
+        """ Whether a table still has uuid4 nids, not migrated to ULIDs
 
-            for nid in select_response:
+        New rows always get ULIDs, so once there are none left this isn't
+        checked again
+        """
+        if NidType.binary_storage:
+            return False  # migrate-ids --binary converted them all
+        if self.legacy_nids.get(table_name, True):
+            table = metadata.tables[table_name]
+            with self.acquire_conn() as conn:
                 row = conn.execute(
-                    sa.sql.select([
-                        notifications_table
-                    ]).where(notifications_table.c.nid == nid[0])).fetchone()
-                if not row['to_username'] in retval.keys():
-                    retval[row['to_username']] = []
-                retval[row['to_username']].append(dict(row.items()))
+                    sa.select([table.c.nid]).where(
+                        sa.func.length(table.c.nid) != ULID_LENGTH).limit(1)
+                ).fetchone()
+            self.legacy_nids[table_name] = row is not None
+        return self.legacy_nids[table_name]
+
+    def get_expired_rows(self, table_name, before, notify_type=None,
+                         limit=1000):
+        """ Returns the oldest rows of a table created before a time
+
+        Notifications and wwwpoll rows are found by nid, which is time
+        ordered, so this is a range scan of the primary key. That only holds
+        for ULIDs, see has_legacy_nids. Actions are found by created_at.
+
+        Keyword args:
+            table_name(str):              yo_notifications, yo_wwwpoll or yo_actions
+            before(datetime.datetime):    naive UTC cut-off
+            notify_type(str):             only rows of this type (not for actions)
+            limit(int):                   at most this many rows
+
+        Returns:
+            list: the rows as dicts, oldest first
+        """
+        table = metadata.tables[table_name]
+        query = table.select()
+        if table_name == 'yo_actions':
+            query = query.where(table.c.created_at < before).order_by(
+                table.c.created_at)
+        else:
+            query = query.where(table.c.nid < min_nid(before)).order_by(
+                table.c.nid)
+            if notify_type is not None:
+                query = query.where(table.c.notify_type == notify_type)
+        with self.acquire_conn() as conn:
+            return [dict(row.items())
+                    for row in conn.execute(query.limit(limit))]
+
+    def get_related_rows(self, table_name, nids):
+        """Returns the rows of a table referring to any of the nids"""
+        table = metadata.tables[table_name]
+        with self.acquire_conn() as conn:
+            return [
+                dict(row.items()) for row in conn.execute(
+                    table.select().where(table.c.nid.in_(nids)))
+            ]
+
+    def delete_rows(self, nids=None, aids=None):
+        """ Deletes notifications with their wwwpoll and action rows
+
+        Everything goes in one short transaction, actions first as they
+        refer to the notifications
+
+        Keyword args:
+            nids(list): delete these from all three tables
+            aids(list): also delete these actions
+
+        Returns:
+            True on success, False on error
+        """
+        if nids and self.cache is not None:
+            self.cache.invalidate_nids(nids)
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                if nids:
+                    conn.execute(actions_table.delete().where(
+                        actions_table.c.nid.in_(nids)))
+                    conn.execute(wwwpoll_table.delete().where(
+                        wwwpoll_table.c.nid.in_(nids)))
+                    conn.execute(notifications_table.delete().where(
+                        notifications_table.c.nid.in_(nids)))
+                if aids:
+                    conn.execute(actions_table.delete().where(
+                        actions_table.c.aid.in_(aids)))
+                tx.commit()
+                return True
+            except BaseException:
+                tx.rollback()
+                logger.exception('delete_rows failed')
+        return False
+
+    def get_wwwpoll_unsents(self, hash_ranges=None):
+        """ Returns the notifications without any action yet
+
+        Keyword args:
+            hash_ranges(list): (low, high) ranges of to_username_hash to
+                               load, e.g. a sender's shards, all if None.
+                               Rows stored before the hash existed are
+                               always included
+
+        Returns:
+            dict: username -> list of notifications, oldest first
+        """
+        retval = {}
+        with self.acquire_conn() as conn:
+            query = sa.sql.select([notifications_table]).where(~sa.exists(
+                sa.sql.select([actions_table.c.nid]).where(
+                    actions_table.c.nid == notifications_table.c.nid)))
+            if hash_ranges is not None:
+                column = notifications_table.c.to_username_hash
+                query = query.where(sa.or_(column.is_(None), *[
+                    sa.and_(column >= low, column < high)
+                    for low, high in hash_ranges
+                ]))
+            query = query.order_by(notifications_table.c.nid)
+            for row in conn.execute(query):
+                retval.setdefault(row['to_username'], []).append(
+                    dict(row.items()))
         return retval
 
+    def get_aggregate_notification(self,
+                                   to_username=None,
+                                   notify_type=None,
+                                   group_key=None,
+                                   created_after=None):
+        """ Returns the latest notification in an aggregation group
+
+        Keyword args:
+            to_username(str):                the recipient
+            notify_type(str):                the notification type
+            group_key(str):                  what the events are about, e.g. a permlink
+            created_after(datetime.datetime): ignore notifications created before this
+
+        Returns:
+            dict: the notification, None if there is none
+        """
+        with self.acquire_conn() as conn:
+            query = notifications_table.select().where(
+                notifications_table.c.to_username == to_username).where(
+                    notifications_table.c.notify_type == notify_type).where(
+                        notifications_table.c.group_key == group_key)
+            if created_after is not None:
+                query = query.where(
+                    notifications_table.c.created >= created_after)
+            query = query.order_by(
+                notifications_table.c.created.desc()).limit(1)
+            row = conn.execute(query).fetchone()
+            if row is not None:
+                return dict(row.items())
+        return None
+
+    def update_aggregate_notification(self, nid, json_data, fence=None):
+        """ Replaces the data of an aggregated notification in place
+
+        Updates the notification and, if it was already delivered, its
+        wwwpoll copy in the same transaction
+
+        Keyword args:
+            fence(tuple): (follower_id, fencing_token) of the follower
+                          writing, the update fails if it lost the lock
+
+        Returns:
+            True on success, False on error
+        """
+        now = datetime.datetime.now()
+        if self.cache is not None:
+            self.cache.invalidate_nids([nid])
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                if not self._holds_follower_lock(conn, fence):
+                    tx.rollback()
+                    return False
+                conn.execute(notifications_table.update().where(
+                    notifications_table.c.nid == nid).values(
+                        json_data=json_data, updated=now))
+                conn.execute(wwwpoll_table.update().where(
+                    wwwpoll_table.c.nid == nid).values(
+                        json_data=json_data, updated=now))
+                tx.commit()
+                return True
+            except BaseException:
+                tx.rollback()
+                logger.exception('update_aggregate_notification failed for %s',
+                                 nid)
+        return False
+
     def _create_notification(self, conn=None, table=None, **notification):
             tx = conn.begin()
             try:
@@ -375,28 +900,36 @@ class YoDatabase:
                                  notification)
             return False
 
-    def mark_sent(self, notification_object, transport):
+    def mark_sent(self, notification_object, transport, status='Sent'):
         """ Marks a notification as sent (updates sent_at timestamp)
+
+        Keyword args:
+            status(str): Sent, Skipped for a notification no transport of
+                         the user takes, Digest for one queued for an email
+                         digest or Deferred for one held back by an open
+                         circuit, only Sent counts for rate limits
         """
         now = datetime.datetime.now()
-        logger.debug('DB: Marking %s as sent via transport \'%s\' at %s', str(notification_object), transport, str(now))
+        logger.debug('DB: Marking %s as %s via transport \'%s\' at %s', str(notification_object), status, transport, str(now))
         with self.acquire_conn() as conn:
              tx = conn.begin()
              try:
                 query = actions_table.insert(values=dict(nid=notification_object['nid'],
                                                          transport=transport,
                                                          to_username=notification_object['to_username'],
-                                                         status='Sent',
+                                                         status=status,
                                                          created_at=now,
                                                          priority_level=notification_object['priority_level']))
                 conn.execute(query)
                 tx.commit()
              except:
-                logger.exception('Exception occurred while marking %s as sent', nid)
+                logger.exception('Exception occurred while marking %s as sent', notification_object['nid'])
                 tx.rollback()
 
     def wwwpoll_mark_shown(self, nid):
         logger.debug('wwwpoll: marking %s as shown', nid)
+        if self.cache is not None:
+            self.cache.invalidate_nids([nid])
         with self.acquire_conn() as conn:
             try:
                 query = wwwpoll_table.update() \
@@ -410,6 +943,8 @@ class YoDatabase:
 
     def wwwpoll_mark_unshown(self, nid):
         logger.debug('wwwpoll: marking %s as unshown', nid)
+        if self.cache is not None:
+            self.cache.invalidate_nids([nid])
         with self.acquire_conn() as conn:
             try:
                 query = wwwpoll_table.update() \
@@ -423,6 +958,8 @@ class YoDatabase:
 
     def wwwpoll_mark_read(self, nid):
         logger.debug('wwwpoll: marking %s as read', nid)
+        if self.cache is not None:
+            self.cache.invalidate_nids([nid])
         with self.acquire_conn() as conn:
             try:
                 query = wwwpoll_table.update() \
@@ -436,6 +973,8 @@ class YoDatabase:
 
     def wwwpoll_mark_unread(self, nid):
         logger.debug('wwwpoll: marking %s as unread', nid)
+        if self.cache is not None:
+            self.cache.invalidate_nids([nid])
         with self.acquire_conn() as conn:
             try:
                 query = wwwpoll_table.update() \
@@ -467,6 +1006,8 @@ class YoDatabase:
             except BaseException:
                 logger.exception('create_user failed')
                 success = False
+        if success:
+            self._notify_user_settings_listeners(username, transports)
         return success
 
     def get_user_transports(self, username=None, retry=False):
@@ -516,18 +1057,55 @@ class YoDatabase:
                 stmt = user_settings_table.update().where(
                     user_settings_table.c.username == username). \
                     values(transports=json.dumps(transports))
-                result = conn.execute(stmt).fetchone()
-                success = True
+                result = conn.execute(stmt)
+                success = result.rowcount > 0
             except sa.exc.SQLAlchemyError as e:
                 logger.info(
                        'Exception occurred trying to update transports for user %s to %s: %s',
                     username, str(transports),str(e))
-        if not success:
+        if success:
+            self._notify_user_settings_listeners(username, transports)
+        else:
             result = self.create_user(username, transports=transports)
             if result:
                 success = True
         return success
 
+    def get_user_settings(self, updated_since=None):
+        """ Returns the transports of every user, or only those updated since
+        the given time
+
+        Keyword args:
+            updated_since(datetime.datetime): if set, only rows with an updated
+                                              timestamp at or after this
+
+        Returns:
+            list: dicts with username, transports (decoded) and updated keys
+        """
+        retval = []
+        with self.acquire_conn() as conn:
+            query = sa.sql.select([
+                user_settings_table.c.username,
+                user_settings_table.c.transports,
+                user_settings_table.c.updated
+            ])
+            if updated_since is not None:
+                query = query.where(
+                    user_settings_table.c.updated >= updated_since)
+            for row in conn.execute(query):
+                try:
+                    transports = json.loads(row['transports'])
+                except ValueError:
+                    logger.exception('invalid transports for user %s',
+                                     row['username'])
+                    continue
+                retval.append({
+                    'username': row['username'],
+                    'transports': transports,
+                    'updated': row['updated']
+                })
+        return retval
+
     def get_priority_count(self,
                            to_username,
                            priority,
@@ -564,6 +1142,7 @@ class YoDatabase:
                     actions_table.c.priority_level >= int(priority))
                 query = query.where(
                     actions_table.c.created_at >= start_time)
+                query = query.where(actions_table.c.status == 'Sent')
                 select_response = conn.execute(query).fetchall()
                 if select_response is None: retval = 0
                 logger.debug('Existing notifications at priority %d for user %s: %s', int(priority), to_username, str(select_response))
@@ -573,6 +1152,139 @@ class YoDatabase:
         if retval < 0: return 0
         return retval
 
+    def get_recent_sends(self, since):
+        """ Returns the sends recorded in yo_actions since a time, for
+        warm-starting rate limits
+
+        Args:
+            since(float): epoch seconds
+
+        Returns:
+            list: (to_username, priority_level, epoch seconds) tuples
+        """
+        # actions are timestamped in local time by mark_sent
+        since = datetime.datetime.fromtimestamp(since)
+        query = sa.select([
+            actions_table.c.to_username, actions_table.c.priority_level,
+            actions_table.c.created_at
+        ]).where(actions_table.c.created_at >= since).where(
+            actions_table.c.status == 'Sent')
+        with self.acquire_conn() as conn:
+            return [(row[0], row[1], row[2].timestamp())
+                    for row in conn.execute(query)]
+
+    def get_digest_users(self):
+        """Returns the usernames with notifications queued for a digest"""
+        query = sa.select([actions_table.c.to_username]).where(
+            actions_table.c.status == 'Digest').distinct()
+        with self.acquire_conn() as conn:
+            return [row[0] for row in conn.execute(query)]
+
+    def get_digest_notifications(self, usernames):
+        """ Returns the notifications queued for the users' digests
+
+        Returns:
+            dict: username -> notifications as dicts, oldest first
+        """
+        query = sa.select([notifications_table]).select_from(
+            notifications_table.join(
+                actions_table,
+                actions_table.c.nid == notifications_table.c.nid)).where(
+                    actions_table.c.status == 'Digest').where(
+                        actions_table.c.to_username.in_(usernames)).order_by(
+                            notifications_table.c.nid)
+        retval = {}
+        with self.acquire_conn() as conn:
+            for row in conn.execute(query):
+                retval.setdefault(row['to_username'], []).append(
+                    dict(row.items()))
+        return retval
+
+    def update_digest_actions(self, nids, status):
+        """ Moves the queued digest actions of notifications to a new status,
+        Digested once sent
+
+        Returns:
+            True on success, False on error
+        """
+        with self.acquire_conn() as conn:
+            try:
+                conn.execute(actions_table.update().where(
+                    actions_table.c.nid.in_(nids)).where(
+                        actions_table.c.status == 'Digest').values(
+                            status=status))
+                return True
+            except BaseException:
+                logger.exception('update_digest_actions failed')
+        return False
+
+    def mark_deferred(self, notifications, transport):
+        """ Records notifications held back while a transport's circuit is
+        open, they're picked up by get_deferred_notifications once it closes
+
+        Returns:
+            True on success, False on error
+        """
+        if not notifications:
+            return True
+        now = datetime.datetime.now()
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                conn.execute(actions_table.insert(), [
+                    dict(
+                        nid=notification['nid'],
+                        transport=transport,
+                        to_username=notification['to_username'],
+                        status='Deferred',
+                        created_at=now,
+                        priority_level=notification['priority_level'])
+                    for notification in notifications
+                ])
+                tx.commit()
+                return True
+            except BaseException:
+                tx.rollback()
+                logger.exception('mark_deferred failed for %d notifications',
+                                 len(notifications))
+        return False
+
+    def get_deferred_notifications(self, transport, limit=1000):
+        """ Returns the notifications deferred for a transport, oldest first
+
+        Returns:
+            list: notifications as dicts
+        """
+        query = sa.select([notifications_table]).select_from(
+            notifications_table.join(
+                actions_table,
+                actions_table.c.nid == notifications_table.c.nid)).where(
+                    actions_table.c.status == 'Deferred').where(
+                        actions_table.c.transport == transport).order_by(
+                            notifications_table.c.nid).limit(limit)
+        with self.acquire_conn() as conn:
+            return [dict(row.items()) for row in conn.execute(query)]
+
+    def update_deferred_actions(self, nids, transport, status):
+        """ Moves the deferred actions of notifications for a transport to a
+        new status, Sent once sent
+
+        Returns:
+            True on success, False on error
+        """
+        with self.acquire_conn() as conn:
+            try:
+                conn.execute(actions_table.update().where(
+                    actions_table.c.nid.in_(nids)).where(
+                        actions_table.c.transport == transport).where(
+                            actions_table.c.status == 'Deferred').values(
+                                status=status,
+                                created_at=datetime.datetime.now()))
+                return True
+            except BaseException:
+                logger.exception('update_deferred_actions failed')
+        return False
+
     def create_wwwpoll_notification(self,
                                     notify_id=None,
                                     notify_type=None,
@@ -585,7 +1297,7 @@ class YoDatabase:
         """ Creates a new notification in the wwwpoll table
 
         Keyword Args:
-           notify_id(str):    if not provided, will be autogenerated as a UUID
+           notify_id(str):    if not provided, will be autogenerated as a ULID
            notify_type(str):  the notification type
            created_time(str): ISO8601-formatted timestamp, if not set current time will be used
            json_data(str):    what to include in the data field of the stored notification, must be JSON formatted
@@ -598,7 +1310,7 @@ class YoDatabase:
         """
 
         if notify_id is None:
-            notify_id = str(uuid.uuid4)
+            notify_id = new_nid()
         if created_time is None:
             created_time = datetime.datetime.now()
         notification = {
@@ -634,25 +1346,107 @@ class YoDatabase:
                     notification)
         return success
 
-    def create_notification(self, **notification_object):
+    def deliver_wwwpoll(self, nids):
+        """ Copies notifications into the wwwpoll table and marks them sent
+
+        Both are set-based, INSERT ... SELECT from yo_notifications, in one
+        transaction. Notifications already in wwwpoll are only marked sent.
+
+        Args:
+            nids(list): the notifications to deliver
+
+        Returns:
+            bool: True if all were delivered
+        """
+        if not nids:
+            return True
+        nids = list(set(nids))
+        now = datetime.datetime.now()
+        with self.acquire_conn() as conn:
+            tx = conn.begin()
+            try:
+                delivered = set(
+                    row[0] for row in conn.execute(
+                        sa.select([wwwpoll_table.c.nid]).where(
+                            wwwpoll_table.c.nid.in_(nids))))
+                new_nids = [nid for nid in nids if nid not in delivered]
+                if new_nids:
+                    conn.execute(
+                        wwwpoll_table.insert().from_select(
+                            [
+                                'nid', 'notify_type', 'to_username',
+                                'from_username', 'json_data', 'created',
+                                'updated', 'read', 'shown'
+                            ],
+                            sa.select([
+                                notifications_table.c.nid,
+                                notifications_table.c.notify_type,
+                                notifications_table.c.to_username,
+                                sa.func.coalesce(
+                                    notifications_table.c.from_username, ''),
+                                notifications_table.c.json_data,
+                                sa.literal(now, sa.DateTime),
+                                sa.literal(now, sa.DateTime),
+                                sa.false(),
+                                sa.false()
+                            ]).where(notifications_table.c.nid.in_(new_nids))))
+                conn.execute(
+                    actions_table.insert().from_select(
+                        [
+                            'nid', 'to_username', 'transport',
+                            'priority_level', 'status', 'created_at'
+                        ],
+                        sa.select([
+                            notifications_table.c.nid,
+                            notifications_table.c.to_username,
+                            sa.literal('wwwpoll', sa.String),
+                            notifications_table.c.priority_level,
+                            sa.literal('Sent', sa.String),
+                            sa.literal(now, sa.DateTime)
+                        ]).where(notifications_table.c.nid.in_(nids))))
+                tx.commit()
+                return True
+            except BaseException:
+                tx.rollback()
+                logger.exception('Failed to deliver %d wwwpoll notifications',
+                                 len(nids))
+        return False
+
+    def create_notification(self, fence=None, **notification_object):
         """ Creates an unsent notification in the DB
 
         Keyword Args:
+           fence(tuple):              (follower_id, fencing_token) of the
+                                      follower writing, nothing is stored if
+                                      it lost the lock
            notification_object(dict): the actual notification to create+store
 
         Returns:
           True on success, False on error
         """
         if 'nid' not in notification_object.keys():
-            notification_object['nid'] = str(uuid.uuid4())
+            notification_object['nid'] = new_nid()
+        if notification_object.get('to_username'):
+            notification_object['to_username_hash'] = username_hash(
+                notification_object['to_username'])
         with self.acquire_conn() as conn:
             tx = conn.begin()
             try:
+                if not self._holds_follower_lock(conn, fence):
+                    tx.rollback()
+                    return False
                 _ = conn.execute(notifications_table.insert(),
                                  **notification_object)
                 tx.commit()
                 logger.info('Created new notification object: %s',
                             notification_object)
+                if self.cache is not None and notification_object.get(
+                        'to_username') in self.cache.users:
+                    # with the column defaults, as a read would return it
+                    row = conn.execute(notifications_table.select().where(
+                        notifications_table.c.nid ==
+                        notification_object['nid'])).fetchone()
+                    self.cache.push(dict(row.items()))
                 return True
             except Exception as e:
                 if is_duplicate_entry_error(e):
@@ -661,3 +1455,6 @@ class YoDatabase:
                     logger.info('failed to add notification')
                     tx.rollback()
         return False
+
+
+instrument_methods(YoDatabase, DB_QUERY_SECONDS, exclude=('acquire_conn', 'add_user_settings_listener'))
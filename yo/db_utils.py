@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 import argparse
+import datetime
 import json
 import logging
 
 import dateutil.parser
+import sqlalchemy as sa
 
+from . import ids
+from .db import INDEX_PROFILES
 from .db import YoDatabase
+from .db import apply_index_profile
 from .db import metadata
 
 logging.basicConfig(level=logging.INFO)
@@ -63,6 +68,161 @@ def init_db(args=None,
         return db  # if called somewhere else like a test, return the db
 
 
+# tables with an nid column, the first one owning the nid
+NID_TABLES = ('yo_notifications', 'yo_wwwpoll', 'yo_actions')
+
+
+def convert_nid(nid, created, binary):
+    """Returns the nid in the target format, from any of the formats"""
+    if isinstance(nid, (bytes, bytearray)):
+        nid = ids.from_bytes(nid)
+    elif not ids.is_ulid(nid):
+        if isinstance(created, str):
+            created = dateutil.parser.parse(created)
+        nid = ids.from_legacy(nid, created or datetime.datetime.utcnow())
+    return ids.to_bytes(nid) if binary else nid
+
+
+def migrate_ids(args=None, db_url=None, binary=False, batch_size=1000):
+    """ Rewrites nids to time ordered ULIDs, optionally in binary form
+
+    uuid4 nids become ULIDs with the timestamp taken from the row's created
+    column, so existing rows keep their order. yo_wwwpoll and yo_actions rows
+    are updated in the same transaction as their notification. Safe to run
+    again, rows already in the target format are skipped.
+
+    Start yo with binary_ids=1 in the [database] section after migrating
+    with binary set.
+    """
+    if args:
+        db_url = db_url or args.db_url
+        binary = args.binary
+        batch_size = args.batch_size
+    db = YoDatabase(db_url)
+    target_length = ids.BINARY_LENGTH if binary else ids.ULID_LENGTH
+    mysql = db.backend == 'mysql'
+    migrated = 0
+    with db.acquire_conn() as conn:
+        if mysql:
+            # the primary keys are rewritten under yo_actions' foreign key
+            conn.execute('SET FOREIGN_KEY_CHECKS=0')
+            for table in NID_TABLES:
+                conn.execute('ALTER TABLE %s MODIFY nid VARBINARY(36)' % table)
+        for owner in NID_TABLES[:2]:
+            # wwwpoll rows can exist without a notification, so it is
+            # migrated on its own after the notifications
+            select = sa.text('SELECT nid, created FROM %s '
+                             'WHERE length(nid) != :length LIMIT :limit' %
+                             owner)
+            while True:
+                rows = conn.execute(
+                    select, length=target_length, limit=batch_size).fetchall()
+                if not rows:
+                    break
+                changes = [{
+                    'old': row[0],
+                    'new': convert_nid(row[0], row[1], binary)
+                } for row in rows]
+                tx = conn.begin()
+                for table in NID_TABLES[NID_TABLES.index(owner):]:
+                    conn.execute(
+                        sa.text('UPDATE %s SET nid = :new WHERE nid = :old' %
+                                table), changes)
+                tx.commit()
+                migrated += len(changes)
+                logger.info('Migrated %d nids', migrated)
+        if mysql:
+            for table in NID_TABLES:
+                conn.execute('ALTER TABLE %s MODIFY nid %s' % (
+                    table, 'BINARY(16)' if binary else 'VARCHAR(36)'))
+            conn.execute('SET FOREIGN_KEY_CHECKS=1')
+    logger.info('Finished migrating %d nids', migrated)
+    if not args:
+        return migrated
+
+
+def sync_indexes(args=None, db_url=None, profile='full', drop=False):
+    """ Creates the indexes of an index profile missing from a database
+
+    With drop set, indexes of the notification tables that are not in the
+    profile are dropped too (only ones named ix_*, constraints are kept)
+
+    Returns:
+        dict: lists of the created and dropped index names
+    """
+    if args:
+        db_url = db_url or args.db_url
+        profile = args.profile
+        drop = args.drop
+    apply_index_profile(profile)
+    db = YoDatabase(db_url)
+    inspector = sa.inspect(db.engine)
+    changes = {'created': [], 'dropped': []}
+    for table_name in INDEX_PROFILES[profile]:
+        table = metadata.tables[table_name]
+        existing = {i['name']: i for i in inspector.get_indexes(table_name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index %s', index.name)
+                index.create(bind=db.engine)
+                changes['created'].append(index.name)
+        if not drop:
+            continue
+        wanted = {index.name for index in table.indexes}
+        for name, info in existing.items():
+            if name in wanted or not name.startswith('ix_'):
+                continue
+            logger.info('Dropping index %s', name)
+            index = sa.Index(name, *[table.c[c] for c in info['column_names']])
+            try:
+                index.drop(bind=db.engine)
+            finally:
+                table.indexes.discard(index)
+            changes['dropped'].append(name)
+    if not args:
+        return changes
+
+
+def sync_columns(args=None, db_url=None):
+    """ Adds the columns of the schema missing from an existing database,
+    e.g. yo_chain_status.fencing_token, and the named indexes that go with
+    them, e.g. yo_notification_group_idx
+
+    The ix_* indexes of the index profiles are left to sync_indexes
+
+    Returns:
+        list: the added columns and indexes as table.name
+    """
+    db_url = db_url or args.db_url
+    db = YoDatabase(db_url)
+    inspector = sa.inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # name, type, server default and NOT NULL as the dialect has them
+            ddl = sa.schema.CreateColumn(column).compile(
+                dialect=db.engine.dialect)
+            logger.info('Adding column %s.%s', table.name, column.name)
+            with db.engine.connect() as conn:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl))
+            added.append('%s.%s' % (table.name, column.name))
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing or index.name.startswith('ix_'):
+                continue
+            logger.info('Creating index %s', index.name)
+            index.create(bind=db.engine)
+            added.append('%s.%s' % (table.name, index.name))
+    if not args:
+        return added
+
+
 def main():
     parser = argparse.ArgumentParser(description="Yo database utils")
     parser.add_argument('db_url', type=str)
@@ -73,6 +233,26 @@ def main():
 
     reset_sub = subparsers.add_parser('reset')
     reset_sub.set_defaults(func=reset_db)
+
+    indexes_sub = subparsers.add_parser('indexes')
+    indexes_sub.add_argument(
+        '--profile', type=str, default='full', choices=sorted(INDEX_PROFILES))
+    indexes_sub.add_argument(
+        '--drop',
+        action='store_true',
+        help='drop notification table indexes not in the profile')
+    indexes_sub.set_defaults(func=sync_indexes)
+
+    columns_sub = subparsers.add_parser('columns')
+    columns_sub.set_defaults(func=sync_columns)
+
+    migrate_ids_sub = subparsers.add_parser('migrate-ids')
+    migrate_ids_sub.add_argument(
+        '--binary',
+        action='store_true',
+        help='store nids as 16 bytes, then run yo with binary_ids=1')
+    migrate_ids_sub.add_argument('--batch-size', type=int, default=1000)
+    migrate_ids_sub.set_defaults(func=migrate_ids)
     args = parser.parse_args()
     args.func(args=args)
 
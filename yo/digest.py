@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+""" Email digests of rate limited notifications
+
+    When the sender's rate limit turns down a LOW or MARKETING notification
+    for a user who gets that type by email, the email is queued (a yo_actions
+    row with status Digest) instead of dropped. The DigestScheduler sends
+    each user one email per period listing everything queued for them,
+    rendered from the digest template.
+
+    Users are spread over `slices` time slices of the period by a hash of
+    their name, and every slice only sends the digests of its own users, so
+    the emails go out at an even rate rather than all at once.
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+from .metrics import TRANSPORT_SENDS
+
+logger = logging.getLogger(__name__)
+
+DIGEST_TYPE = 'digest'
+
+
+class DigestScheduler:
+    def __init__(self,
+                 db,
+                 send,
+                 routes,
+                 owns=None,
+                 period=86400,
+                 slices=96,
+                 max_items=50,
+                 batch_size=100):
+        """ Sends the queued digests, one slice of users at a time
+
+        Args:
+            db(YoDatabase):         where digests are queued
+            send(coroutine):        sends an email, send_notification args
+            routes(RoutingCache):   to find the users' email addresses
+        Keyword args:
+            owns(callable):         whether a username is ours to send to,
+                                    for sharded senders
+            period(float):          seconds between two digests of a user
+            slices(int):            the period is split in this many slices
+            max_items(int):         notifications listed in full per digest
+            batch_size(int):        users loaded from the database at once
+        """
+        self.db = db
+        self.send = send
+        self.routes = routes
+        self.owns = owns
+        self.period = period
+        self.slices = slices
+        self.max_items = max_items
+        self.batch_size = batch_size
+
+    @property
+    def slice_seconds(self):
+        return self.period / self.slices
+
+    def slice_of(self, username):
+        return zlib.crc32(username.encode('utf-8')) % self.slices
+
+    def current_slice(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.slice_seconds) % self.slices
+
+    def email_address(self, username):
+        for transports in self.routes.routes(username).values():
+            for transport_name, sub_data in transports:
+                if transport_name == 'email':
+                    return sub_data
+        return None
+
+    def digest_data(self, username, notifications):
+        items = [{
+            'nid': notification['nid'],
+            'notify_type': notification['notify_type'],
+            'from_username': notification['from_username'],
+            'created': notification['created'],
+            'data': json.loads(notification['json_data'])
+        } for notification in notifications[:self.max_items]]
+        return {
+            'username': username,
+            'count': len(notifications),
+            'notifications': items,
+            'more': max(0, len(notifications) - self.max_items)
+        }
+
+    async def send_digest(self, username, notifications):
+        """ Sends one user's digest and marks its notifications Digested
+
+        Returns:
+            True if an email went out
+        """
+        nids = [notification['nid'] for notification in notifications]
+        address = self.email_address(username)
+        if address is None:
+            # email was turned off since these were queued
+            self.db.update_digest_actions(nids, 'Skipped')
+            return False
+        try:
+            await self.send(
+                to_subdata=address,
+                to_username=username,
+                notify_type=DIGEST_TYPE,
+                data=self.digest_data(username, notifications))
+        except Exception:  # pylint: disable=broad-except
+            # left queued for the next period
+            TRANSPORT_SENDS.inc('email', 'failed')
+            logger.exception('Failed to send digest to %s', username)
+            return False
+        TRANSPORT_SENDS.inc('email', DIGEST_TYPE)
+        self.db.update_digest_actions(nids, 'Digested')
+        return True
+
+    async def run_slice(self, slice_number):
+        """ Sends the digests of the users in a slice
+
+        Returns:
+            int: the number of digests sent
+        """
+        usernames = [
+            username for username in self.db.get_digest_users()
+            if self.slice_of(username) == slice_number and
+            (self.owns is None or self.owns(username))
+        ]
+        sent = 0
+        for start in range(0, len(usernames), self.batch_size):
+            queued = self.db.get_digest_notifications(
+                usernames[start:start + self.batch_size])
+            for username, notifications in queued.items():
+                sent += await self.send_digest(username, notifications)
+        logger.info('Sent %d digests for slice %d', sent, slice_number)
+        return sent
+
+    async def run(self):
+        while True:
+            now = time.time()
+            try:
+                await self.run_slice(self.current_slice(now))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Exception occurred in run_slice')
+            next_slice = (now // self.slice_seconds + 1) * self.slice_seconds
+            await asyncio.sleep(max(0, next_slice - time.time()))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+""" Time-ordered notification IDs
+
+    nids are ULIDs: a 48 bit millisecond timestamp followed by 80 random
+    bits, written as 26 characters of Crockford's base32. They sort by
+    creation time both as strings and as 16 byte binary, so inserts land at
+    the end of the primary key index and an nid works as a pagination
+    cursor.
+
+    Older databases have uuid4 nids, see migrate-ids in db_utils.
+"""
+import datetime
+import os
+import uuid
+
+import sqlalchemy as sa
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+DECODE = {c: i for i, c in enumerate(ALPHABET)}
+DECODE.update({c.lower(): i for c, i in DECODE.items()})
+
+ULID_LENGTH = 26
+BINARY_LENGTH = 16
+RANDOM_BITS = 80
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_millis(timestamp):
+    """Milliseconds since the epoch for a naive UTC datetime"""
+    return int((timestamp - EPOCH).total_seconds() * 1000)
+
+
+def encode(value):
+    chars = []
+    for _ in range(ULID_LENGTH):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(nid):
+    value = 0
+    for char in nid:
+        value = (value << 5) | DECODE[char]
+    return value
+
+
+def is_ulid(nid):
+    return isinstance(nid, str) and len(nid) == ULID_LENGTH and all(
+        c in DECODE for c in nid)
+
+
+class NidGenerator:
+    """ Makes ULIDs, increasing the random part for IDs made in the same
+    millisecond so they stay in order
+    """
+
+    def __init__(self):
+        self.last_millis = -1
+        self.last_random = 0
+
+    def new(self, timestamp=None, randomness=None):
+        """ Returns a new nid
+
+        Keyword args:
+            timestamp(datetime.datetime): naive UTC time, defaults to now
+            randomness(int):              the low 80 bits, random if None
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow()
+        millis = to_millis(timestamp)
+        if randomness is None:
+            if millis == self.last_millis:
+                randomness = (self.last_random + 1) % (1 << RANDOM_BITS)
+            else:
+                randomness = int.from_bytes(os.urandom(10), 'big')
+            self.last_millis, self.last_random = millis, randomness
+        return encode((millis << RANDOM_BITS) | randomness)
+
+
+GENERATOR = NidGenerator()
+
+
+def new_nid(timestamp=None, randomness=None):
+    return GENERATOR.new(timestamp=timestamp, randomness=randomness)
+
+
+def nid_time(nid):
+    """The naive UTC datetime a ULID was made at"""
+    return EPOCH + datetime.timedelta(
+        milliseconds=decode(nid) >> RANDOM_BITS)
+
+
+def min_nid(timestamp):
+    """The smallest nid made at timestamp, for range queries by time"""
+    return encode(to_millis(timestamp) << RANDOM_BITS)
+
+
+def from_legacy(nid, created):
+    """ Converts a uuid4 nid into a ULID made at created
+
+    The random part comes from the uuid so distinct uuids stay distinct
+    """
+    randomness = uuid.UUID(nid).int & ((1 << RANDOM_BITS) - 1)
+    return new_nid(timestamp=created, randomness=randomness)
+
+
+def to_bytes(nid):
+    return decode(nid).to_bytes(BINARY_LENGTH, 'big')
+
+
+def from_bytes(value):
+    return encode(int.from_bytes(value, 'big'))
+
+
+class NidType(sa.types.TypeDecorator):
+    """ Column type for nids
+
+    Stored as the 26 character string by default, or as 16 bytes once
+    use_binary_storage(True) was called, which must happen before the
+    tables are first used. Either way nids are strings in Python.
+    """
+    impl = sa.String(36)
+    binary_storage = False
+
+    def load_dialect_impl(self, dialect):
+        if self.binary_storage:
+            return dialect.type_descriptor(sa.types.BINARY(BINARY_LENGTH))
+        return dialect.type_descriptor(sa.String(36))
+
+    def process_bind_param(self, value, dialect):
+        if self.binary_storage and is_ulid(value):
+            return to_bytes(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (bytes, bytearray)):
+            return from_bytes(value)
+        return value
+
+
+def use_binary_storage(enabled):
+    NidType.binary_storage = bool(enabled)
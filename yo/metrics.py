@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+""" In-process metrics, exported in the Prometheus text format
+
+    Everything here is updated from the event loop thread only, so the
+    metrics are plain counters in dicts and lists with no locking. An
+    observation is a dict lookup and a couple of additions.
+"""
+import bisect
+import functools
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# default latency buckets in seconds, from 0.5ms to 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.metric_type)
+        ]
+        for labels in sorted(self.values.keys()):
+            lines.extend(self.render_sample(labels))
+        return lines
+
+    def render_sample(self, labels):
+        return [
+            '%s%s %s' % (self.name, format_labels(self.labelnames, labels),
+                         format_value(self.values[labels]))
+        ]
+
+    def reset(self):
+        self.values.clear()
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def get(self, *labels):
+        return self.values.get(labels)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # values[labels] is [per-bucket counts..., +Inf count, sum]
+        sample = self.values.get(labels)
+        if sample is None:
+            sample = self.values[labels] = [0] * (len(self.buckets) + 2)
+        sample[bisect.bisect_left(self.buckets, value)] += 1
+        sample[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Context manager observing the wall time of its block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        sample = self.values.get(labels)
+        return sum(sample[:-1]) if sample else 0
+
+    def render_sample(self, labels):
+        sample = self.values[labels]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'), ),
+                                sample[:-1]):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(
+                self.labelnames, labels, ('le', format_value(bound))),
+                                              cumulative))
+        label_str = format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_str,
+                                      format_value(float(sample[-1]))))
+        lines.append('%s_count%s %d' % (self.name, label_str, cumulative))
+        return lines
+
+
+class Summary(Metric):
+    """Quantiles over a sliding window of the most recent observations"""
+    metric_type = 'summary'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 quantiles=(0.5, 0.9, 0.99), max_samples=1024):
+        super().__init__(name, documentation, labelnames)
+        self.quantiles = quantiles
+        self.max_samples = max_samples
+
+    def observe(self, value, *labels):
+        # values[labels] is [recent samples, sum, count]
+        sample = self.values.get(labels)
+        if sample is None:
+            sample = self.values[labels] = [
+                deque(maxlen=self.max_samples), 0, 0
+            ]
+        sample[0].append(value)
+        sample[1] += value
+        sample[2] += 1
+
+    def get_quantiles(self, *labels):
+        sample = self.values.get(labels)
+        if not sample:
+            return {}
+        window = sorted(sample[0])
+        return {
+            q: window[min(int(q * len(window)), len(window) - 1)]
+            for q in self.quantiles
+        }
+
+    def render_sample(self, labels):
+        sample = self.values[labels]
+        lines = [
+            '%s%s %s' % (self.name, format_labels(
+                self.labelnames, labels, ('quantile', format_value(q))),
+                         format_value(float(v)))
+            for q, v in sorted(self.get_quantiles(*labels).items())
+        ]
+        label_str = format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_str,
+                                      format_value(float(sample[1]))))
+        lines.append('%s_count%s %d' % (self.name, label_str, sample[2]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+API_REQUEST_SECONDS = REGISTRY.register(
+    Histogram('yo_api_request_seconds', 'Time spent handling JSON-RPC calls',
+              ('method', )))
+DB_QUERY_SECONDS = REGISTRY.register(
+    Histogram('yo_db_method_seconds', 'Time spent in YoDatabase methods',
+              ('method', )))
+FOLLOWER_OP_SECONDS = REGISTRY.register(
+    Histogram('yo_follower_op_seconds',
+              'Time spent handling blockchain ops in the follower',
+              ('op_type', )))
+TRANSPORT_SEND_SECONDS = REGISTRY.register(
+    Histogram('yo_transport_send_seconds',
+              'Time spent sending a notification via a transport',
+              ('transport', )))
+TRANSPORT_SENDS = REGISTRY.register(
+    Counter('yo_transport_sends_total',
+            'Notifications sent via each transport by outcome',
+            ('transport', 'status')))
+TRANSPORT_CIRCUIT_STATE = REGISTRY.register(
+    Gauge('yo_transport_circuit_state',
+          'Circuit breaker of each transport, 0 closed, 1 half-open, 2 open',
+          ('transport', )))
+TRANSPORT_CONCURRENCY = REGISTRY.register(
+    Gauge('yo_transport_concurrency_limit',
+          'Batches of each transport allowed in flight at once',
+          ('transport', )))
+SENDER_SHARDS_OWNED = REGISTRY.register(
+    Gauge('yo_sender_shards_owned',
+          'Shards of the notification senders this worker holds the lease on'))
+RATELIMIT_DECISIONS = REGISTRY.register(
+    Counter('yo_ratelimit_decisions_total',
+            'Rate limit decisions by priority level and outcome',
+            ('priority', 'decision')))
+FOLLOWER_DROPPED = REGISTRY.register(
+    Counter('yo_follower_dropped_notifications_total',
+            'Notifications not stored as no transport of the user takes them',
+            ('notify_type', )))
+FOLLOWER_AGGREGATED = REGISTRY.register(
+    Counter('yo_follower_aggregated_notifications_total',
+            'Events merged into an existing notification instead of stored',
+            ('notify_type', )))
+RETENTION_ROWS = REGISTRY.register(
+    Counter('yo_retention_expired_rows_total',
+            'Rows moved out of the hot tables by the retention service',
+            ('table', )))
+NOTIFICATION_CACHE_LOOKUPS = REGISTRY.register(
+    Counter('yo_notification_cache_lookups_total',
+            'get_notifications lookups in the recent notification cache',
+            ('result', )))
+NOTIFICATION_CACHE_BYTES = REGISTRY.register(
+    Gauge('yo_notification_cache_bytes',
+          'Estimated memory held by the recent notification cache'))
+NOTIFICATION_CACHE_USERS = REGISTRY.register(
+    Gauge('yo_notification_cache_users',
+          'Users in the recent notification cache'))
+BLOCKS_PROCESSED = REGISTRY.register(
+    Counter('yo_follower_blocks_processed_total',
+            'Blocks processed by the blockchain follower'))
+FOLLOWER_LAST_BLOCK = REGISTRY.register(
+    Gauge('yo_follower_last_block', 'Last block processed by the follower'))
+FOLLOWER_LAG_BLOCKS = REGISTRY.register(
+    Gauge('yo_follower_lag_blocks',
+          'How many blocks the follower is behind the head block'))
+FOLLOWER_ACTIVE = REGISTRY.register(
+    Gauge('yo_follower_active',
+          '1 while this node is the active blockchain follower'))
+FOLLOWER_FAILOVER_SECONDS = REGISTRY.register(
+    Histogram(
+        'yo_follower_failover_seconds',
+        'Time from the last sign of life of the previous active follower '
+        'to this one taking over',
+        buckets=(0.5, 1, 2, 5, 10, 15, 20, 30, 60, 120, 300)))
+NOTIFICATION_STAGE_SECONDS = REGISTRY.register(
+    Summary('yo_notification_stage_seconds',
+            'Time notifications spend in each stage from block to delivery',
+            ('stage', )))
+
+
+def timed_method(histogram, method_name):
+    """Wraps a method so each call is observed in histogram"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(method_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_methods(kls, histogram, exclude=()):
+    """Times every public method of kls, labelled with the method name"""
+    for name, func in list(vars(kls).items()):
+        if name.startswith('_') or name in exclude or not callable(func):
+            continue
+        setattr(kls, name, timed_method(histogram, name)(func))
+    return kls
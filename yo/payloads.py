@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Compact per notify_type payloads for the json_data column
+
+    Handlers used to store whole op dicts, including full post bodies. Each
+    builder here keeps only what the templates and API clients render, plus
+    a short excerpt of any free text, so rows stay small and well under the
+    size of the json_data column.
+"""
+import re
+
+EXCERPT_LENGTH = 140
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# fields of account_update ops that mean something changed on the account
+ACCOUNT_UPDATE_FIELDS = ('owner', 'active', 'posting', 'memo_key',
+                         'json_metadata')
+
+
+def excerpt(text, length=EXCERPT_LENGTH):
+    """Returns text with whitespace collapsed, cut on a word boundary"""
+    text = WHITESPACE_PATTERN.sub(' ', text or '').strip()
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut + '…'
+
+
+def vote_payload(op_data):
+    return {
+        'author': op_data['author'],
+        'permlink': op_data['permlink'],
+        'voter': op_data['voter'],
+        'weight': op_data['weight'],
+    }
+
+
+def follow_payload(follow_data):
+    return {
+        'follower': follow_data['follower'],
+        'following': follow_data['following'],
+    }
+
+
+def resteem_payload(resteem_data):
+    return {
+        'account': resteem_data['account'],
+        'author': resteem_data['author'],
+        'permlink': resteem_data['permlink'],
+    }
+
+
+def transfer_payload(op_data):
+    return {
+        'amount': op_data['amount'],
+        'from': op_data['from'],
+        'memo': excerpt(op_data['memo']),
+        'to': op_data['to'],
+    }
+
+
+def power_down_payload(op_data):
+    return {
+        'account': op_data['account'],
+        'vesting_shares': op_data['vesting_shares'],
+    }
+
+
+def account_update_payload(op_data):
+    return {
+        'account': op_data['account'],
+        'updated': [f for f in ACCOUNT_UPDATE_FIELDS if op_data.get(f)],
+    }
+
+
+def mention_payload(op_data):
+    return {
+        'author': op_data['author'],
+        'permlink': op_data['permlink'],
+        'excerpt': excerpt(op_data['body']),
+    }
+
+
+def reply_payload(op_data):
+    return {
+        'author': op_data['author'],
+        'permlink': op_data['permlink'],
+        'parent_author': op_data['parent_author'],
+        'parent_permlink': op_data['parent_permlink'],
+        'excerpt': excerpt(op_data['body']),
+    }
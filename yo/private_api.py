@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+""" Client for invoking private API methods on remote Yo nodes
+
+    Private API methods (such as notification_sender.trigger_notifications)
+    are normally invoked in-process, but a service can be configured with a
+    url other than :local: in yo.cfg, in which case the calls go over HTTP to
+    the /private endpoint on that node.
+
+    Calls made close together are batched into a single JSON-RPC batch
+    request over a pooled keep-alive connection, and fire-and-forget wake-up
+    signals are coalesced so a burst of them only results in at most two
+    requests per window (one at the start and one at the end).
+"""
+import asyncio
+import itertools
+import json
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+PRIVATE_API_PATH = '/private'
+PRIVATE_API_KEY_HEADER = 'X-Yo-Private-Key'
+
+
+class PrivateAPIClient:
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self,
+                 url,
+                 api_key=None,
+                 timeout=10,
+                 batch_window=0.01,
+                 max_batch_size=50,
+                 coalesce_window=0.5,
+                 max_connections=10,
+                 loop=None):
+        """ Private API client for a single remote node
+
+        Args:
+            url(str): base URL of the remote node, e.g. http://sender:8080
+
+        Keyword args:
+            api_key(str):            shared key sent to the remote node, if set
+            timeout(float):          seconds to wait for a batch to complete
+            batch_window(float):     seconds to wait for more calls to batch
+            max_batch_size(int):     maximum number of calls in one request
+            coalesce_window(float):  seconds within which signals are merged
+            max_connections(int):    size of the keep-alive connection pool
+        """
+        self.url = url.rstrip('/') + PRIVATE_API_PATH
+        self.api_key = api_key
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.coalesce_window = coalesce_window
+        self.max_connections = max_connections
+        self.loop = loop or asyncio.get_event_loop()
+        self.session = None
+        self.pending = []
+        self.flush_handle = None
+        self.signals = {}
+        self.request_ids = itertools.count(1)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            await self.send_batch(batch)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call(self, service=None, api_method=None, **kwargs):
+        """ Invokes a private API method on the remote node
+
+        Returns:
+            whatever the remote method returned, or a dict with an error key
+            if the call could not be completed
+        """
+        future = self.loop.create_future()
+        self.pending.append(({
+            'jsonrpc': '2.0',
+            'id': next(self.request_ids),
+            'method': '%s.%s' % (service, api_method),
+            'params': kwargs
+        }, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.batch_window,
+                                                     self.flush)
+        return await future
+
+    def signal(self, service=None, api_method=None):
+        """ Fire-and-forget invocation of a private API method
+
+        The first signal is sent immediately, any more for the same method
+        within coalesce_window are merged into a single trailing call
+        """
+        key = (service, api_method)
+        if key in self.signals:
+            self.signals[key] = True  # trailing call needed
+            return
+        self.signals[key] = False
+        self.loop.create_task(self.call(service, api_method))
+        self.loop.call_later(self.coalesce_window, self.end_signal_window,
+                             key)
+
+    def end_signal_window(self, key):
+        if self.signals.pop(key, False):
+            self.signal(*key)
+
+    def flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            self.loop.create_task(self.send_batch(batch))
+
+    async def send_batch(self, batch):
+        futures = {request['id']: future for request, future in batch}
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers[PRIVATE_API_KEY_HEADER] = self.api_key
+        body = json.dumps([request for request, _ in batch])
+        logger.debug('Sending %d private API calls to %s', len(batch),
+                     self.url)
+        try:
+            responses = await asyncio.wait_for(
+                self.post(body, headers), self.timeout)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Private API batch to %s failed', self.url)
+            error = {'error': 'Private API call failed: %s' % repr(e)}
+            for future in futures.values():
+                if not future.done():
+                    future.set_result(error)
+            return
+        for response in responses:
+            future = futures.pop(response.get('id'), None)
+            if future is None or future.done():
+                continue
+            if 'error' in response:
+                future.set_result({'error': response['error']})
+            else:
+                future.set_result(response.get('result'))
+        for future in futures.values():
+            if not future.done():
+                future.set_result({'error': 'No response from remote node'})
+
+    async def post(self, body, headers):
+        async with self.get_session().post(
+                self.url, data=body, headers=headers) as response:
+            response.raise_for_status()
+            return await response.json()
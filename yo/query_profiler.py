@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+""" Slow query log and per-statement profiling for YoDatabase
+
+    Hooks SQLAlchemy's cursor execute events on the engine to time every
+    statement. Statements slower than the threshold are logged with their
+    SQL, parameters (redacted by default), row count and the YoDatabase
+    method they came from. Aggregated stats per statement are kept in memory
+    and can be dumped on demand, optionally with the EXPLAIN output of the
+    most expensive statements.
+"""
+import logging
+import sys
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+REDACTED = '<redacted>'
+
+# statements EXPLAIN can be run on
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE', 'INSERT')
+
+
+def redact_params(params):
+    if isinstance(params, dict):
+        return {k: REDACTED for k in params}
+    if isinstance(params, (list, tuple)):
+        return [redact_params(p) if isinstance(p, (dict, list, tuple))
+                else REDACTED for p in params]
+    return REDACTED
+
+
+def find_caller():
+    """Returns the name of the YoDatabase method running this statement
+
+    This walks the stack, so it's only done for slow statements
+    """
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None:
+        if frame.f_globals.get('__name__') == 'yo.db' and \
+                'self' in frame.f_locals:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryStats:
+    __slots__ = ('count', 'total_time', 'max_time', 'rows', 'callers',
+                 'last_params')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.callers = set()
+        self.last_params = None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'mean_time': self.total_time / self.count if self.count else 0,
+            'max_time': self.max_time,
+            'rows': self.rows,
+            'callers': sorted(self.callers)
+        }
+
+
+class QueryProfiler:
+    def __init__(self,
+                 slow_query_threshold=None,
+                 redact_params=True,
+                 capture_explain=False):
+        """ Profiles the statements run on an engine
+
+        Keyword args:
+            slow_query_threshold(float): log statements taking longer than
+                                         this many seconds, None to disable
+            redact_params(bool):         replace parameter values in the log
+            capture_explain(bool):       remember the last parameters of each
+                                         statement so explain() can be used
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.redact_params = redact_params
+        self.capture_explain = capture_explain
+        self.stats = {}
+        self.engine = None
+        self.explaining = False
+
+    def attach(self, engine):
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def detach(self):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self.before_execute)
+        event.remove(self.engine, 'after_cursor_execute', self.after_execute)
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('query_start_time', []).append(
+            time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        if self.explaining:
+            return
+        stats = self.stats.get(statement)
+        if stats is None:
+            stats = self.stats[statement] = QueryStats()
+        stats.count += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        rowcount = getattr(cursor, 'rowcount', -1)
+        if rowcount is not None and rowcount > 0:
+            stats.rows += rowcount
+        if self.capture_explain and not executemany:
+            stats.last_params = parameters
+        if self.slow_query_threshold is not None and \
+                elapsed >= self.slow_query_threshold:
+            caller = find_caller()
+            stats.callers.add(caller)
+            logger.warning(
+                'Slow query (%.3fs, %s rows) in YoDatabase.%s: %s params=%s',
+                elapsed, rowcount, caller, statement,
+                redact_params(parameters)
+                if self.redact_params else parameters)
+
+    # pylint: enable=too-many-arguments,unused-argument
+
+    def get_stats(self, top=None):
+        """Returns per-statement stats, most total time first"""
+        stats = sorted(
+            self.stats.items(), key=lambda i: i[1].total_time, reverse=True)
+        if top is not None:
+            stats = stats[:top]
+        return [
+            dict(statement=statement, **s.as_dict()) for statement, s in stats
+        ]
+
+    def reset(self):
+        self.stats.clear()
+
+    def explain(self, top=5):
+        """ Runs EXPLAIN on the top statements by total time
+
+        Requires capture_explain, statements that were never seen with
+        parameters (or can't be explained) are skipped
+
+        Returns:
+            list of dicts with the statement, its stats and the plan rows
+        """
+        if not self.capture_explain:
+            return []
+        prefix = 'EXPLAIN QUERY PLAN ' \
+            if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        results = []
+        for entry in self.get_stats():
+            if len(results) >= top:
+                break
+            stats = self.stats[entry['statement']]
+            if not entry['statement'].lstrip().upper().startswith(
+                    EXPLAINABLE) or stats.last_params is None:
+                continue
+            self.explaining = True
+            try:
+                with self.engine.connect() as conn:
+                    plan = conn.execute(prefix + entry['statement'],
+                                        stats.last_params).fetchall()
+                entry['plan'] = [list(row) for row in plan]
+            except Exception as e:  # pylint: disable=broad-except
+                entry['plan'] = None
+                entry['error'] = str(e)
+            finally:
+                self.explaining = False
+            results.append(entry)
+        return results
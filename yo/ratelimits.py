@@ -1,72 +1,282 @@
 # -*- coding: utf-8 -*-
+""" Rate limits on the notifications sent to a user
+
+    A policy allows a user at most `limit` notifications of a priority or
+    higher in a sliding window of `window` seconds, written limit/window in
+    the [ratelimits] config section, e.g. low=1/3600. Each priority has a
+    normal policy and a softer one used with override, e.g. low_override.
+
+    check_ratelimit answers from the sends recorded in yo_actions. The
+    notification sender uses a SlidingWindowLimiter instead, which keeps the
+    recent send times of each user in memory, warm-started from yo_actions,
+    and optionally shares them with the other senders on the host through a
+    SQLiteRateStore.
+"""
+import collections
 import logging
+import os
+import sqlite3
+import time
 
 from .db import Priority
+from .metrics import RATELIMIT_DECISIONS
 
 logger = logging.getLogger(__name__)
 
+PRIORITY_NAMES = {int(priority): priority.name for priority in Priority}
+
+# priority -> (limit, window in seconds)
+DEFAULT_POLICIES = {
+    Priority.ALWAYS: (10, 3600),
+    Priority.PRIORITY: (2, 3600),
+    Priority.NORMAL: (2, 60),
+    Priority.LOW: (1, 3600),
+    Priority.MARKETING: (2, 3600),
+}
+DEFAULT_OVERRIDE_POLICIES = {
+    Priority.ALWAYS: (10, 3600),
+    Priority.PRIORITY: (11, 3600),
+    Priority.NORMAL: (3, 60),
+    Priority.LOW: (10, 3600),
+    Priority.MARKETING: (2, 86400),
+}
+
+
+def parse_policy(value):
+    """Parses limit/window, e.g. 10/3600"""
+    limit, window = value.split('/')
+    return int(limit), float(window)
+
+
+def load_policies(settings=None):
+    """ Returns (policies, override policies) from the [ratelimits] section,
+    priority names in lower case are the keys
+    """
+    policies = dict(DEFAULT_POLICIES)
+    override_policies = dict(DEFAULT_OVERRIDE_POLICIES)
+    for priority in Priority.__members__.values():
+        name = priority.name.lower()
+        if settings is not None and settings.get(name):
+            policies[priority] = parse_policy(settings.get(name))
+        if settings is not None and settings.get(name + '_override'):
+            override_policies[priority] = parse_policy(
+                settings.get(name + '_override'))
+    return policies, override_policies
+
+
+def count_decision(notification_object, allowed):
+    priority = PRIORITY_NAMES.get(notification_object['priority_level'],
+                                  'invalid')
+    RATELIMIT_DECISIONS.inc(priority, 'allowed' if allowed else 'denied')
+    return allowed
+
 
-# pylint: disable=too-many-branches
-# pylint: disable-msg=unused-argument
-def check_ratelimit(db, notification_object, override=False):
+def check_ratelimit(db, notification_object, override=False, policies=None):
+    """Checks if this notification should be sent or not, see _check_ratelimit
+
+    The decision is also counted in the rate limit metrics
+    """
+    return count_decision(
+        notification_object,
+        _check_ratelimit(
+            db, notification_object, override=override, policies=policies))
+
+
+def _check_ratelimit(db, notification_object, override=False, policies=None):
     """Checks if this notification should be sent or not
 
     Args:
         notification_object(dict): The notification in question, must contain the priority field (priority_level)
     Keyword args:
         override(bool): If set True, will use the hard limits instead of soft
+        policies(tuple): (policies, override policies), the defaults if None
 
     Returns:
         True if allowed, False if not
-        :param notification_object:
-        :param override:
-        :param db:
     """
-
     notification_priority = notification_object['priority_level']
     to_username = notification_object['to_username']
-
-
-    if notification_priority == Priority.ALWAYS:
-        logger.debug('PRIORITY ALWAYS Checking')
-        return db.get_priority_count(to_username, Priority.ALWAYS, 3600) < 10
-    elif notification_priority == Priority.PRIORITY:
-        logger.debug('PRIORITY PRIORITY Checking')
-        if override:
-            return (db.get_priority_count(to_username, Priority.PRIORITY, 3600)
-                    <= 10)
-        else:
-            return (db.get_priority_count(to_username, Priority.PRIORITY,
-                                          3600) <= 1)
-    elif notification_priority == Priority.NORMAL:
-        logger.debug('PRIORITY PRIORITY Checking')
-        if override:
-            return (db.get_priority_count(to_username, Priority.NORMAL, 60) <
-                    3)
-        else:
-            return (db.get_priority_count(to_username, Priority.NORMAL,
-                                          60) <= 1)
-    elif notification_priority == Priority.LOW:
-        logger.debug('PRIORITY LOW Checking')
-        count = db.get_priority_count(to_username, int(Priority.LOW), 3600)
-        logger.debug('Found %d existing objects of LOW priority for username %s', count,to_username)
-        if override:
-            return (db.get_priority_count(to_username, Priority.LOW, 3600) <
-                    10)
-        else:
-            return (db.get_priority_count(to_username, Priority.LOW,
-                                          3600) == 0)
-    elif notification_priority == Priority.MARKETING:
-        logger.debug('PRIORITY MARKETING Checking')
-        if override:
-            return (db.get_priority_count(to_username, Priority.MARKETING,
-                                          86400) <= 1)
-        else:
-            return (db.get_priority_count(to_username, Priority.MARKETING,
-                                          3600) <= 1)
-    else:
+    policies = policies or (DEFAULT_POLICIES, DEFAULT_OVERRIDE_POLICIES)
+    policy = policies[1 if override else 0].get(notification_priority)
+    if policy is None:
         logger.error(
             'Invalid notification priority level! Assuming corrupted data for notification: %s',
             notification_object)
+        return False  # for invalid stuff, assume it's bad
+    limit, window = policy
+    count = db.get_priority_count(to_username, notification_priority, window)
+    logger.debug('Found %d sends at priority %d or higher for username %s',
+                 count, notification_priority, to_username)
+    return count < limit
+
+
+class SQLiteRateStore:
+    def __init__(self, path, sync_interval=1.0):
+        """ Send times shared by the sender processes on one host
+
+        Every limiter appends its own sends and, at most every sync_interval
+        seconds, reads the ones the other processes appended since
+
+        Keyword args:
+            path(str):              sqlite database file, created if missing
+            sync_interval(float):   seconds between reads of other's sends
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.owner = '%d-%d' % (os.getpid(), id(self))
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=5)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS yo_ratelimit_sends ('
+            'id INTEGER PRIMARY KEY, owner TEXT, username TEXT, '
+            'priority INTEGER, sent_at REAL)')
+        self.last_id = self.conn.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM yo_ratelimit_sends').fetchone()[0]
+        self.next_sync = 0
+
+    def add(self, username, priority, sent_at):
+        self.conn.execute(
+            'INSERT INTO yo_ratelimit_sends (owner, username, priority, '
+            'sent_at) VALUES (?, ?, ?, ?)',
+            (self.owner, username, int(priority), sent_at))
+
+    def others_since_last_sync(self, now):
+        """Returns the [(username, priority, sent_at)] others added, if due"""
+        if now < self.next_sync:
+            return []
+        self.next_sync = now + self.sync_interval
+        rows = self.conn.execute(
+            'SELECT id, username, priority, sent_at FROM yo_ratelimit_sends '
+            'WHERE id > ? AND owner != ? ORDER BY id',
+            (self.last_id, self.owner)).fetchall()
+        if rows:
+            self.last_id = rows[-1][0]
+        return [row[1:] for row in rows]
+
+    def expire(self, before):
+        self.conn.execute('DELETE FROM yo_ratelimit_sends WHERE sent_at < ?',
+                          (before, ))
+
+
+class SlidingWindowLimiter:
+    def __init__(self,
+                 policies=None,
+                 override_policies=None,
+                 store=None,
+                 evict_interval=60):
+        """ In-memory sliding window rate limits
+
+        Per user and priority level the most recent send times are kept,
+        no more than the largest limit of any policy, as more can't change
+        a decision. Users with no send in the longest window are evicted.
+
+        Keyword args:
+            policies(dict):           priority -> (limit, window)
+            override_policies(dict):  the same, used with override
+            store(SQLiteRateStore):   if set, sends are shared through it
+            evict_interval(float):    seconds between sweeps for idle users
+        """
+        self.policies = policies or dict(DEFAULT_POLICIES)
+        self.override_policies = override_policies or dict(
+            DEFAULT_OVERRIDE_POLICIES)
+        all_policies = list(self.policies.values()) + list(
+            self.override_policies.values())
+        self.max_sends = max(limit for limit, _ in all_policies)
+        self.ttl = max(window for _, window in all_policies)
+        self.store = store
+        self.evict_interval = evict_interval
+        self.users = {}
+        self.next_evict = time.time() + evict_interval
+        self.warm = False
+
+    def __len__(self):
+        return len(self.users)
+
+    def warm_start(self, db):
+        """Loads the sends within the longest window from yo_actions"""
+        since = time.time() - self.ttl
+        actions = db.get_recent_sends(since)
+        for username, priority, sent_at in actions:
+            self._add(username, priority, sent_at)
+        self.warm = True
+        logger.info('Rate limiter warm-started with %d sends of %d users',
+                    len(actions), len(self.users))
+
+    def _add(self, username, priority, sent_at):
+        levels = self.users.get(username)
+        if levels is None:
+            levels = self.users[username] = {}
+        sends = levels.get(priority)
+        if sends is None:
+            sends = levels[priority] = collections.deque(
+                maxlen=self.max_sends)
+        if sends and sent_at < sends[-1]:
+            # out of order, e.g. from another process, keep it sorted
+            sends.append(sent_at)
+            ordered = sorted(sends)
+            sends.clear()
+            sends.extend(ordered)
+        else:
+            sends.append(sent_at)
+
+    def record(self, username, priority, sent_at=None):
+        """Records a send counting against the user's limits"""
+        sent_at = time.time() if sent_at is None else sent_at
+        self._add(username, int(priority), sent_at)
+        if self.store is not None:
+            self.store.add(username, priority, sent_at)
+
+    def count(self, username, priority, window, now):
+        """Sends to the user at priority or higher within window seconds"""
+        levels = self.users.get(username)
+        if not levels:
+            return 0
+        since = now - window
+        total = 0
+        for level, sends in levels.items():
+            if level < priority:
+                continue
+            for sent_at in reversed(sends):
+                if sent_at < since:
+                    break
+                total += 1
+        return total
+
+    def allowed(self, username, priority, override=False, now=None):
+        now = time.time() if now is None else now
+        if self.store is not None:
+            for other in self.store.others_since_last_sync(now):
+                self._add(*other)
+        if now >= self.next_evict:
+            self.evict(now)
+        policy = (self.override_policies
+                  if override else self.policies).get(priority)
+        if policy is None:
+            return False
+        limit, window = policy
+        return self.count(username, priority, window, now) < limit
+
+    def check(self, db, notification_object, override=False):
+        """ Same as check_ratelimit, answered from memory
+        """
+        if not self.warm:
+            self.warm_start(db)
+        allowed = self.allowed(notification_object['to_username'],
+                               notification_object['priority_level'],
+                               override=override)
+        if notification_object['priority_level'] not in self.policies:
+            logger.error(
+                'Invalid notification priority level! Assuming corrupted data for notification: %s',
+                notification_object)
+        return count_decision(notification_object, allowed)
 
-    return False  # for invalid stuff, assume it's bad
+    def evict(self, now):
+        before = now - self.ttl
+        self.users = {
+            username: levels
+            for username, levels in self.users.items()
+            if any(sends and sends[-1] >= before for sends in levels.values())
+        }
+        if self.store is not None:
+            self.store.expire(before)
+        self.next_evict = now + self.evict_interval
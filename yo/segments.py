@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+""" Indexed, memory-mapped segments of archived notifications
+
+    A segment is an immutable file holding the archived notifications of
+    many users, grouped per user, newest first, with an index of users at
+    the end so one user's rows are found with a binary search:
+
+        header   magic, version, user count, index offset, row count,
+                 min nid, max nid
+        records  per user: [nid, notify_type, length, JSON row]...
+        index    per user, sorted: [username, offset, length, count,
+                 newest nid, oldest nid]
+
+    Readers mmap the file and filter records on the nid and notify_type in
+    their fixed-size header, so only the rows actually returned are copied
+    out of the map and decoded.
+"""
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+
+import dateutil.parser
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'YOSEG001'
+VERSION = 1
+SEGMENT_SUFFIX = '.yoseg'
+
+HEADER = struct.Struct('<8sIIQQ26s26s')
+INDEX_ENTRY = struct.Struct('<32sQII26s26s')
+RECORD = struct.Struct('<26s20sI')
+
+DATETIME_FIELDS = ('created', 'updated', 'created_at', 'block_time')
+
+
+def pack_str(value, size):
+    data = (value or '').encode('utf-8')
+    if len(data) > size:
+        raise ValueError('%r does not fit in %d bytes' % (value, size))
+    return data
+
+
+def unpack_str(data):
+    return data.rstrip(b'\0').decode('utf-8')
+
+
+def write_segment(path, rows):
+    """ Writes rows (JSON-ready dicts with at least nid, to_username and
+    notify_type) as a segment, atomically: the file only appears once it is
+    complete and synced
+
+    Returns:
+        str: path
+    """
+    by_user = {}
+    for row in rows:
+        by_user.setdefault(row['to_username'], []).append(row)
+    all_nids = [row['nid'] for row in rows]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        index = []
+        for username in sorted(by_user):
+            user_rows = sorted(
+                by_user[username], key=lambda r: r['nid'], reverse=True)
+            offset = f.tell()
+            for row in user_rows:
+                data = json.dumps(row, sort_keys=True).encode('utf-8')
+                f.write(RECORD.pack(
+                    pack_str(row['nid'], 26),
+                    pack_str(row['notify_type'], 20), len(data)))
+                f.write(data)
+            index.append(INDEX_ENTRY.pack(
+                pack_str(username, 32), offset, f.tell() - offset,
+                len(user_rows), pack_str(user_rows[0]['nid'], 26),
+                pack_str(user_rows[-1]['nid'], 26)))
+        index_offset = f.tell()
+        f.write(b''.join(index))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(index), index_offset,
+                            len(rows), pack_str(min(all_nids, default=''), 26),
+                            pack_str(max(all_nids, default=''), 26)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return path
+
+
+def decode_row(data):
+    row = json.loads(data)
+    for field in DATETIME_FIELDS:
+        if row.get(field):
+            row[field] = dateutil.parser.parse(row[field])
+    return row
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        (magic, version, self.user_count, self.index_offset, self.row_count,
+         min_nid, max_nid) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a yo segment' % path)
+        self.min_nid = unpack_str(min_nid)
+        self.max_nid = unpack_str(max_nid)
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    def rows(self):
+        """Yields every row in the segment, for compaction"""
+        position = HEADER.size
+        while position < self.index_offset:
+            _, _, size = RECORD.unpack_from(self.mm, position)
+            start = position + RECORD.size
+            position = start + size
+            yield json.loads(self.view[start:position].tobytes())
+
+    def username_at(self, i):
+        start = self.index_offset + i * INDEX_ENTRY.size
+        return unpack_str(bytes(self.view[start:start + 32]))
+
+    def find_user(self, username):
+        """Returns the index entry of a user, None if not in this segment"""
+        # bisect over a lazily sliced view of the sorted index
+        names = _IndexNames(self)
+        i = bisect.bisect_left(names, username)
+        if i == self.user_count or names[i] != username:
+            return None
+        return INDEX_ENTRY.unpack_from(self.mm,
+                                       self.index_offset + i * INDEX_ENTRY.size)
+
+    def user_rows(self, username, before_id=None, notify_types=None):
+        """Yields (nid, row) of a user, newest first"""
+        entry = self.find_user(username)
+        if entry is None:
+            return
+        _, offset, length, _, _, oldest = entry
+        if before_id is not None and unpack_str(oldest) >= before_id:
+            return
+        position, end = offset, offset + length
+        while position < end:
+            nid, notify_type, size = RECORD.unpack_from(self.mm, position)
+            start = position + RECORD.size
+            position = start + size
+            nid = unpack_str(nid)
+            if before_id is not None and nid >= before_id:
+                continue
+            if notify_types and unpack_str(notify_type) not in notify_types:
+                continue
+            yield nid, decode_row(self.view[start:position].tobytes())
+
+
+class _IndexNames:
+    """Sequence view of the usernames in a segment index, for bisect"""
+
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __len__(self):
+        return self.segment.user_count
+
+    def __getitem__(self, i):
+        return self.segment.username_at(i)
+
+
+class ArchiveReader:
+    """ Reads the notification segments in a directory
+
+    Rows come back as dicts decoded from a copy of their record's bytes,
+    not as views into the map. New segments written by the retention
+    service (and segments replaced by compaction) are picked up when the
+    directory changes
+    """
+
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        self.segments = {}
+        self.dir_mtime = None
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.segment_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.dir_mtime:
+            return
+        self.dir_mtime = mtime
+        paths = {
+            os.path.join(self.segment_dir, name)
+            for name in os.listdir(self.segment_dir)
+            if name.endswith(SEGMENT_SUFFIX)
+        }
+        for path in set(self.segments) - paths:
+            self.segments.pop(path).close()
+        for path in paths - set(self.segments):
+            try:
+                self.segments[path] = Segment(path)
+            except (OSError, ValueError):
+                logger.exception('Failed to open segment %s', path)
+
+    def get_notifications(self, to_username, before_id=None,
+                          notify_types=None, limit=30):
+        """ Returns a user's archived notifications, newest first
+
+        Rows from all segments are merged by nid, the same nid in several
+        segments (e.g. while compaction runs) is only returned once
+        """
+        self.refresh()
+        streams = [
+            segment.user_rows(to_username, before_id, notify_types)
+            for segment in self.segments.values()
+            if before_id is None or segment.min_nid < before_id
+        ]
+        rows = []
+        last_nid = None
+        for nid, row in heapq.merge(
+                *streams, key=lambda item: item[0], reverse=True):
+            if nid == last_nid:
+                continue
+            last_nid = nid
+            rows.append(row)
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
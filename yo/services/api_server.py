@@ -23,6 +23,7 @@ class YoAPIServer(YoBaseService):
                                     read=None,
                                     notify_types=None,
                                     limit=30,
+                                    before_id=None,
                                     context=None):
         """ Get all notifications since the specified time
 
@@ -33,6 +34,7 @@ class YoAPIServer(YoBaseService):
           read(bool): If set, only returns notifications with read flag set to this value
           notify_types(str): The notification type to return
           limit(int): The maximum number of notifications to return, defaults to 30
+          before_id(str): If set, only returns notifications older than this id, use the last id of a page to get the next page
 
        Returns:
           list: list of notifications represented in dictionary format
@@ -44,7 +46,8 @@ class YoAPIServer(YoBaseService):
             updated_after=updated_after,
             notify_types=notify_types,
             read=read,
-            limit=limit)
+            limit=limit,
+            before_id=before_id)
 
     # pylint: enable=too-many-arguments
 
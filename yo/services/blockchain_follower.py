@@ -3,15 +3,27 @@ import asyncio
 import json
 import logging
 import re
+import time
 
 import datetime
 
 import uuid
 
-import steem
-from steem.blockchain import Blockchain
-
+from .. import payloads
 from ..db import Priority
+from ..ids import new_nid
+from ..metrics import BLOCKS_PROCESSED
+from ..metrics import FOLLOWER_ACTIVE
+from ..metrics import FOLLOWER_AGGREGATED
+from ..metrics import FOLLOWER_DROPPED
+from ..metrics import FOLLOWER_FAILOVER_SECONDS
+from ..metrics import FOLLOWER_LAG_BLOCKS
+from ..metrics import FOLLOWER_LAST_BLOCK
+from ..metrics import FOLLOWER_OP_SECONDS
+from ..subscriptions import SubscriptionIndex
+from ..tracing import TRACER
+from ..tracing import parse_block_time
+from ..tracing import to_epoch
 from .base_service import YoBaseService
 
 logger = logging.getLogger(__name__)
@@ -36,6 +48,15 @@ RESTEEM = 'resteem'
 REWARD = 'reward'
 VOTE = 'vote'
 
+# op types we handle, anything else is counted under 'other' in metrics
+HANDLED_OP_TYPES = {
+    'vote', 'custom_json', 'account_update', 'transfer', 'withdraw_vesting',
+    'comment'
+}
+
+# how many aggregation groups to remember before dropping expired ones
+MAX_AGGREGATES = 100000
+
 # any valid @username with a trailing whitespace
 MENTION_PATTERN = re.compile(r'@([a-z][a-z0-9\-]{2,15})\s')
 
@@ -46,14 +67,143 @@ class YoBlockchainFollower(YoBaseService):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        steemd_url = self.yo_app.config.config_data['blockchain_follower'].get(
-            'steemd_url', 'https://api.steemit.com')
-        self.steemd_rpc = steem.steemd.Steemd(nodes=[steemd_url])
+        self.steemd_url = self.yo_app.config.config_data[
+            'blockchain_follower'].get('steemd_url', 'https://api.steemit.com')
+        self._steemd_rpc = None
         self.follower_id = str(uuid.uuid1())
 
-    async def store_notification(self, **data):
+        # skip notifications none of the recipient's transports would deliver
+        settings = self.yo_app.config.config_data['blockchain_follower']
+
+        # the active follower holds a lock in yo_chain_status, renewed by
+        # heartbeat() independently of block processing, and stops as soon
+        # as it loses it. fencing_token is what try_active_follower() gave
+        # us, None while we're standby
+        self.lock_timeout = settings.getfloat('lock_timeout', 9)
+        self.fencing_token = None
+        self.heartbeat_task = None
+        self.chain_status = None
+        self.subscriptions = None
+        if settings.getint('ingest_filter', 1):
+            self.subscriptions = SubscriptionIndex(
+                self.db,
+                refresh_interval=settings.getfloat(
+                    'ingest_filter_refresh_interval', 60),
+                drop_unknown_users=bool(
+                    settings.getint('ingest_filter_drop_unknown_users', 0)))
+            self.db.add_user_settings_listener(self.subscriptions.update)
+
+        # bursts of e.g. votes on the same post are merged into one
+        # notification, keyed by (to_username, notify_type, group_key)
+        self.aggregate_types = {
+            t.strip()
+            for t in settings.get('aggregate_types', 'vote').split(',')
+            if t.strip()
+        }
+        self.aggregate_window = datetime.timedelta(
+            seconds=settings.getfloat('aggregate_window', 600))
+        self.aggregate_sample_size = settings.getint('aggregate_sample_size',
+                                                     5)
+        self.aggregates = {}
+        self.aggregates_since = datetime.datetime.now()
+
+    @property
+    def steemd_rpc(self):
+        """ The steemd client, created on first use
+
+        steem-python is slow to import, so it is only loaded once we actually
+        talk to the blockchain
+        """
+        if self._steemd_rpc is None:
+            from steem.steemd import Steemd
+            self._steemd_rpc = Steemd(nodes=[self.steemd_url])
+        return self._steemd_rpc
+
+    @steemd_rpc.setter
+    def steemd_rpc(self, steemd_rpc):
+        self._steemd_rpc = steemd_rpc
+
+    async def store_notification(self, op, **data):
+        if self.subscriptions is not None and not self.subscriptions.wants(
+                data['to_username'], data['notify_type']):
+            FOLLOWER_DROPPED.inc(data['notify_type'])
+            return
+        aggregate = data.get('group_key') is not None and \
+            data['notify_type'] in self.aggregate_types and \
+            self.aggregate_window.total_seconds() > 0
+        if aggregate:
+            if self.merge_into_aggregate(data):
+                return
+            payload = json.loads(data['json_data'])
+            payload['count'] = 1
+            payload['senders'] = [data['from_username']]
+            data['json_data'] = json.dumps(payload)
         data['sent'] = False
-        self.db.create_notification(**data)
+        data['nid'] = new_nid()
+        block_time = parse_block_time(op.get('timestamp'))
+        data['block_time'] = block_time
+        data['created'] = datetime.datetime.now()
+        if self.db.create_notification(fence=self.fence, **data):
+            TRACER.record(
+                data['nid'],
+                'commit',
+                block=to_epoch(block_time),
+                ingest=op.get('ingest_time'))
+            if aggregate:
+                self.remember_aggregate(data, payload)
+
+    def remember_aggregate(self, data, payload):
+        if len(self.aggregates) >= MAX_AGGREGATES:
+            expired = datetime.datetime.now() - self.aggregate_window
+            self.aggregates = {
+                k: v
+                for k, v in self.aggregates.items() if v['created'] >= expired
+            }
+        key = (data['to_username'], data['notify_type'], data['group_key'])
+        self.aggregates[key] = {
+            'nid': data['nid'],
+            'created': data['created'],
+            'payload': payload
+        }
+
+    def merge_into_aggregate(self, data):
+        """ Adds the event to a recent notification in the same group
+
+        Returns:
+            True if it was merged, False if a new notification is needed
+        """
+        key = (data['to_username'], data['notify_type'], data['group_key'])
+        since = datetime.datetime.now() - self.aggregate_window
+        aggregate = self.aggregates.get(key)
+        if aggregate is None or aggregate['created'] < since:
+            if self.aggregates_since <= since:
+                # we've been running for the whole window, so anything
+                # recent enough would be in memory
+                return False
+            row = self.db.get_aggregate_notification(
+                to_username=key[0],
+                notify_type=key[1],
+                group_key=key[2],
+                created_after=since)
+            if row is None:
+                return False
+            aggregate = {
+                'nid': row['nid'],
+                'created': row['created'],
+                'payload': json.loads(row['json_data'])
+            }
+        payload = aggregate['payload']
+        payload['count'] = payload.get('count', 1) + 1
+        senders = payload.setdefault('senders', [])
+        if len(senders) < self.aggregate_sample_size and \
+                data.get('from_username') not in senders:
+            senders.append(data.get('from_username'))
+        if not self.db.update_aggregate_notification(
+                aggregate['nid'], json.dumps(payload), fence=self.fence):
+            return False
+        self.aggregates[key] = aggregate
+        FOLLOWER_AGGREGATED.inc(data['notify_type'])
+        return True
 
     async def handle_vote(self, op):
         logger.info('handle_vote received %s op', ['op'][0])
@@ -62,10 +212,12 @@ class YoBlockchainFollower(YoBaseService):
                     vote_info['permlink'], vote_info['author'],
                     vote_info['voter'], vote_info['weight'])
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             from_username=vote_info['voter'],
             to_username=vote_info['author'],
-            json_data=json.dumps(vote_info),
+            json_data=json.dumps(payloads.vote_payload(vote_info)),
+            group_key=vote_info['permlink'],
             notify_type=VOTE,
             priority_level=int(Priority.LOW))
         return True
@@ -86,10 +238,11 @@ class YoBlockchainFollower(YoBaseService):
             return False
         logger.debug('Follow: %s started following %s', follower, following)
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             from_username=follower,
             to_username=following,
-            json_data=json.dumps(follow_data[1]),
+            json_data=json.dumps(payloads.follow_payload(follow_data[1])),
             notify_type=FOLLOW,
             priority_level=Priority.LOW)
         return True
@@ -99,24 +252,21 @@ class YoBlockchainFollower(YoBaseService):
         logger.debug('Account: %s updated their account info',
                      op_data['account'])
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             to_username=op_data['account'],
-            json_data=json.dumps(op_data),
+            json_data=json.dumps(payloads.account_update_payload(op_data)),
             notify_type=ACCOUNT_UPDATE,
             priority_level=Priority.LOW)
         return True
 
     async def handle_send(self, op):
         op_data = op['op'][1]
-        send_data = {
-            'amount': op_data['amount'],
-            'from': op_data['from'],
-            'memo': op_data['memo'],
-            'to': op_data['to'],
-        }
+        send_data = payloads.transfer_payload(op_data)
         logger.debug('Send: %s sent %s to %s', send_data['from'],
                      send_data['amount'], send_data['to'])
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             to_username=send_data['from'],
             json_data=json.dumps(send_data),
@@ -126,15 +276,11 @@ class YoBlockchainFollower(YoBaseService):
 
     async def handle_receive(self, op):
         op_data = op['op'][1]
-        receive_data = {
-            'amount': op_data['amount'],
-            'from': op_data['from'],
-            'memo': op_data['memo'],
-            'to': op_data['to'],
-        }
+        receive_data = payloads.transfer_payload(op_data)
         logger.debug('Receive: %s got %s from %s', receive_data['to'],
                      receive_data['amount'], receive_data['from'])
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             to_username=receive_data['to'],
             from_username=receive_data['from'],
@@ -148,9 +294,10 @@ class YoBlockchainFollower(YoBaseService):
         logger.debug('Powerdown: %s powered down %s', op_data['account'],
                      op_data['vesting_shares'])
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             to_username=op_data['account'],
-            json_data=json.dumps(op_data),
+            json_data=json.dumps(payloads.power_down_payload(op_data)),
             notify_type=POWER_DOWN,
             priority_level=Priority.LOW)
         return True
@@ -158,15 +305,13 @@ class YoBlockchainFollower(YoBaseService):
     async def handle_mention(self, op):
         comment_data = op['op'][1]
         haystack = comment_data['body'] + '\n'
-        data = {
-            'author': comment_data['author'],
-            'permlink': comment_data['permlink'],
-        }
+        data = payloads.mention_payload(comment_data)
         for match in re.findall(MENTION_PATTERN, haystack):
             # TODO: only allow N mentions per operation?
             # TODO: validate mentioned user exists on chain?
             logger.debug('Mention: %s mentioned %s', data['author'], match)
             await self.store_notification(
+                op,
                 trx_id=op['trx_id'],
                 to_username=match,
                 from_username=data['author'],
@@ -182,15 +327,17 @@ class YoBlockchainFollower(YoBaseService):
             # top level post
             return True
         parent_id = '@' + op_data['parent_author'] + '/' + op_data['parent_permlink']
-        parent = steem.post.Post(parent_id)
+        from steem.post import Post
+        parent = Post(parent_id, steemd_instance=self.steemd_rpc)
         note_type = COMMENT_REPLY if parent.is_comment() else POST_REPLY
         logger.debug('Comment(%s): %s replied to %s', note_type,
                      op_data['author'], parent_id)
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             to_username=op_data['parent_author'],
             from_username=op_data['author'],
-            json_data=json.dumps(op_data),
+            json_data=json.dumps(payloads.reply_payload(op_data)),
             notify_type=note_type,
             priority_level=Priority.LOW)
         return True
@@ -213,10 +360,12 @@ class YoBlockchainFollower(YoBaseService):
             return True
         logger.debug('Resteem: %s reblogged @%s/%s', account, author, permlink)
         await self.store_notification(
+            op,
             trx_id=op['trx_id'],
             from_username=account,
             to_username=author,
-            json_data=json.dumps(resteem_data[1]),
+            json_data=json.dumps(payloads.resteem_payload(resteem_data[1])),
+            group_key=permlink,
             notify_type=RESTEEM,
             priority_level=Priority.LOW)
         return True
@@ -224,6 +373,16 @@ class YoBlockchainFollower(YoBaseService):
     async def notify(self, blockchain_op):
         """ Handle notification for a particular op
         """
+        blockchain_op.setdefault('ingest_time', time.time())
+        op_type = blockchain_op['op'][0]
+        if op_type not in HANDLED_OP_TYPES:
+            op_type = 'other'
+        with FOLLOWER_OP_SECONDS.time(op_type):
+            return await self.dispatch_op(blockchain_op)
+
+    async def dispatch_op(self, blockchain_op):
+        """ Hands the op over to the handlers for its type
+        """
         logger.debug('Got operation from blockchain: %s', str(blockchain_op))
         # vote
         if blockchain_op['op'][0] == 'vote':
@@ -297,48 +456,154 @@ class YoBlockchainFollower(YoBaseService):
                 start_block = b.get_current_block_num() - start_block
         return start_block
 
+    @property
+    def fence(self):
+        """ What our writes are fenced with, so they fail in the database
+        once another follower took over, None when not following the chain
+        """
+        if self.fencing_token is None:
+            return None
+        return (self.follower_id, self.fencing_token)
+
+    def try_lead(self, start_block=None):
+        """ Takes over as active follower if the lock is free
+
+        Returns:
+            bool: True if we're the active follower
+        """
+        before = self.db.get_chain_status()
+        if before is None:  # we must be the first, so let's init stuff
+            status = self.db.try_active_follower(
+                follower_id=self.follower_id,
+                last_processed_block=start_block - 1,
+                lock_timeout=self.lock_timeout)
+        else:  # we don't overwrite last_processed_block
+            status = self.db.try_active_follower(
+                follower_id=self.follower_id, lock_timeout=self.lock_timeout)
+        self.chain_status = status
+        if status['active_follower_id'] != self.follower_id:
+            if self.fencing_token is not None:
+                self.step_down()
+            return False
+        if status['fencing_token'] != self.fencing_token:
+            self.take_over(before, status)
+        return True
+
+    def take_over(self, before, status):
+        self.fencing_token = status['fencing_token']
+        FOLLOWER_ACTIVE.set(1)
+        if before is not None and before['active_follower_id'] != \
+                self.follower_id and before.get('lock_renewed') is not None:
+            failover = (status['lock_renewed'] -
+                        before['lock_renewed']).total_seconds()
+            FOLLOWER_FAILOVER_SECONDS.observe(max(failover, 0))
+            logger.info('Took over from follower %s, %.1fs after it was last '
+                        'seen', before['active_follower_id'], failover)
+        else:
+            logger.info('We are active follower with fencing token %d',
+                        self.fencing_token)
+        self.heartbeat_task = asyncio.ensure_future(
+            self.heartbeat(self.fencing_token))
+
+    def step_down(self, release=False):
+        """ Stops acting as active follower
+
+        Keyword args:
+            release(bool): also free the lock so a standby can take over
+        """
+        fencing_token, self.fencing_token = self.fencing_token, None
+        FOLLOWER_ACTIVE.set(0)
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        self.heartbeat_task = None
+        if release and fencing_token is not None:
+            self.db.release_follower_lock(
+                follower_id=self.follower_id, fencing_token=fencing_token)
+
+    async def heartbeat(self, fencing_token):
+        """Renews the lock every third of lock_timeout while we're active"""
+        while self.fencing_token == fencing_token:
+            await asyncio.sleep(self.lock_timeout / 3)
+            if self.fencing_token != fencing_token:
+                return
+            if not self.db.renew_follower_lock(
+                    follower_id=self.follower_id,
+                    fencing_token=fencing_token,
+                    lock_timeout=self.lock_timeout):
+                logger.warning('Lost the follower lock, stepping down')
+                self.heartbeat_task = None  # don't cancel ourselves
+                self.step_down()
+
+    async def wait_for_lock(self):
+        """ Sleeps until the active follower's lock expires, checking every
+        third of lock_timeout so a released lock is taken over quickly
+        """
+        lock_expires = self.chain_status['lock_expires']
+        logger.info('We are not active follower, sleeping until %s',
+                    str(lock_expires))
+        while True:
+            sleep_time = (lock_expires - datetime.datetime.now()).total_seconds()
+            if sleep_time <= 0:
+                return
+            await asyncio.sleep(min(sleep_time + 0.01, self.lock_timeout / 3))
+            status = self.db.get_chain_status()
+            if status is not None:
+                lock_expires = status['lock_expires']
+
     async def async_task(self):
 
+        from steem.blockchain import Blockchain
+
         logger.info('Blockchain follower started')
         chain = Blockchain(steemd_instance=self.steemd_rpc)
         start_block = self.get_start_block(chain)
         block_interval = chain.config().get("STEEMIT_BLOCK_INTERVAL") # we use this to calculate timeouts
 
-        while True:
-           chain_status = self.db.get_chain_status()
-
-           if chain_status is None: # we must be the first, so let's init stuff
-              chain_status = self.db.try_active_follower(follower_id=self.follower_id,last_processed_block=start_block-1,lock_timeout=block_interval*10) # timeout after 10 blocks go unprocessed
-           else: # an existing follower is in the DB, check if it's expired, and if so take over
-              chain_status = self.db.try_active_follower(follower_id=self.follower_id,lock_timeout=block_interval*10) # we don't overwrite last_processed_block
-
-           if chain_status['active_follower_id'] == self.follower_id: # we are active
-              await self.run_active(chain=chain,start_block=chain_status['last_processed_block']+1,max_blocks=10,block_interval=block_interval)
-           else: # we are not active, so go to sleep for now
-              logger.info('We are not active follower, sleeping until %s', str(chain_status['lock_expires']))
-              now = datetime.datetime.now()
-              sleep_time = chain_status['lock_expires'] - now
-              await asyncio.sleep(sleep_time.total_seconds())
-
+        try:
+            while True:
+                if self.try_lead(start_block):
+                    await self.run_active(chain=chain,start_block=self.chain_status['last_processed_block']+1,max_blocks=10,block_interval=block_interval)
+                else:  # we are not active, so go to sleep for now
+                    await self.wait_for_lock()
+        finally:
+            self.step_down(release=True)
 
     async def run_active(self,chain=None,start_block=None,max_blocks=9,block_interval=2):
           queue = asyncio.Queue()
+          loop = asyncio.get_event_loop()
+          fencing_token = self.fencing_token
           logger.debug('We are active follower!')
           if start_block is None: start_block = self.get_start_block(chain)
-          processed_count = 0
+          try:
+             # steemd calls block, run them in the executor so the
+             # heartbeat keeps the lock while we wait on them
+             head_block = await loop.run_in_executor(None, chain.get_current_block_num)
+          except Exception:
+             logger.exception('Failed to get head block number')
+             head_block = None
 
           for block_num in range(start_block,start_block+max_blocks):
+              if self.fencing_token != fencing_token:
+                 logger.warning('Lost the follower lock, stopping before block %d', block_num)
+                 return
               try:
-                 ops = self.steemd_rpc.get_ops_in_block(block_num, False)
+                 ops = await loop.run_in_executor(None, self.steemd_rpc.get_ops_in_block, block_num, False)
                  for op in ops:
+                       if self.fencing_token != fencing_token:
+                          break
                        await queue.put(op)
                        await asyncio.sleep(0)
                        runner_resp = await self.run_queue(queue)
                        if runner_resp:
                           queue.put(runner_resp)
-                 processed_count += 1
-                 new_timeout = ((max_blocks+1) - processed_count) * block_interval # as we process more blocks, shrink our timeout, but leave enough space for another block
-                 self.db.try_update_status(follower_id = self.follower_id, last_processed_block = block_num, lock_timeout = new_timeout)
+                 else:
+                    BLOCKS_PROCESSED.inc()
+                    FOLLOWER_LAST_BLOCK.set(block_num)
+                    if head_block is not None:
+                       FOLLOWER_LAG_BLOCKS.set(max(head_block - block_num, 0))
+                    # fenced, a follower that lost the lock can't move the status
+                    self.db.try_update_status(follower_id = self.follower_id, last_processed_block = block_num, lock_timeout = self.lock_timeout, fencing_token = fencing_token)
+                    self.yo_app.signal_private_api('notification_sender', 'wake')
               except Exception:
                  logger.exception('Exception occurred')
 
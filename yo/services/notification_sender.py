@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import logging
+import time
 
+from ..circuit_breaker import AIMDLimiter
+from ..circuit_breaker import CircuitBreaker
+from ..db import Priority
+from ..digest import DigestScheduler
+from ..metrics import TRANSPORT_SEND_SECONDS
+from ..metrics import TRANSPORT_SENDS
+from ..ratelimits import SQLiteRateStore
+from ..ratelimits import SlidingWindowLimiter
 from ..ratelimits import check_ratelimit
-from ..transports import sendgrid
-from ..transports import twilio
-from ..transports import wwwpoll
+from ..ratelimits import load_policies
+from ..shards import ShardLeases
+from ..subscriptions import RoutingCache
+from ..tracing import TRACER
+from ..tracing import local_to_epoch
+from ..tracing import to_epoch
 from .base_service import YoBaseService
 
 logger = logging.getLogger(__name__)
@@ -14,6 +27,9 @@ logger = logging.getLogger(__name__)
      1. Blockchain sender inserts notification into DB
      2. Blockchain sender triggers the notification by calling internal API method
      3. Notification sender checks if the notification is already sent or not, if not it sends to all configured transports and updates it to sent
+
+    While the circuit of a transport is open (see circuit_breaker) its
+    notifications are recorded as Deferred and sent once the circuit closes.
 """
 
 
@@ -23,67 +39,363 @@ class YoNotificationSender(YoBaseService):
     def __init__(self, yo_app=None, config=None, db=None):
         super().__init__(yo_app=yo_app, config=config, db=db)
         self.configured_transports = {}
+        self.started_transports = set()
+        self.wakeup = asyncio.Event()
+        settings = self.yo_app.config.config_data['notification_sender']
+        self.routes = RoutingCache(
+            self.db,
+            max_users=settings.getint('routing_cache_users', 10000),
+            max_age=settings.getfloat('routing_cache_max_age', 60))
+        self.breaker_settings = {
+            'window': settings.getfloat('breaker_window', 60),
+            'min_sends': settings.getint('breaker_min_sends', 20),
+            'error_rate': settings.getfloat('breaker_error_rate', 0.5),
+            'slow_seconds': settings.getfloat('breaker_slow_seconds', 10),
+            'cooldown': settings.getfloat('breaker_cooldown', 30)
+        }
+        self.deferred_batch_size = settings.getint('deferred_batch_size',
+                                                   1000)
+        self.breakers = {}
+        self.limiters = {}
+        self.shards = None
+        if settings.getint('shards', 1) > 1:
+            self.shards = ShardLeases(
+                self.db,
+                settings.getint('shards'),
+                lease_timeout=settings.getfloat('shard_lease_timeout', 30))
+        ratelimit_settings = self.yo_app.config.config_data['ratelimits']
+        self.ratelimit_policies = load_policies(ratelimit_settings)
+        self.ratelimiter = None
+        if ratelimit_settings.getint('in_memory', 1):
+            store = None
+            if ratelimit_settings.get('store_path'):
+                store = SQLiteRateStore(
+                    ratelimit_settings['store_path'],
+                    sync_interval=ratelimit_settings.getfloat(
+                        'store_sync_interval', 1))
+            self.ratelimiter = SlidingWindowLimiter(
+                *self.ratelimit_policies, store=store)
+        self.digests = None
+        self.digest_priorities = set()
+        if settings.getint('digest', 1):
+            self.digest_priorities = {
+                Priority[name.strip().upper()]
+                for name in settings.get('digest_priorities',
+                                         'low,marketing').split(',')
+                if name.strip()
+            }
+            self.digests = DigestScheduler(
+                self.db,
+                self.send_digest_email,
+                self.routes,
+                owns=self.owns,
+                period=settings.getfloat('digest_period', 86400),
+                slices=settings.getint('digest_slices', 96),
+                max_items=settings.getint('digest_max_items', 50))
+
+    def owns(self, username):
+        """Whether this worker sends the user's notifications"""
+        return self.shards is None or self.shards.owns(username)
+
+    def check_ratelimit(self, notification):
+        if self.ratelimiter is not None:
+            return self.ratelimiter.check(self.db, notification)
+        return check_ratelimit(
+            self.db, notification, policies=self.ratelimit_policies)
+
+    def guard(self, transport_name):
+        """ Returns the (circuit breaker, concurrency limiter) of a transport,
+        the breaker is None for transports that don't use one
+        """
+        if transport_name not in self.limiters:
+            transport = self.configured_transports[transport_name]
+            self.limiters[transport_name] = AIMDLimiter(
+                transport_name, transport.max_concurrency)
+            self.breakers[transport_name] = None
+            if transport.circuit_breaker:
+                self.breakers[transport_name] = CircuitBreaker(
+                    transport_name, **self.breaker_settings)
+        return self.breakers[transport_name], self.limiters[transport_name]
+
+    async def send_digest_email(self, **kwargs):
+        breaker, limiter = self.guard('email')
+        async with limiter:
+            if breaker is not None and not breaker.allow():
+                raise RuntimeError('The email circuit is open')
+            start = time.perf_counter()
+            try:
+                with TRANSPORT_SEND_SECONDS.time('email'):
+                    await self.configured_transports['email'].send_one(kwargs)
+            except Exception:
+                if breaker is not None:
+                    breaker.record(0, 1, time.perf_counter() - start)
+                limiter.record(False)
+                raise
+            elapsed = time.perf_counter() - start
+            if breaker is not None:
+                breaker.record(1, 0, elapsed)
+            limiter.record(elapsed <= self.breaker_settings['slow_seconds'])
+
+    def queue_digest(self, notification, transports):
+        """ Queues a rate limited notification for the user's email digest
+
+        Returns:
+            True if it was queued
+        """
+        if notification['priority_level'] not in self.digest_priorities or \
+                'email' not in self.configured_transports or \
+                'email' not in [t[0] for t in transports]:
+            return False
+        logger.info('Queueing rate limited notification %s for a digest',
+                    notification['nid'])
+        TRANSPORT_SENDS.inc('email', 'queued')
+        self.db.mark_sent(notification, 'email', status='Digest')
+        return True
 
     async def api_trigger_notifications(self):
         await self.run_send_notify()
         return {'result': 'Succeeded'}  # FIXME
 
+    async def api_wake(self):
+        """ Wakes up the sender loop without waiting for it to run
+
+        This is what the blockchain follower signals after storing new
+        notifications, many wake-ups before the loop runs count as one
+        """
+        self.wakeup.set()
+        return {'result': 'Succeeded'}
+
+    async def start_transports(self):
+        """Runs the start() hook of transports that weren't started yet"""
+        for name, transport in self.configured_transports.items():
+            if name in self.started_transports:
+                continue
+            logger.info('Starting transport %s', name)
+            await transport.start()
+            self.started_transports.add(name)
+
+    async def stop_transports(self):
+        for name in list(self.started_transports):
+            logger.info('Stopping transport %s', name)
+            try:
+                await self.configured_transports[name].stop()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Exception occurred stopping transport %s',
+                                 name)
+            self.started_transports.discard(name)
+
+    def defer(self, transport_name, chunk):
+        """Holds back a chunk while the circuit of its transport is open"""
+        TRANSPORT_SENDS.inc(transport_name, 'deferred', amount=len(chunk))
+        self.db.mark_deferred(
+            [n for n, _ in chunk if not n.get('deferred')], transport_name)
+
+    async def send_chunk(self, transport_name, chunk):
+        transport = self.configured_transports[transport_name]
+        breaker, limiter = self.guard(transport_name)
+        async with limiter:
+            if self.shards is not None:
+                # the pass may have outlived a lease, leave the notifications
+                # of lost shards to their new owner
+                self.shards.renew()
+                chunk = [(notification, item) for notification, item in chunk
+                         if self.owns(item['to_username'])]
+                if not chunk:
+                    return
+            if breaker is not None and not breaker.allow():
+                self.defer(transport_name, chunk)
+                return
+            start = time.perf_counter()
+            with TRANSPORT_SEND_SECONDS.time(transport_name):
+                try:
+                    results = await transport.send_batch(
+                        [item for _, item in chunk])
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Exception occurred when sending %d '
+                                     'notifications to transport %s',
+                                     len(chunk), transport_name)
+                    results = [False] * len(chunk)
+            elapsed = time.perf_counter() - start
+            failed = len(chunk) - sum(1 for sent in results if sent)
+            if breaker is not None:
+                breaker.record(len(chunk) - failed, failed, elapsed)
+            limiter.record(not failed and
+                           elapsed <= self.breaker_settings['slow_seconds'])
+        retried = {True: [], False: []}
+        for (notification, _), sent in zip(chunk, results):
+            TRANSPORT_SENDS.inc(transport_name, 'sent' if sent else 'failed')
+            if notification.get('deferred'):
+                retried[bool(sent)].append(notification['nid'])
+            if not sent:
+                continue
+            TRACER.record(notification['nid'], 'deliver')
+            if not transport.marks_sent and not notification.get('deferred'):
+                self.db.mark_sent(notification, transport_name)
+        for sent, nids in retried.items():
+            if nids:
+                self.db.update_deferred_actions(nids, transport_name,
+                                                'Sent' if sent else 'Failed')
+
+    async def flush_batches(self, batches):
+        """ Sends the collected notifications, each transport gets chunks of
+        up to its max_batch_size, as many at once as its limiter allows
+
+        Args:
+            batches(dict): transport name -> [(notification, item)]
+        """
+        sends = []
+        for transport_name, entries in batches.items():
+            size = max(
+                1, self.configured_transports[transport_name].max_batch_size)
+            sends.extend(
+                self.send_chunk(transport_name, entries[start:start + size])
+                for start in range(0, len(entries), size))
+        await asyncio.gather(*sends)
+
+    def queue_deferred(self, batches):
+        """ Adds the deferred notifications of transports whose circuit
+        would let them through to the batches
+        """
+        for transport_name in self.configured_transports:
+            breaker, _ = self.guard(transport_name)
+            if breaker is None or not breaker.ready():
+                continue
+            for notification in self.db.get_deferred_notifications(
+                    transport_name, limit=self.deferred_batch_size):
+                username = notification['to_username']
+                if not self.owns(username):
+                    continue
+                sub_data = [
+                    t[1] for t in self.routes.routes(username).get(
+                        notification['notify_type'], [])
+                    if t[0] == transport_name
+                ]
+                if not sub_data:
+                    # the user turned the transport off since
+                    self.db.update_deferred_actions(
+                        [notification['nid']], transport_name, 'Skipped')
+                    continue
+                batches.setdefault(transport_name, []).append(
+                    (dict(notification, deferred=True), {
+                        'nid': notification['nid'],
+                        'to_subdata': sub_data[0],
+                        'to_username': username,
+                        'notify_type': notification['notify_type'],
+                        'data': json.loads(notification['json_data'])
+                    }))
+
     async def run_send_notify(self):
-        unsents = self.db.get_wwwpoll_unsents()
+        await self.start_transports()
+        hash_ranges = None
+        if self.shards is not None:
+            self.shards.refresh()
+            hash_ranges = self.shards.hash_ranges()
+        unsents = self.db.get_wwwpoll_unsents(hash_ranges=hash_ranges)
         logger.debug('run_send_notify() handling %s unsents', str(len(unsents)))
+        batches = {}
+        self.queue_deferred(batches)
 
         for username, notifications in unsents.items():
+            if not self.owns(username):
+                continue  # stored without a hash, loaded by every shard
             logger.info(
                 'run_send_notify() handling user %s with %d notifications',
                 username, len(notifications))
-            user_transports = self.db.get_user_transports(username)
-            user_notify_types_transports = {}
-            for transport_name, transport_data in user_transports.items():
-                for notify_type in transport_data['notification_types']:
-                    if notify_type not in user_notify_types_transports.keys():
-                        user_notify_types_transports[notify_type] = []
-                    user_notify_types_transports[notify_type].append(
-                        (transport_name, transport_data['sub_data']))
+            routes = self.routes.routes(username)
             for notification in notifications:
+                TRACER.record(
+                    notification['nid'],
+                    'claim',
+                    block=to_epoch(notification.get('block_time')),
+                    commit=local_to_epoch(notification.get('created')))
+                transports = routes.get(notification['notify_type'])
+                if not transports:
+                    # recorded so the notification isn't picked up again
+                    logger.debug('No transport of %s takes %s', username,
+                                 notification['notify_type'])
+                    TRANSPORT_SENDS.inc('none', 'skipped')
+                    self.db.mark_sent(notification, None, status='Skipped')
+                    continue
                 logger.debug('Ratelimit checking on %s', str(notification))
-                if not check_ratelimit(self.db, notification):
+                if not self.check_ratelimit(notification):
+                    if self.queue_digest(notification, transports):
+                        continue
                     logger.info(
                         'Skipping notification for failing rate limit check: %s',
                         str(notification))
                     continue
-                for t in user_notify_types_transports[notification[
-                        'notify_type']]:
-                    logger.info('Sending notification %s to transport %s',
-                                str(notification), str(t[0]))
-                    try:
-                       self.configured_transports[t[0]].send_notification(
-                            to_subdata=t[1],
-                            to_username=username,
-                            notify_type=notification['notify_type'],
-                            data=json.loads(notification['json_data']))
-                       self.db.mark_sent(notification,t[0])
-                    except:
-                       logger.exception('Exception occurred when sending notification %s', str(notification))
+                data = json.loads(notification['json_data'])
+                for transport_name, sub_data in transports:
+                    if transport_name not in self.configured_transports:
+                        logger.debug('Transport %s is not configured',
+                                     transport_name)
+                        TRANSPORT_SENDS.inc(transport_name, 'failed')
+                        continue
+                    batches.setdefault(transport_name, []).append(
+                        (notification, {
+                            'nid': notification['nid'],
+                            'to_subdata': sub_data,
+                            'to_username': username,
+                            'notify_type': notification['notify_type'],
+                            'data': data
+                        }))
+                    # counted now, so later notifications of this pass see
+                    # it, even if the send fails
+                    if self.ratelimiter is not None:
+                        self.ratelimiter.record(username,
+                                                notification['priority_level'])
+        await self.flush_batches(batches)
 
     def init_api(self):
         self.private_api_methods[
             'trigger_notifications'] = self.api_trigger_notifications
+        self.private_api_methods['wake'] = self.api_wake
         if self.yo_app.config.config_data['wwwpoll'].getint('enabled', 1):
             logger.info('Enabling wwwpoll transport')
+            from ..transports import wwwpoll
             self.configured_transports['wwwpoll'] = wwwpoll.WWWPollTransport(
                 self.db)
         if self.yo_app.config.config_data['sendgrid'].getint('enabled', 0):
             logger.info('Enabling sendgrid (email) transport')
+            from ..transports import sendgrid  # pulls in jinja2 and premailer
             self.configured_transports['email'] = sendgrid.SendGridTransport(
                 self.yo_app.config.config_data['sendgrid']['priv_key'],
-                self.yo_app.config.config_data['sendgrid']['templates_dir'])
+                self.yo_app.config.config_data['sendgrid']['templates_dir'],
+                base_url=self.yo_app.config.config_data['sendgrid'].get(
+                    'base_url'))
         if self.yo_app.config.config_data['twilio'].getint('enabled', 0):
             logger.info('Enabling twilio (sms) transport')
+            from ..transports import twilio
             self.configured_transports['sms'] = twilio.TwilioTransport(
                 self.yo_app.config.config_data['twilio']['account_sid'],
                 self.yo_app.config.config_data['twilio']['auth_token'],
                 self.yo_app.config.config_data['twilio']['from_number'],
-            )
+                base_url=self.yo_app.config.config_data['twilio'].get(
+                    'base_url'))
 
     async def async_task(self):
-        pass
+        # woken up by the blockchain follower, poll_interval is only a
+        # fallback in case a wake-up signal gets lost
+        poll_interval = self.yo_app.config.config_data[
+            'notification_sender'].getfloat('poll_interval', 60)
+        if self.shards is not None:
+            # passes renew the shard leases
+            poll_interval = min(poll_interval, self.shards.lease_timeout / 3)
+        await self.start_transports()
+        if self.digests is not None and 'email' in self.configured_transports:
+            asyncio.ensure_future(self.digests.run())
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                try:
+                    await self.run_send_notify()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Exception occurred in run_send_notify')
+        finally:
+            if self.shards is not None:
+                self.shards.release()
+            await self.stop_transports()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+""" Retention service, moves expired rows out of the hot tables
+
+    Every interval, notifications older than the TTL of their type are
+    written to archive segments (see yo/archive.py) together with their
+    wwwpoll and action rows, then deleted. This works in small batches with
+    a pause between them, each batch deleting in one short transaction, so
+    the follower, sender and API are never locked out for long.
+"""
+import asyncio
+import datetime
+import logging
+
+from ..archive import ArchiveWriter
+from ..db import NOTIFY_TYPES
+from ..metrics import RETENTION_ROWS
+from .base_service import YoBaseService
+
+logger = logging.getLogger(__name__)
+
+
+class YoRetention(YoBaseService):
+    service_name = 'retention'
+
+    def __init__(self, yo_app=None, config=None, db=None):
+        super().__init__(yo_app=yo_app, config=config, db=db)
+        settings = self.yo_app.config.config_data['retention']
+        self.interval = settings.getfloat('interval', 3600)
+        self.batch_size = settings.getint('batch_size', 1000)
+        self.batch_pause = settings.getfloat('batch_pause', 0.1)
+        self.actions_ttl_days = settings.getfloat('actions_ttl_days', 0)
+        self.ttl_days = {
+            notify_type:
+            settings.getfloat('ttl_days_%s' % notify_type,
+                              settings.getfloat('default_ttl_days', 0))
+            for notify_type in NOTIFY_TYPES
+        }
+        self.archive = None
+        if settings.getint('archive', 1):
+            self.archive = ArchiveWriter(
+                settings.get('archive_dir', 'archive'),
+                segment_bytes=settings.getint('segment_bytes',
+                                              64 * 1024 * 1024))
+
+    async def api_run_retention(self):
+        return {'result': await self.run_retention()}
+
+    def archive_rows(self, table_name, rows):
+        if rows and self.archive is not None:
+            self.archive.write(table_name, rows)
+        RETENTION_ROWS.inc(table_name, amount=len(rows))
+
+    def expire_batch(self, table_name, before, notify_type=None):
+        """ Archives and deletes one batch of expired rows
+
+        Returns:
+            int: the number of rows found in table_name
+        """
+        rows = self.db.get_expired_rows(
+            table_name,
+            before,
+            notify_type=notify_type,
+            limit=self.batch_size)
+        if not rows:
+            return 0
+        if table_name == 'yo_actions':
+            self.archive_rows(table_name, rows)
+            deleted = self.db.delete_rows(aids=[row['aid'] for row in rows])
+        else:
+            nids = [row['nid'] for row in rows]
+            # rows referring to these go first, so the archive of a
+            # notification is always complete once it is gone
+            for related in ('yo_actions', 'yo_wwwpoll'):
+                if related != table_name:
+                    self.archive_rows(related,
+                                      self.db.get_related_rows(related, nids))
+            self.archive_rows(table_name, rows)
+            deleted = self.db.delete_rows(nids=nids)
+        if not deleted:
+            raise RuntimeError('Failed to delete expired %s rows' % table_name)
+        return len(rows)
+
+    async def expire_table(self, table_name, before, notify_type=None):
+        total = 0
+        while True:
+            count = self.expire_batch(table_name, before, notify_type)
+            total += count
+            if count < self.batch_size:
+                return total
+            await asyncio.sleep(self.batch_pause)
+
+    async def run_retention(self):
+        """ Expires everything past its TTL
+
+        Returns:
+            dict: rows expired per table
+        """
+        totals = {}
+        now = datetime.datetime.utcnow()
+        ttls = self.ttl_days
+        legacy = [
+            table_name for table_name in ('yo_notifications', 'yo_wwwpoll')
+            if self.db.has_legacy_nids(table_name)
+        ]
+        if legacy and any(days > 0 for days in ttls.values()):
+            # uuid4 nids don't sort by time, a nid cut-off would delete
+            # recent notifications and keep old ones
+            logger.error(
+                'Not expiring notifications, %s still has uuid4 nids, run '
+                'python -m yo.db_utils <db_url> migrate-ids first',
+                ', '.join(legacy))
+            ttls = {}
+        for notify_type, ttl_days in sorted(ttls.items()):
+            if ttl_days <= 0:
+                continue
+            before = now - datetime.timedelta(days=ttl_days)
+            # wwwpoll after notifications, for wwwpoll rows left on their own
+            for table_name in ('yo_notifications', 'yo_wwwpoll'):
+                count = await self.expire_table(table_name, before,
+                                                notify_type)
+                totals[table_name] = totals.get(table_name, 0) + count
+        if self.actions_ttl_days > 0:
+            # actions are timestamped in local time by mark_sent
+            before = datetime.datetime.now() - datetime.timedelta(
+                days=self.actions_ttl_days)
+            totals['yo_actions'] = await self.expire_table('yo_actions', before)
+        if self.archive is not None:
+            self.archive.compact('yo_notifications')
+        logger.info('Retention run expired %s', totals)
+        return totals
+
+    def init_api(self):
+        self.private_api_methods['run_retention'] = self.api_run_retention
+
+    async def async_task(self):
+        while True:
+            try:
+                await self.run_retention()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Exception occurred in run_retention')
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+""" Sharding of the notification sender
+
+    With shards=N in [notification_sender], the crc32 of a username is cut
+    into N equal ranges and every shard sends the notifications of the users
+    in its range, so a user's notifications are always sent in order by one
+    worker and its rate limit state stays in that worker's memory.
+
+    Sender workers lease shards in yo_sender_shards the way followers lease
+    yo_chain_status: a lease is renewed before every pass and between the
+    batches of a pass, and lapses after lease_timeout seconds. Workers also heartbeat in yo_sender_workers. A
+    worker takes its fair share of the shards, ceil(N / live workers), from
+    the ones that are new or whose lease expired, and releases any above its
+    share so workers that just started get theirs. When a worker dies its
+    shards are picked up by the others once their leases run out.
+
+    Notifications store the crc32 of their recipient in to_username_hash,
+    so a worker only loads the unsent notifications of its own shards.
+"""
+import datetime
+import logging
+import math
+import time
+import uuid
+import zlib
+
+from .metrics import SENDER_SHARDS_OWNED
+
+logger = logging.getLogger(__name__)
+
+HASH_SPACE = 2**32
+
+
+def username_hash(username):
+    """The crc32 of a username, stored with its notifications"""
+    return zlib.crc32(username.encode('utf-8'))
+
+
+def shard_of(username, shards):
+    """The shard whose crc32 range the username falls into"""
+    return username_hash(username) * shards // HASH_SPACE
+
+
+def hash_range(shard_id, shards):
+    """ The crc32 values of a shard's users
+
+    Returns:
+        (int, int): the lowest hash in the shard and the lowest one past it
+    """
+    return (-(-shard_id * HASH_SPACE // shards),
+            -(-(shard_id + 1) * HASH_SPACE // shards))
+
+
+class ShardLeases:
+    def __init__(self, db, shards, lease_timeout=30, worker_id=None):
+        """ Leases shards of the sender for one worker
+
+        Args:
+            db(YoDatabase):         where leases are kept
+            shards(int):            total number of shards
+        Keyword args:
+            lease_timeout(float):   seconds a lease lasts without renewal
+            worker_id(str):         defaults to a new uuid
+        """
+        self.db = db
+        self.shards = shards
+        self.lease_timeout = lease_timeout
+        self.worker_id = worker_id or str(uuid.uuid1())
+        self.owned = set()
+        self.renewed = None
+
+    def owns(self, username):
+        return shard_of(username, self.shards) in self.owned
+
+    def hash_ranges(self):
+        """The crc32 ranges of the owned shards, to filter queries by"""
+        return [hash_range(shard_id, self.shards)
+                for shard_id in sorted(self.owned)]
+
+    def renew(self):
+        """ Renews the worker's leases if a third of lease_timeout passed
+        since they were last renewed, so they don't lapse during a long pass
+
+        Returns:
+            set: the shards the worker still owns
+        """
+        if self.renewed is not None and \
+                time.monotonic() - self.renewed < self.lease_timeout / 3:
+            return self.owned
+        self.renewed = time.monotonic()
+        owned = self.db.renew_sender_shards(
+            worker_id=self.worker_id,
+            shard_ids=list(self.owned),
+            lock_timeout=self.lease_timeout)
+        if owned != self.owned:
+            logger.warning('Lost sender shards %s', self.owned - owned)
+            self.owned = owned
+            SENDER_SHARDS_OWNED.set(len(self.owned))
+        return self.owned
+
+    def refresh(self, now=None):
+        """ Renews the worker's leases and takes or releases shards to get
+        to its fair share
+
+        Keyword args:
+            now(datetime): the current time as stored in the leases, now by
+                           default
+
+        Returns:
+            set: the shards the worker owns now
+        """
+        now = now or datetime.datetime.now()
+        self.renewed = time.monotonic()
+        self.owned = self.db.renew_sender_shards(
+            worker_id=self.worker_id,
+            shard_ids=list(self.owned),
+            lock_timeout=self.lease_timeout)
+        workers = self.db.touch_sender_worker(
+            worker_id=self.worker_id, lock_timeout=self.lease_timeout)
+        share = int(math.ceil(self.shards / workers))
+        leases = self.db.get_sender_shards()
+        if len(self.owned) > share:
+            extra = sorted(self.owned)[share:]
+            logger.info('Releasing sender shards %s to other workers', extra)
+            self.db.release_sender_shards(
+                worker_id=self.worker_id, shard_ids=extra)
+            self.owned -= set(extra)
+        taken = {
+            lease['shard_id']
+            for lease in leases if lease['lock_expires'] > now
+        }
+        for shard_id in range(self.shards):
+            if len(self.owned) >= share:
+                break
+            if shard_id in taken or shard_id in self.owned:
+                continue
+            if self.db.try_acquire_sender_shard(
+                    worker_id=self.worker_id,
+                    shard_id=shard_id,
+                    lock_timeout=self.lease_timeout):
+                logger.info('Took over sender shard %d', shard_id)
+                self.owned.add(shard_id)
+        SENDER_SHARDS_OWNED.set(len(self.owned))
+        return self.owned
+
+    def release(self):
+        """Hands the shards to the other workers, when shutting down"""
+        self.db.release_sender_shards(
+            worker_id=self.worker_id, shard_ids=list(self.owned))
+        # a heartbeat that already expired, so the others stop counting us
+        self.db.touch_sender_worker(worker_id=self.worker_id, lock_timeout=0)
+        self.owned = set()
+        SENDER_SHARDS_OWNED.set(0)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+""" In-memory views of user transport settings
+
+    SubscriptionIndex holds the notification types each user can receive.
+    The blockchain follower consults this before writing a notification, so
+    events no transport would ever deliver never hit yo_notifications.
+
+    The index is kept in sync with set_user_transports/create_user on the
+    same YoDatabase instance through a listener, and periodically refreshed
+    from rows whose updated timestamp moved on, which picks up changes made
+    through API servers running on other nodes.
+
+    RoutingCache holds, for the users the notification sender recently
+    delivered to, which transports each notification type goes to.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from .db import DEFAULT_USER_TRANSPORT_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+def enabled_notify_types(transports):
+    """Returns the set of notify types any of the transports delivers"""
+    types = set()
+    for transport_data in (transports or {}).values():
+        types.update(transport_data.get('notification_types') or ())
+    return frozenset(types)
+
+
+class SubscriptionIndex:
+    def __init__(self,
+                 db,
+                 refresh_interval=60,
+                 drop_unknown_users=False,
+                 default_transports=None):
+        """ Index of username -> enabled notify types
+
+        Keyword args:
+            db(YoDatabase):            where user settings are loaded from
+            refresh_interval(float):   seconds between incremental reloads
+            drop_unknown_users(bool):  if set, users without settings get
+                                       nothing, otherwise they get the types
+                                       enabled in default_transports
+            default_transports(dict):  settings for users never seen,
+                                       DEFAULT_USER_TRANSPORT_SETTINGS if None
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.drop_unknown_users = drop_unknown_users
+        self.default_types = enabled_notify_types(
+            DEFAULT_USER_TRANSPORT_SETTINGS
+            if default_transports is None else default_transports)
+        self.users = {}
+        self.watermark = None
+        self.next_refresh = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def update(self, username, transports):
+        self.users[username] = enabled_notify_types(transports)
+
+    def refresh(self):
+        """ Loads settings changed since the last refresh, all on first call
+        """
+        rows = self.db.get_user_settings(updated_since=self.watermark)
+        for row in rows:
+            self.update(row['username'], row['transports'])
+            if self.watermark is None or row['updated'] > self.watermark:
+                self.watermark = row['updated']
+        self.next_refresh = time.monotonic() + self.refresh_interval
+        logger.debug('Refreshed %d user settings, %d users indexed',
+                     len(rows), len(self.users))
+
+    def wants(self, username, notify_type):
+        """Returns True if any of the user's transports take notify_type"""
+        if time.monotonic() >= self.next_refresh:
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Failed to refresh subscription index')
+                self.next_refresh = time.monotonic() + self.refresh_interval
+        types = self.users.get(username)
+        if types is None:
+            if self.drop_unknown_users:
+                return False
+            types = self.default_types
+        return notify_type in types
+
+
+def routing_table(transports):
+    """ Returns notify_type -> [(transport name, sub_data)] for a user's
+    transport settings
+    """
+    table = {}
+    for transport_name, transport_data in (transports or {}).items():
+        for notify_type in transport_data.get('notification_types') or ():
+            table.setdefault(notify_type, []).append(
+                (transport_name, transport_data.get('sub_data')))
+    return table
+
+
+class RoutingCache:
+    def __init__(self, db, max_users=10000, max_age=60):
+        """ Bounded cache of username -> routing table
+
+        Keyword args:
+            db(YoDatabase):    where transports are loaded from, changes
+                               made through it update the cache
+            max_users(int):    users kept, least recently used are evicted
+            max_age(float):    seconds a table is trusted, bounds staleness
+                               from changes made through other nodes
+        """
+        self.db = db
+        self.max_users = max_users
+        self.max_age = max_age
+        self.users = OrderedDict()
+        db.add_user_settings_listener(self.update)
+
+    def __len__(self):
+        return len(self.users)
+
+    def update(self, username, transports):
+        if username in self.users:
+            self.users[username] = (time.monotonic(),
+                                    routing_table(transports))
+
+    def routes(self, username):
+        """ Returns the user's routing table, loading it if needed
+
+        Users without settings get created with the defaults, like
+        get_user_transports does
+        """
+        entry = self.users.get(username)
+        if entry is None or time.monotonic() - entry[0] > self.max_age:
+            entry = (time.monotonic(),
+                     routing_table(self.db.get_user_transports(username)))
+            self.users[username] = entry
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(username)
+        return entry[1]
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+""" End-to-end latency tracing for notifications
+
+    Each notification passes through these stages:
+
+        block   - the timestamp of the block containing the op
+        ingest  - the follower picked up the op
+        commit  - the notification was committed to yo_notifications
+        claim   - the sender picked it up as unsent
+        deliver - a transport acknowledged it
+
+    The time between consecutive stages is observed in the
+    yo_notification_stage_seconds summary, along with block_to_deliver for
+    the end-to-end latency. The stage timestamps of the most recent
+    notifications are also kept per nid for debugging.
+
+    Timestamps are unix epoch seconds (UTC), so traces from a follower and
+    sender on different hosts line up as long as their clocks do.
+"""
+import calendar
+import datetime
+import time
+from collections import OrderedDict
+
+from .metrics import NOTIFICATION_STAGE_SECONDS
+
+STAGES = ('block', 'ingest', 'commit', 'claim', 'deliver')
+
+BLOCK_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def parse_block_time(timestamp):
+    """Returns the naive UTC datetime for a steemd timestamp, or None"""
+    if not timestamp:
+        return None
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+    try:
+        return datetime.datetime.strptime(timestamp, BLOCK_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def to_epoch(utc_datetime):
+    """Converts a naive UTC datetime to epoch seconds"""
+    if utc_datetime is None:
+        return None
+    return calendar.timegm(
+        utc_datetime.timetuple()) + utc_datetime.microsecond / 1e6
+
+
+def local_to_epoch(local_datetime):
+    """ Converts a naive local datetime to epoch seconds, for the columns
+    db.py fills with datetime.now() such as created
+    """
+    if local_datetime is None:
+        return None
+    return local_datetime.timestamp()
+
+
+class NotificationTracer:
+    def __init__(self, max_traces=10000, summary=NOTIFICATION_STAGE_SECONDS):
+        """ Records stage timestamps of notifications
+
+        Keyword args:
+            max_traces(int): how many per-nid traces to keep for debugging
+            summary:         the metrics Summary to observe stage times in
+        """
+        self.max_traces = max_traces
+        self.summary = summary
+        self.traces = OrderedDict()
+
+    def record(self, nid, stage, timestamp=None, **earlier_stages):
+        """ Records that nid reached stage at timestamp (default: now)
+
+        Timestamps for earlier stages can be passed as keyword args, this is
+        how the sender fills in block and commit times read from the DB.
+        Only the first time a stage is reached counts.
+        """
+        trace = self.traces.get(nid)
+        if trace is None:
+            trace = self.traces[nid] = {}
+            if len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        earlier_stages[stage] = time.time() if timestamp is None else timestamp
+        for name in STAGES:
+            if earlier_stages.get(name) is None or name in trace:
+                continue
+            trace[name] = earlier_stages[name]
+            self.observe(trace, name)
+
+    def observe(self, trace, stage):
+        index = STAGES.index(stage)
+        for previous in reversed(STAGES[:index]):
+            if previous in trace:
+                self.summary.observe(
+                    max(trace[stage] - trace[previous], 0),
+                    '%s_to_%s' % (previous, stage))
+                break
+        if stage == 'deliver' and 'block' in trace:
+            self.summary.observe(
+                max(trace['deliver'] - trace['block'], 0), 'block_to_deliver')
+
+    def get_trace(self, nid):
+        """ Returns the recorded stage timestamps for nid, or None
+
+        Stage latencies relative to the block (or first known stage) are
+        included under 'latency'
+        """
+        trace = self.traces.get(nid)
+        if trace is None:
+            return None
+        stages = [stage for stage in STAGES if stage in trace]
+        origin = trace[stages[0]]
+        return {
+            'nid': nid,
+            'stages': {stage: trace[stage]
+                       for stage in stages},
+            'latency': {stage: trace[stage] - origin
+                        for stage in stages}
+        }
+
+
+TRACER = NotificationTracer()
@@ -1,10 +1,77 @@
 # -*- coding: utf-8 -*-
 """ Base transport class
+
+    The sender hands a transport its notifications in batches of up to
+    max_batch_size items, running up to max_concurrency batches of the same
+    transport at once. An item is a dict with the nid of the notification
+    and the send_notification keyword args (SEND_KEYS).
+
+    Transports only implement send_notification, sync or async, unless they
+    can do better for a whole batch. start() and stop() are where connection
+    pools and the like are set up and torn down. A transport whose send_batch
+    records the sent actions itself sets marks_sent, the sender then doesn't.
+    Transports that can't get unhealthy on their own, like wwwpoll, unset
+    circuit_breaker.
 """
+import asyncio
+import inspect
 import logging
 
 logger = logging.getLogger(__name__)
 
+SEND_KEYS = ('to_subdata', 'to_username', 'notify_type', 'data')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call (e.g. a sync HTTP client) in the executor"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+
 
 class BaseTransport:
-    pass
+    max_batch_size = 1
+    max_concurrency = 1
+    marks_sent = False
+    circuit_breaker = True
+
+    async def start(self):
+        """Called once before the first send"""
+        pass
+
+    async def stop(self):
+        """Called when the sender shuts down"""
+        pass
+
+    def send_notification(self,
+                          to_subdata=None,
+                          to_username=None,
+                          notify_type=None,
+                          data=None):
+        """ Sends a notification to a specific user, raises on failure
+
+        Keyword args:
+           to_subdata:       the subscription data for this transport
+           to_username(str): the user we're sending to
+           notify_type(str): the type of notification we're sending
+           data(dict):       a dictionary containing the raw data for the notification
+        """
+        raise NotImplementedError
+
+    async def send_one(self, item):
+        result = self.send_notification(**{k: item.get(k) for k in SEND_KEYS})
+        if inspect.isawaitable(result):
+            await result
+
+    async def send_batch(self, items):
+        """ Sends a batch of items
+
+        Returns:
+            list: True or False for each item, whether it was sent
+        """
+        results = await asyncio.gather(
+            *[self.send_one(item) for item in items], return_exceptions=True)
+        for item, result in zip(items, results):
+            if isinstance(result, Exception):
+                logger.error('%s failed to send %s: %r',
+                             type(self).__name__, item.get('nid'), result)
+        return [not isinstance(result, Exception) for result in results]
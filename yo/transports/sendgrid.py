@@ -1,32 +1,60 @@
 # -*- coding: utf-8 -*-
 """ Sendgrid transport class
+
+    Emails of the same notification type share a template, so send_batch
+    sends them as one request with a personalization per recipient, up to
+    MAX_PERSONALIZATIONS at a time. Each recipient's subject and rendered
+    text/html go in the personalization, the shared content only holds the
+    substitution tags. A request rejected as a whole is split in halves and
+    retried, which narrows it down to the recipients that caused it.
+
+    The SendGrid client is blocking, requests run in the executor.
 """
+import asyncio
 import logging
 
+from python_http_client.exceptions import HTTPError
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Content
-from sendgrid.helpers.mail import Email
-from sendgrid.helpers.mail import Mail
 
 from ..email_templates import EmailRenderer
 from .base_transport import BaseTransport
+from .base_transport import run_blocking
 
 logger = logging.getLogger(__name__)
 
+FROM_EMAIL = {'email': 'no-reply@steemit.com', 'name': 'steemit.com'}
+TEXT_TAG = '-yo_text-'
+HTML_TAG = '-yo_html-'
+# limits of the v3 mail send API
+MAX_PERSONALIZATIONS = 1000
+MAX_SUBSTITUTION_BYTES = 10000
+
 
 class SendGridTransport(BaseTransport):
-    def __init__(self, sendgrid_privkey, templates_dir):
+    max_batch_size = MAX_PERSONALIZATIONS
+    max_concurrency = 4
+
+    def __init__(self, sendgrid_privkey, templates_dir, base_url=None):
         """ Transport implementation for sendgrid
 
         Args:
             sendgrid_privkey(str): the private key for sendgrid
             templates_dir(str): the directory containing email templates
+        Keyword args:
+            base_url(str): the API to talk to, api.sendgrid.com by default
         """
         self.privkey = sendgrid_privkey
-        self.sg = SendGridAPIClient(apikey=sendgrid_privkey)
+        options = {'apikey': sendgrid_privkey}
+        if base_url:
+            options['host'] = base_url
+        self.sg = SendGridAPIClient(**options)
         self.renderer = EmailRenderer(templates_dir)
 
-    def send_notification(self, to_subdata=None, notify_type=None, data=None):
+    async def send_notification(self,
+                                to_subdata=None,
+                                to_username=None,
+                                notify_type=None,
+                                data=None):
         """ Sends a notification to a specific user
 
         Keyword args:
@@ -39,22 +67,118 @@ class SendGridTransport(BaseTransport):
            the subscription data for sendgrid is simply an email address
         """
         logger.debug('SendGrid sending notification to %s', to_subdata)
-        from_email = Email('no-reply@steemit.com', 'steemit.com')
+        results = await self.send_batch([{
+            'to_subdata': to_subdata,
+            'to_username': to_username,
+            'notify_type': notify_type,
+            'data': data
+        }])
+        if not results[0]:
+            raise RuntimeError('SendGrid failed to send to %s' % to_subdata)
 
+    def render(self, item):
+        """Returns the personalization of an item, None if it can't render"""
         try:
-            mail_content = self.renderer.render(notify_type, data)
+            mail_content = self.renderer.render(item['notify_type'],
+                                                item['data'])
         except Exception:
             logger.exception(
                 'Exception occurred when rendering email template')
-            return
-
-        mail = Mail(from_email)
-        mail.subject = mail_content['subject']
-        mail.add_content(Content('text/plain', mail_content['text']))
+            return None
+        substitutions = {TEXT_TAG: mail_content['text']}
         if mail_content['html'] is not None:
-            mail.add_content(Content('text/html', mail_content['html']))
+            substitutions[HTML_TAG] = mail_content['html']
+        return {
+            'to': [{'email': item['to_subdata']}],
+            'subject': mail_content['subject'],
+            'substitutions': substitutions
+        }
 
-        response = self.sg.client.mail.send.post(request_body=mail.get())
-        logger.debug('SendGrid response code %s', response.status_code)
-        logger.debug('SendGrid response body %s', response.body)
-        logger.debug('SendGrid response headers %s', str(response.headers))
+    async def send_batch(self, items):
+        """ Sends many notifications with as few requests as possible
+
+        Args:
+            items(list): dicts with the send_notification keyword args
+
+        Returns:
+            list: True or False for each item, whether it was accepted
+        """
+        results = [False] * len(items)
+        groups = {}
+        for i, item in enumerate(items):
+            personalization = self.render(item)
+            if personalization is None:
+                continue
+            size = sum(
+                len(v.encode('utf-8'))
+                for v in personalization['substitutions'].values())
+            # too big to substitute, these go in a request of their own
+            key = (item['notify_type'], HTML_TAG in
+                   personalization['substitutions'],
+                   i if size > MAX_SUBSTITUTION_BYTES else None)
+            groups.setdefault(key, []).append((i, personalization))
+        posts = [
+            run_blocking(
+                self.post,
+                notify_type,
+                group[start:start + MAX_PERSONALIZATIONS],
+                inline=single is not None)
+            for (notify_type, _, single), group in groups.items()
+            for start in range(0, len(group), MAX_PERSONALIZATIONS)
+        ]
+        for sent in await asyncio.gather(*posts):
+            for i in sent:
+                results[i] = True
+        return results
+
+    def request_body(self, personalizations, inline=False):
+        first = personalizations[0]
+        if inline:
+            # a single recipient with its content in place
+            substitutions = first['substitutions']
+            first = dict(first, substitutions={})
+            personalizations = [first]
+        else:
+            substitutions = {k: k for k in first['substitutions']}
+        content = [{'type': 'text/plain', 'value': substitutions[TEXT_TAG]}]
+        if HTML_TAG in substitutions:
+            content.append({
+                'type': 'text/html',
+                'value': substitutions[HTML_TAG]
+            })
+        return {
+            'from': FROM_EMAIL,
+            'subject': first['subject'],
+            'personalizations': [
+                {k: v for k, v in p.items() if v} for p in personalizations
+            ],
+            'content': content
+        }
+
+    def post(self, notify_type, chunk, inline=False):
+        """ Sends a chunk of (index, personalization), splitting it up if
+        the request is rejected
+
+        Returns:
+            list: the indexes sent
+        """
+        try:
+            response = self.sg.client.mail.send.post(
+                request_body=self.request_body([p for _, p in chunk],
+                                               inline=inline))
+            logger.debug('SendGrid response code %s for %d %s emails',
+                         response.status_code, len(chunk), notify_type)
+            return [i for i, _ in chunk]
+        except HTTPError as e:
+            if e.status_code >= 500 or e.status_code == 429 or \
+                    len(chunk) == 1:
+                logger.error('SendGrid rejected %d %s emails: %s %s',
+                             len(chunk), notify_type, e.status_code, e.body)
+                return []
+            middle = len(chunk) // 2
+            return self.post(notify_type, chunk[:middle], inline) + \
+                self.post(notify_type, chunk[middle:], inline)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to send %d %s emails', len(chunk),
+                             notify_type)
+            return []
@@ -3,8 +3,12 @@
 
     This handles the notifications accessible via the API with polling (as used by condenser).
     "delivery" basically means storing the notification into the wwwpoll table where it can be polled using the API.
+
+    Batches are copied over from the notifications table and marked sent in a
+    single transaction, see YoDatabase.deliver_wwwpoll.
 """
 
+import json
 import logging
 
 from .base_transport import BaseTransport
@@ -13,6 +17,10 @@ logger = logging.getLogger(__name__)
 
 
 class WWWPollTransport(BaseTransport):
+    max_batch_size = 500
+    marks_sent = True
+    circuit_breaker = False
+
     def __init__(self, yo_db):
         """ Transport implementation for polling interface
 
@@ -21,15 +29,34 @@ class WWWPollTransport(BaseTransport):
        """
         self.db = yo_db
 
-    def send_notification(self, to_username=None, data=None):
+    def send_notification(self,
+                          to_subdata=None,
+                          to_username=None,
+                          notify_type=None,
+                          data=None,
+                          nid=None):
         """ Sends a notification to a specific user
 
        Keyword args:
+          to_subdata:       ignored, wwwpoll has no subscription data
           to_username(str): the username for the user we're sending to
+          notify_type(str): the type of notification we're sending
           data(dict):       a dictionary containing the raw data for the notification
+          nid(str):         the id of the notification, mark_read etc use it
 
        Note:
           the subscription data for wwwpoll is ignored at present and not used
        """
         logger.debug('wwwpoll sending notification to %s', to_username)
-        self.db.create_wwwpoll_notification(to_user=to_username, raw_data=data)
+        if not self.db.create_wwwpoll_notification(
+                notify_id=nid,
+                notify_type=notify_type,
+                from_username='',
+                to_username=to_username,
+                json_data=json.dumps(data)):
+            raise RuntimeError('Failed to store wwwpoll notification %s' % nid)
+
+    async def send_batch(self, items):
+        logger.debug('wwwpoll delivering %d notifications', len(items))
+        delivered = self.db.deliver_wwwpoll([item['nid'] for item in items])
+        return [delivered] * len(items)